@@ -43,12 +43,18 @@ namespace RevitGeminiRAG
             // 4. Add Button to Panel
             PushButton pushButton = ribbonPanel.AddItem(buttonData) as PushButton;
 
+            // 5. Warm the RAG model and index in the background so the first query runs at warm speed
+            //    (skipped when the host-wide RAG service is up; the service probe also runs in the background)
+            RunRAGCommand.StartRagWarmupInBackground();
+
             return Result.Succeeded;
         }
 
         public Result OnShutdown(UIControlledApplication application)
         {
             // Clean up resources if needed
+            RunRAGCommand.StopRagWorker(); // Stop the long-lived Python RAG worker, if one was started
+            RunRAGCommand.StopRagWarmup(); // Stop a warm-up that is still running
             return Result.Succeeded;
         }
     }
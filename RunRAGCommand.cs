@@ -9,6 +9,7 @@ using System.Text;
 using System.Reflection;
 using System.Threading.Tasks;
 using System.Net.Http;
+using System.Net.Sockets;
 // Removed System.Net.Http.Headers as it wasn't explicitly used
 using Newtonsoft.Json;
 using Newtonsoft.Json.Linq;
@@ -53,7 +54,24 @@ namespace RevitGeminiRAG
         private const string GoogleApiKeyEnvVariable = "GOOGLE_API_KEY";
         private const int MaxOutputTokens = 8192;
         private const int MaxRetryAttempts = 5; // Max number of times to try fixing errors
-        // --- END CONFIGURATION ---
+        private const string PythonExePath = @"C:\Users\isele\anaconda3\envs\revit_rag_env\python.exe"; // IMPORTANT: Verify this path or make it configurable
+        private const int RagWorkerStartupTimeoutMs = 300000; // 5 minutes: first start loads the embedding model and opens ChromaDB
+        private const int RagWorkerRequestTimeoutMs = 120000; // 2 minutes per query once the worker is warm
+        private const string RagServiceAddress = "127.0.0.1:47615"; // Host-wide 'generate_rag_prompt.py --listen' service; "" disables it
+        private const int RagServiceConnectTimeoutMs = 300;
+        private const int RagServiceRetryDelayMs = 60000; // After a failed connect, use the per-session worker for a minute before retrying
+        // --- END CONFIGURATION ---
+
+        // --- RAG WORKER STATE ---
+        // A single long-lived 'generate_rag_prompt.py --serve' process is shared by all command invocations
+        // so the embedding model and ChromaDB collection stay loaded between queries.
+        private static readonly object RagWorkerLock = new object();
+        private static Process _ragWorker;
+        private static int _ragWorkerRequestId;
+        private static readonly object RagWarmupLock = new object();
+        private static Process _ragWarmup; // Background `warmup` run started by App.OnStartup
+        private static bool _ragWarmupStopped; // Set by StopRagWarmup so a warm-up decided on too late never starts
+        private static DateTime _ragServiceRetryAfter = DateTime.MinValue;
 
         public Result Execute(
       ExternalCommandData commandData,
@@ -112,7 +130,7 @@ namespace RevitGeminiRAG
             try
             {
                 System.Diagnostics.Debug.WriteLine("Generating initial LLM prompt via Python RAG script...");
-                initialRagPrompt = GenerateLlmPromptViaPython(userQuery: userPrompt); // Pass userPrompt here
+                initialRagPrompt = GenerateLlmPrompt(userQuery: userPrompt); // Pass userPrompt here
                 if (string.IsNullOrWhiteSpace(initialRagPrompt))
                 {
                     message = "Failed to generate initial LLM prompt via Python script (returned empty). Check Python script logs/errors in Debug Output.";
@@ -417,21 +435,322 @@ CORRECTED PYTHON SCRIPT (or single comment line if unfixable):
         }
 
 
-        /// <summary>
-        /// Executes an external Python script to generate the initial prompt for the LLM.
-        /// </summary>
-        private string GenerateLlmPromptViaPython(string userQuery)
+        /// <summary>
+        /// Resolves and validates the Python executable, working directory and RAG script paths.
+        /// </summary>
+        private static void ResolvePythonPaths(out string pythonExePath, out string pythonWorkingDir, out string scriptPath)
         {
             string assemblyLocation = Assembly.GetExecutingAssembly().Location;
             string pluginDirectory = Path.GetDirectoryName(assemblyLocation);
-            string pythonWorkingDir = Path.Combine(pluginDirectory, "Python");
-            string scriptPath = Path.Combine(pythonWorkingDir, "generate_rag_prompt.py");
-            // IMPORTANT: Verify this path or make it configurable (e.g., via environment variable or config file)
-            string pythonExePath = @"C:\Users\isele\anaconda3\envs\revit_rag_env\python.exe";
+            pythonWorkingDir = Path.Combine(pluginDirectory, "Python");
+            scriptPath = Path.Combine(pythonWorkingDir, "generate_rag_prompt.py");
+            pythonExePath = PythonExePath;
 
             if (!Directory.Exists(pythonWorkingDir)) throw new DirectoryNotFoundException($"Python working directory not found: {pythonWorkingDir}");
             if (!File.Exists(scriptPath)) throw new FileNotFoundException($"Python RAG script not found: {scriptPath}");
             if (!File.Exists(pythonExePath)) throw new FileNotFoundException($"Python executable not found. Please check the path: {pythonExePath}");
+        }
+
+
+        /// <summary>
+        /// Generates the initial prompt via the host-wide RAG service if one is running, otherwise via the long-lived
+        /// Python RAG worker of this Revit session, falling back to a one-shot Python process if the worker fails.
+        /// </summary>
+        private string GenerateLlmPrompt(string userQuery)
+        {
+            if (!string.IsNullOrEmpty(RagServiceAddress) && DateTime.UtcNow >= _ragServiceRetryAfter)
+            {
+                try
+                {
+                    return GenerateLlmPromptViaService(userQuery);
+                }
+                catch (Exception ex)
+                {
+                    System.Diagnostics.Debug.WriteLine($"WARNING: Host-wide RAG service at {RagServiceAddress} unavailable ({ex.Message}). Using the per-session worker.");
+                    _ragServiceRetryAfter = DateTime.UtcNow.AddMilliseconds(RagServiceRetryDelayMs);
+                }
+            }
+            try
+            {
+                return GenerateLlmPromptViaWorker(userQuery);
+            }
+            catch (Exception ex)
+            {
+                System.Diagnostics.Debug.WriteLine($"WARNING: Python RAG worker failed ({ex.Message}). Falling back to a one-shot Python process.");
+                StopRagWorker();
+                return GenerateLlmPromptViaPython(userQuery);
+            }
+        }
+
+
+        /// <summary>
+        /// Sends the query to the host-wide 'generate_rag_prompt.py --listen' service over TCP (same JSON protocol as the worker).
+        /// </summary>
+        private string GenerateLlmPromptViaService(string userQuery)
+        {
+            using (TcpClient client = new TcpClient())
+            {
+                ConnectToRagService(client);
+                client.ReceiveTimeout = RagWorkerRequestTimeoutMs;
+                using (NetworkStream stream = client.GetStream())
+                using (StreamReader reader = new StreamReader(stream, new UTF8Encoding(false)))
+                using (StreamWriter writer = new StreamWriter(stream, new UTF8Encoding(false)) { NewLine = "\n", AutoFlush = true })
+                {
+                    JObject ready = JObject.Parse(reader.ReadLine() ?? throw new InvalidOperationException("RAG service closed the connection."));
+                    if (ready["event"]?.ToString() != "ready")
+                        throw new InvalidOperationException($"Unexpected first message from RAG service: {ready.ToString(Formatting.None)}");
+
+                    // The client name lets the service report latency per Revit session
+                    string clientName = $"{Environment.UserName}@{Environment.MachineName}/revit-{Process.GetCurrentProcess().Id}";
+                    System.Diagnostics.Debug.WriteLine($"DEBUG: Sending query to host-wide RAG service at {RagServiceAddress}: [{userQuery}]");
+                    writer.WriteLine(JsonConvert.SerializeObject(new { id = 1, query = userQuery, client = clientName }));
+
+                    JObject response = JObject.Parse(reader.ReadLine() ?? throw new InvalidOperationException("RAG service closed the connection."));
+                    if (response["ok"]?.ToObject<bool>() != true)
+                        throw new InvalidOperationException($"RAG service reported an error: {response["error"]}");
+
+                    System.Diagnostics.Debug.WriteLine($"DEBUG: RAG service stage timings: {response["timings"]?.ToString(Formatting.None)}");
+                    return response["prompt"]?.ToString()?.Trim() ?? string.Empty;
+                }
+            }
+        }
+
+
+        /// <summary>
+        /// Connects to the host-wide RAG service at RagServiceAddress, giving up after RagServiceConnectTimeoutMs.
+        /// </summary>
+        private static void ConnectToRagService(TcpClient client)
+        {
+            int separator = RagServiceAddress.LastIndexOf(':');
+            string host = RagServiceAddress.Substring(0, separator);
+            int port = int.Parse(RagServiceAddress.Substring(separator + 1));
+            if (!client.ConnectAsync(host, port).Wait(RagServiceConnectTimeoutMs))
+                throw new TimeoutException($"No answer within {RagServiceConnectTimeoutMs} ms.");
+        }
+
+
+        /// <summary>
+        /// True if the host-wide RAG service answers with its 'ready' message. Queries then go to the service,
+        /// which keeps its own model and index warm, so no warm-up is started. Never throws.
+        /// </summary>
+        internal static bool IsRagServiceAvailable()
+        {
+            if (string.IsNullOrEmpty(RagServiceAddress)) return false;
+            try
+            {
+                using (TcpClient client = new TcpClient())
+                {
+                    ConnectToRagService(client);
+                    client.ReceiveTimeout = RagServiceConnectTimeoutMs;
+                    using (StreamReader reader = new StreamReader(client.GetStream(), new UTF8Encoding(false)))
+                    {
+                        string line = reader.ReadLine();
+                        return line != null && JObject.Parse(line)["event"]?.ToString() == "ready";
+                    }
+                }
+            }
+            catch (Exception ex)
+            {
+                System.Diagnostics.Debug.WriteLine($"DEBUG: Host-wide RAG service at {RagServiceAddress} not available ({ex.Message}).");
+                return false;
+            }
+        }
+
+
+        /// <summary>
+        /// Sends the query to the long-lived 'generate_rag_prompt.py --serve' worker (starting it if needed) and returns the prompt.
+        /// </summary>
+        private string GenerateLlmPromptViaWorker(string userQuery)
+        {
+            lock (RagWorkerLock)
+            {
+                EnsureRagWorkerStarted();
+
+                int requestId = ++_ragWorkerRequestId;
+                // Escape non-ASCII so the request survives the ANSI-encoded stdin pipe of .NET Framework processes
+                string requestLine = JsonConvert.SerializeObject(
+                    new { id = requestId, query = userQuery },
+                    new JsonSerializerSettings { StringEscapeHandling = StringEscapeHandling.EscapeNonAscii });
+                System.Diagnostics.Debug.WriteLine($"DEBUG: Sending query to Python RAG worker (Request {requestId}): [{userQuery}]");
+                _ragWorker.StandardInput.WriteLine(requestLine);
+                _ragWorker.StandardInput.Flush();
+
+                JObject response = ReadRagWorkerMessage(RagWorkerRequestTimeoutMs);
+                if (response["id"]?.ToObject<int?>() != requestId)
+                    throw new InvalidOperationException($"Python RAG worker answered out of order (expected request {requestId}): {response.ToString(Formatting.None)}");
+                if (response["ok"]?.ToObject<bool>() != true)
+                    throw new InvalidOperationException($"Python RAG worker reported an error: {response["error"]}");
+
+                System.Diagnostics.Debug.WriteLine($"DEBUG: Python RAG worker stage timings (Request {requestId}): {response["timings"]?.ToString(Formatting.None)}");
+                return response["prompt"]?.ToString()?.Trim() ?? string.Empty;
+            }
+        }
+
+
+        /// <summary>
+        /// Starts the Python RAG worker process if it is not already running and waits for its 'ready' message.
+        /// </summary>
+        private static void EnsureRagWorkerStarted()
+        {
+            if (_ragWorker != null && !_ragWorker.HasExited) return;
+            StopRagWorker();
+
+            ResolvePythonPaths(out string pythonExePath, out string pythonWorkingDir, out string scriptPath);
+            ProcessStartInfo startInfo = new ProcessStartInfo
+            {
+                FileName = pythonExePath,
+                Arguments = $"{EscapeArgument(scriptPath)} --serve",
+                UseShellExecute = false,
+                RedirectStandardInput = true,
+                RedirectStandardOutput = true,
+                RedirectStandardError = true,
+                StandardOutputEncoding = Encoding.UTF8,
+                StandardErrorEncoding = Encoding.UTF8,
+                CreateNoWindow = true,
+                WorkingDirectory = pythonWorkingDir
+            };
+
+            Process worker = new Process { StartInfo = startInfo };
+            worker.ErrorDataReceived += (sender, args) => { if (args.Data != null) System.Diagnostics.Debug.WriteLine($"PY_WORKER_STDERR: {args.Data}"); };
+            worker.Start();
+            worker.BeginErrorReadLine();
+            _ragWorker = worker;
+            System.Diagnostics.Debug.WriteLine($"DEBUG: Started Python RAG worker (ID: {worker.Id}). Waiting for ready message (Timeout: {RagWorkerStartupTimeoutMs / 1000}s)...");
+
+            JObject ready = ReadRagWorkerMessage(RagWorkerStartupTimeoutMs);
+            if (ready["event"]?.ToString() != "ready")
+                throw new InvalidOperationException($"Unexpected first message from Python RAG worker: {ready.ToString(Formatting.None)}");
+            System.Diagnostics.Debug.WriteLine($"DEBUG: Python RAG worker ready. Startup timings: {ready["timings"]?.ToString(Formatting.None)}");
+        }
+
+
+        /// <summary>
+        /// Reads the next JSON message from the worker's stdout, skipping any non-JSON noise printed by Python libraries.
+        /// </summary>
+        private static JObject ReadRagWorkerMessage(int timeoutMilliseconds)
+        {
+            while (true)
+            {
+                Task<string> readTask = _ragWorker.StandardOutput.ReadLineAsync();
+                if (!readTask.Wait(timeoutMilliseconds))
+                    throw new TimeoutException($"Python RAG worker did not answer within {timeoutMilliseconds / 1000} seconds.");
+                string line = readTask.Result;
+                if (line == null)
+                    throw new InvalidOperationException("Python RAG worker closed its output stream (process exited). Check PY_WORKER_STDERR in Debug Output.");
+                if (line.TrimStart().StartsWith("{")) return JObject.Parse(line);
+                System.Diagnostics.Debug.WriteLine($"PY_WORKER_STDOUT (ignored): {line}");
+            }
+        }
+
+
+        /// <summary>
+        /// Called by App.OnStartup. On a thread-pool thread, probes the host-wide RAG service and starts the warm-up
+        /// only if the service is not running, so neither the probe nor the process launch holds up Revit's UI thread.
+        /// </summary>
+        internal static void StartRagWarmupInBackground()
+        {
+            Task.Run(() =>
+            {
+                if (IsRagServiceAvailable())
+                    System.Diagnostics.Debug.WriteLine("DEBUG: Host-wide RAG service is running; skipping the Python RAG warm-up.");
+                else
+                    StartRagWarmup();
+            });
+        }
+
+
+        /// <summary>
+        /// Starts `generate_rag_prompt.py warmup` in the background (below-normal priority, no window) so the model weights
+        /// and ChromaDB files are in the OS page cache before the first query. Never throws: warm-up is best effort.
+        /// </summary>
+        private static void StartRagWarmup()
+        {
+            try
+            {
+                ResolvePythonPaths(out string pythonExePath, out string pythonWorkingDir, out string scriptPath);
+                ProcessStartInfo startInfo = new ProcessStartInfo
+                {
+                    FileName = pythonExePath,
+                    Arguments = $"{EscapeArgument(scriptPath)} warmup",
+                    UseShellExecute = false,
+                    RedirectStandardOutput = true,
+                    RedirectStandardError = true,
+                    StandardOutputEncoding = Encoding.UTF8,
+                    StandardErrorEncoding = Encoding.UTF8,
+                    CreateNoWindow = true,
+                    WorkingDirectory = pythonWorkingDir
+                };
+
+                Process warmup = new Process { StartInfo = startInfo, EnableRaisingEvents = true };
+                warmup.OutputDataReceived += (sender, args) => { if (args.Data != null) System.Diagnostics.Debug.WriteLine($"PY_WARMUP: {args.Data}"); };
+                warmup.ErrorDataReceived += (sender, args) => { if (args.Data != null) System.Diagnostics.Debug.WriteLine($"PY_WARMUP_STDERR: {args.Data}"); };
+                warmup.Exited += (sender, args) => { try { System.Diagnostics.Debug.WriteLine($"DEBUG: Python RAG warm-up finished (Exit code: {warmup.ExitCode})."); } catch { } }; // Process may already be disposed
+                lock (RagWarmupLock)
+                {
+                    if (_ragWarmupStopped) { warmup.Dispose(); return; } // Revit is already shutting down
+                    warmup.Start();
+                    try { warmup.PriorityClass = ProcessPriorityClass.BelowNormal; } catch { } // Don't compete with Revit's own startup
+                    warmup.BeginOutputReadLine();
+                    warmup.BeginErrorReadLine();
+                    _ragWarmup = warmup;
+                }
+                System.Diagnostics.Debug.WriteLine($"DEBUG: Started Python RAG warm-up (ID: {warmup.Id}).");
+            }
+            catch (Exception ex) { System.Diagnostics.Debug.WriteLine($"WARNING: Could not start Python RAG warm-up: {ex.Message}"); }
+        }
+
+
+        /// <summary>
+        /// Stops a still-running warm-up process, if any. Called when Revit shuts down.
+        /// </summary>
+        internal static void StopRagWarmup()
+        {
+            Process warmup;
+            lock (RagWarmupLock)
+            {
+                _ragWarmupStopped = true;
+                warmup = _ragWarmup;
+                _ragWarmup = null;
+            }
+            if (warmup == null) return;
+            try { if (!warmup.HasExited) warmup.Kill(); }
+            catch (Exception ex) { System.Diagnostics.Debug.WriteLine($"ERROR: Failed to stop Python RAG warm-up: {ex.Message}"); }
+            finally { warmup.Dispose(); }
+        }
+
+
+        /// <summary>
+        /// Stops the Python RAG worker process, if any. Called on worker failures and when Revit shuts down.
+        /// </summary>
+        internal static void StopRagWorker()
+        {
+            lock (RagWorkerLock)
+            {
+                if (_ragWorker == null) return;
+                try
+                {
+                    if (!_ragWorker.HasExited)
+                    {
+                        try { _ragWorker.StandardInput.Close(); } catch { } // EOF asks the worker to exit cleanly
+                        if (!_ragWorker.WaitForExit(2000)) _ragWorker.Kill();
+                    }
+                }
+                catch (Exception ex) { System.Diagnostics.Debug.WriteLine($"ERROR: Failed to stop Python RAG worker: {ex.Message}"); }
+                finally
+                {
+                    _ragWorker.Dispose();
+                    _ragWorker = null;
+                }
+            }
+        }
+
+
+        /// <summary>
+        /// Executes an external Python script to generate the initial prompt for the LLM.
+        /// </summary>
+        private string GenerateLlmPromptViaPython(string userQuery)
+        {
+            ResolvePythonPaths(out string pythonExePath, out string pythonWorkingDir, out string scriptPath);
 
             System.Diagnostics.Debug.WriteLine($"DEBUG: Using Python executable: [{pythonExePath}]");
             System.Diagnostics.Debug.WriteLine($"DEBUG: Running Python script: [{scriptPath}]");
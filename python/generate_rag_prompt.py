@@ -1,21 +1,43 @@
-import chromadb
-from chromadb.utils import embedding_functions # <-- Keep this import
-from sentence_transformers import SentenceTransformer # Keep for EF definition, not explicit embedding
+import time # For stage timings (imported first so the startup report covers every later import)
+_SCRIPT_START = time.perf_counter()
 import os
 import sys
 import argparse
 import traceback
 import logging
-import torch
-import json # For parsing LLM output
+import json # For parsing LLM output (and serve-mode requests)
 import pprint # For nicer printing
-import google.generativeai as genai # <-- Import Google Generative AI
+import re
+import ast
+import importlib
+import threading
+import shutil
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from rag_cache import SqliteCache, EmbeddingCache, normalize_query_text, text_hash # Local module (stdlib only, cheap to import)
+from rag_embeddings import (EmbeddingCoalescer, OnnxEmbeddingFunction, TruncatedEmbeddingFunction, ONNX_BACKENDS, # Local module (stdlib only)
+                            LengthBucketedEmbeddingFunction, ProjectedQueryEmbeddingFunction, PurposeIndex, QueryProjection,
+                            SentenceTransformerFunction,
+                            export_onnx_model, length_buckets, onnx_export_directory, padded_token_count,
+                            share_torch_weights, shared_weights_file, truncate_embeddings)
+from rag_benchmark import process_memory, latency_summary, top_k_overlap # Local module (stdlib only)
+from rag_index import (FLAT_BACKENDS, SNAPSHOT_SUFFIX, BinaryQuantizedIndex, FlatIndex, # Local module (stdlib only)
+                       verify_index_snapshot, write_flat_index, write_index_snapshot)
+# Heavy dependencies (torch, chromadb, sentence_transformers, google.generativeai) are NOT imported here.
+# They are loaded via timed_import() by the stage that needs them, so argument errors and empty
+# queries exit immediately and the Gemini refinement can overlap with the retrieval imports.
+# The ONNX backends (see embedding_backend) need neither torch nor sentence_transformers,
+# and the flat retrieval backends (see retrieval_backend) do not need chromadb.
+RETRIEVAL_MODULES = {'torch': ('torch', 'sentence_transformers', 'chromadb', 'chromadb.utils.embedding_functions'),
+                     'onnx': ('onnxruntime', 'tokenizers', 'numpy', 'chromadb')}
 
 # --- Configuration ---
 # <<< --- CONFIGURATION POINTING TO REFINED CHUNKS DB --- >>>
 persist_directory = r"C:\Users\isele\Documents\RevitAPI_2025\revit_db_arctic" # Path to DB folder
 collection_name = "revit_api_2025_arctic_l_refined_v3" # <-- Use collection with v3 refined chunks
 model_name = 'Snowflake/snowflake-arctic-embed-l-v2.0'      # <-- Model used for indexing v3 chunks
+active_pair_collection = "rag_active_pair" # Metadata-only pointer to the model/collection pair in use; written by migrate-model / switch-model and overrides the two values above
+generated_code_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "GeneratedSuccessfulCode") # Scripts with '# Purpose:' lines
 # <<< --- END CONFIGURATION --- >>>
 
 # <<< --- GEMINI CONFIGURATION --- >>>
@@ -24,8 +46,61 @@ GEMINI_MODEL_NAME = 'gemini-2.0-flash-001' # Use the latest flash model
 
 num_results_per_query = 7 # How many results to fetch for EACH refined query
 final_num_results = 15   # How many top results to include in the final prompt after combining
-
-transformer_device = 'cuda' if torch.cuda.is_available() else 'cpu'
+lazy_document_fetch = True # Query ids and distances only; text and metadata of the final results come from one get() call
+api_prefilter = True # Revit API identifiers in the queries (e.g. FilteredElementCollector, BuiltInParameter.ROOM_NAME) add a search restricted to those api_element_name values
+api_prefilter_element_types = None # e.g. ('Class', 'Enumeration'): also restrict that search to these element_type values (None = any)
+api_prefilter_reserved_results = 3 # Final results kept for the best prefiltered chunks even when unfiltered chunks are closer
+refinement_budget_seconds = 8.0 # Latency budget for Gemini refinement; results for the original query are used if it is late
+batch_size = 64 # --batch: requests embedded and queried together per collection.query call
+batch_refine_concurrency = 8 # --batch: Gemini refinement calls in flight at once
+service_address = '127.0.0.1:47615' # --listen default: host-wide service ('host:port' or 'unix:/path/to/socket')
+embedding_batch_window_ms = 5.0 # --listen: how long concurrent clients' query embeddings are gathered into one batch
+embedding_max_batch_size = 64 # --listen: texts per coalesced model call
+
+# <<< --- CACHE CONFIGURATION --- >>>
+cache_enabled = True # --no-cache disables all on-disk caches for a run
+cache_directory = os.path.join(os.path.expanduser("~"), "Documents", "RevitGeminiRAG_Cache")
+cache_db_path = os.path.join(cache_directory, "rag_cache.sqlite3") # Shared by all RAG processes
+refinement_cache_ttl_seconds = 30 * 24 * 3600 # Ask Gemini again after 30 days
+refinement_cache_max_entries = 5000 # Least recently used refinements are evicted beyond this
+embedding_cache_path = os.path.join(cache_directory, "query_embeddings.f16") # float16 matrix; model tag is appended to the name
+embedding_cache_capacity = 20000 # Rows in the matrix (~40 MB at 1024 dims); least recently used rows are reused
+prompt_cache_ttl_seconds = 7 * 24 * 3600 # Final-prompt context is rebuilt at least weekly
+prompt_cache_max_entries = 2000
+purpose_index_path = os.path.join(cache_directory, "past_requests.npz") # Embedded '# Purpose:' lines; model tag is appended to the name
+warmup_purpose_limit = 32 # Most new '# Purpose:' lines one warm-up embeds (it runs at Revit start-up); index-purposes embeds any backlog
+active_pair_mirror_path = os.path.join(cache_directory, "active_pair.json") # Copy of the pointer collection, so the pair is known without opening Chroma
+# <<< --- END CACHE CONFIGURATION --- >>>
+
+# <<< --- EMBEDDING BACKEND CONFIGURATION --- >>>
+embedding_backend = 'torch' # 'torch' (SentenceTransformer), 'onnx' (ONNX Runtime fp32) or 'onnx-int8' (dynamic int8); see export-onnx
+onnx_model_directory = os.path.join(cache_directory, "onnx") # export-onnx writes <this>/<model name with '--'>/
+embedding_dimensions = None # Matryoshka mode (e.g. 256 or 384): queries go to "<collection_name>_d<dims>" built by build-truncated; None = full width
+embedding_max_tokens = 128 # Query texts are truncated to this many tokens (the model itself accepts up to 8192)
+embedding_length_buckets = (16, 32, 64) # Token-length bucket bounds: each bucket of a multi-query call is its own padded batch
+shared_model_weights = False # Map model weights from one file shared by all RAG processes on the host (--shared-weights; see README)
+shared_weights_directory = os.path.join(cache_directory, "shared_weights") # torch backend: memory-mappable state-dict copies
+query_encoder = 'full' # 'full' (model_name embeds queries) or 'projected' (small encoder + learned projection; see train-projection)
+query_encoder_model = 'sentence-transformers/all-MiniLM-L6-v2' # Small query-side encoder used by train-projection
+query_projection_path = os.path.join(cache_directory, "query_projection.npz")
+query_projection_min_confidence = None # None = threshold calibrated by train-projection; below it the full model embeds the query
+# <<< --- END EMBEDDING BACKEND CONFIGURATION --- >>>
+
+# <<< --- RETRIEVAL BACKEND CONFIGURATION --- >>>
+retrieval_backend = 'chroma' # 'chroma' (persistent ChromaDB), 'flat' (exact search over the export-flat-index files; no chromadb import) or 'binary' (sign-bit shortlist of those files, rescored exactly)
+binary_candidates_per_result = 10 # 'binary': rows shortlisted by Hamming distance per requested result (at least 100); see benchmark-binary
+flat_index_directory = os.path.join(cache_directory, "flat_index") # export-flat-index writes <this>/<collection>/ (import-snapshot: <collection>.ragidx) and the pair to active_pair.json
+# <<< --- END RETRIEVAL BACKEND CONFIGURATION --- >>>
+
+# <<< --- CPU CONFIGURATION --- >>>
+# The embedding model shares the workstation with Revit; library defaults use every core and can stall both
+intra_op_threads = None # Threads per embedding op (torch.set_num_threads / ONNX Runtime intra-op); None = tuned value, else library default
+inter_op_threads = None # Threads running independent ops concurrently; None = tuned value, else library default
+cpu_affinity = None # e.g. [4, 5, 6, 7]: pin the RAG process to these logical cores and leave the rest to Revit; None = no pinning
+cpu_tuning_path = os.path.join(cache_directory, "cpu_tuning.json") # Written by tune-threads; explicit values above take precedence
+# <<< --- END CPU CONFIGURATION --- >>>
+
+transformer_device = None # Resolved by resolve_transformer_device() once torch is imported ('cuda' if available, else 'cpu')
 
 # --- File Logging Setup ---
 try:
@@ -50,22 +125,218 @@ def log_debug(message):
     print(f"PYTHON_DEBUG: {message}", file=sys.stderr)
     if logging: logging.debug(message)
 
-# --- Gemini Query Refinement Function ---
-def refine_query_with_gemini(original_query, api_key):
+# --- Stage Timing Helper ---
+class StageTimer:
     """
-    Uses Gemini to refine the user query for better RAG retrieval.
+    Collects wall-clock durations (in seconds) for named pipeline stages.
+    Each span also keeps its start offset and thread so overlapping stages can be reported.
     """
-    log_debug(f"Refining query with Gemini ({GEMINI_MODEL_NAME}): '{original_query}'")
-    if not api_key:
-        log_error("GOOGLE_API_KEY is not set. Cannot use Gemini for refinement.")
-        return [original_query] # Fallback to original query
+    def __init__(self, origin=None):
+        self.origin = origin if origin is not None else time.perf_counter()
+        self.timings = {}
+        self.spans = [] # (name, start offset, duration, thread name)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.timings[name] = round(duration, 4)
+            self.spans.append((name, start - self.origin, duration, threading.current_thread().name))
+
+# Process-wide timer for imports, model load and collection open (see --startup-report)
+startup_timer = StageTimer(origin=_SCRIPT_START)
+
+# --- Lazy Imports and Background Work ---
+def timed_import(module_name):
+    """
+    Imports a heavy dependency on first use and records its wall-clock cost in the startup report.
+    Safe to call from several threads: import_module waits for a module another thread is still initializing.
+    """
+    if module_name in sys.modules:
+        return importlib.import_module(module_name)
+    with startup_timer.stage(f"import {module_name}"):
+        return importlib.import_module(module_name)
 
+def preload_retrieval_modules():
+    """
+    Imports everything the retrieval stage needs for the configured backend (see RETRIEVAL_MODULES)
+    and, for the torch backend, resolves the device. CPU settings are applied first.
+    """
+    apply_cpu_settings()
+    for module_name in RETRIEVAL_MODULES['onnx' if embedding_backend in ONNX_BACKENDS else 'torch']:
+        if retrieval_backend in FLAT_BACKENDS and module_name.startswith('chromadb'):
+            continue
+        timed_import(module_name)
+    if embedding_backend not in ONNX_BACKENDS:
+        resolve_transformer_device()
+
+def resolve_transformer_device():
+    global transformer_device
+    if transformer_device is None:
+        torch = timed_import('torch')
+        transformer_device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return transformer_device
+
+# --- CPU Threads and Core Affinity ---
+_cpu_settings = None
+_cpu_settings_lock = threading.Lock()
+
+def load_cpu_tuning():
+    """
+    Settings tune-threads recorded for the configured backend ({} if none).
+    """
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
-
-        # Construct the prompt for Gemini
-        gemini_prompt = f"""
+        with open(cpu_tuning_path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('backends', {}).get(embedding_backend, {})
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, AttributeError) as e:
+        log_error(f"Ignoring unreadable CPU tuning file {cpu_tuning_path}: {e}")
+        return {}
+
+def set_process_affinity(cores):
+    """
+    Pins this process (and the threads it starts later) to the given logical cores.
+    """
+    cores = sorted(set(int(core) for core in cores))
+    if hasattr(os, 'sched_setaffinity'): # Linux
+        os.sched_setaffinity(0, cores)
+        return
+    try:
+        import psutil # Optional dependency
+        psutil.Process().cpu_affinity(cores)
+        return
+    except ImportError:
+        pass
+    if sys.platform == 'win32':
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        if not kernel32.SetProcessAffinityMask(kernel32.GetCurrentProcess(), ctypes.c_size_t(sum(1 << core for core in cores))):
+            raise ctypes.WinError()
+        return
+    raise OSError(f"Core pinning is not supported on {sys.platform}.")
+
+def apply_cpu_settings():
+    """
+    Once per process, before torch / onnxruntime run anything: pins the process to `cpu_affinity` and fixes
+    the intra-/inter-op thread counts (configured, else tuned). OpenMP and MKL read their thread variables at
+    import, and torch's inter-op pool can only be sized before its first use. Returns the settings applied.
+    """
+    global _cpu_settings
+    with _cpu_settings_lock:
+        if _cpu_settings is not None:
+            return _cpu_settings
+        tuned = load_cpu_tuning()
+        intra = intra_op_threads or tuned.get('intra_op_threads')
+        inter = inter_op_threads or tuned.get('inter_op_threads')
+        if cpu_affinity:
+            try:
+                set_process_affinity(cpu_affinity)
+                intra = intra or len(cpu_affinity) # More threads than pinned cores only adds contention
+            except Exception as e:
+                log_error(f"Could not pin the process to cores {cpu_affinity}: {e}")
+        if intra:
+            for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+                os.environ[variable] = str(intra)
+        if embedding_backend not in ONNX_BACKENDS and (intra or inter):
+            torch = timed_import('torch')
+            if intra:
+                torch.set_num_threads(intra)
+            if inter:
+                try:
+                    torch.set_num_interop_threads(inter)
+                except RuntimeError as e: # Inter-op pool already started
+                    log_debug(f"Could not set torch inter-op threads to {inter}: {e}")
+        _cpu_settings = {'intra_op_threads': intra, 'inter_op_threads': inter, 'cpu_affinity': cpu_affinity,
+                         'source': 'config' if intra_op_threads or inter_op_threads else 'tuned' if tuned else 'default'}
+        log_debug(f"CPU settings: {_cpu_settings}")
+        return _cpu_settings
+
+def lower_process_priority():
+    """
+    Lets long background jobs (migrate-model) yield the CPU to Revit and the query workers.
+    """
+    if hasattr(os, 'nice'):
+        os.nice(10)
+    elif sys.platform == 'win32':
+        import ctypes
+        BELOW_NORMAL_PRIORITY_CLASS = 0x4000
+        kernel32 = ctypes.windll.kernel32
+        if not kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), BELOW_NORMAL_PRIORITY_CLASS):
+            raise ctypes.WinError()
+
+def run_in_background(name, fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) on a daemon thread and returns a Future for its result.
+    Daemon threads (unlike ThreadPoolExecutor workers) never hold the process open at exit.
+    """
+    future = Future()
+    def runner():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+    threading.Thread(target=runner, name=name, daemon=True).start()
+    return future
+
+# --- Startup Report ---
+def interpreter_startup_seconds():
+    """
+    Best-effort time from process creation until the first line of this script ran (None if unavailable).
+    Uses psutil when installed, otherwise GetProcessTimes on Windows.
+    """
+    created = None
+    try:
+        import psutil # Optional dependency
+        created = psutil.Process().create_time()
+    except Exception:
+        if sys.platform == 'win32':
+            try:
+                import ctypes
+                from ctypes import wintypes
+                creation, exited, kernel, user = (wintypes.FILETIME() for _ in range(4))
+                kernel32 = ctypes.windll.kernel32
+                if kernel32.GetProcessTimes(kernel32.GetCurrentProcess(), ctypes.byref(creation), ctypes.byref(exited),
+                                            ctypes.byref(kernel), ctypes.byref(user)):
+                    ticks = (creation.dwHighDateTime << 32) | creation.dwLowDateTime
+                    created = ticks / 1e7 - 11644473600 # FILETIME (100 ns since 1601) -> Unix epoch seconds
+            except Exception:
+                created = None
+    if created is None:
+        return None
+    script_start_wall = time.time() - (time.perf_counter() - _SCRIPT_START)
+    return max(0.0, script_start_wall - created)
+
+def format_startup_report(timer):
+    """
+    Formats the startup spans as a table: stage, start offset from script start, duration, thread.
+    """
+    lines = ["--- Startup Report (wall-clock seconds; stages on different threads overlap) ---",
+             f"  {'stage':<46} {'start':>9} {'duration':>9}  thread"]
+    interpreter = interpreter_startup_seconds()
+    interpreter_text = f"{interpreter:>9.3f}" if interpreter is not None else f"{'n/a':>9}"
+    lines.append(f"  {'interpreter startup':<46} {'':>9} {interpreter_text}  (before script body)")
+    for name, start, duration, thread_name in sorted(timer.spans, key=lambda span: span[1]):
+        lines.append(f"  {name:<46} {start:>+9.3f} {duration:>9.3f}  {thread_name}")
+    lines.append(f"  {'total since script start':<46} {'':>9} {time.perf_counter() - timer.origin:>9.3f}")
+    return "\n".join(lines)
+
+def print_startup_report(timer):
+    report = format_startup_report(timer)
+    print(report, file=sys.stderr) # stderr: stdout is reserved for the prompt / serve responses
+    if logging: logging.info("\n" + report)
+
+# --- Gemini Refinement Prompt ---
+def build_gemini_refinement_prompt(original_query):
+    """
+    Returns the Gemini prompt that asks for a JSON list of refined search queries.
+    """
+    return f"""
         You are an expert in the Autodesk Revit API. Your task is to refine a user's query to make it more effective for searching technical Revit API documentation using vector similarity (RAG).
 
         Rephrase the following user query into one or more specific, technical search terms. Focus on using precise Revit API class names (e.g., FilteredElementCollector, Wall, Floor, Parameter, OverrideGraphicSettings), method names (e.g., Create.NewFloor, SetElementOverrides), properties (e.g., HOST_AREA_COMPUTED, BuiltInParameter.WALL_USER_HEIGHT_PARAM), and common concepts used in the Revit API.
@@ -111,9 +382,75 @@ def refine_query_with_gemini(original_query, api_key):
 
         Refined JSON List:
         """
+
+# Hash of the refinement prompt template; part of the refinement cache key so editing the prompt invalidates old entries
+GEMINI_REFINEMENT_TEMPLATE_HASH = text_hash(build_gemini_refinement_prompt("{original_query}"))
+
+# --- Refinement Cache ---
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(table, ttl_seconds=None, max_entries=None):
+    """
+    Returns the shared SqliteCache for `table`, or None if caching is disabled or the cache file cannot be opened.
+    """
+    if not cache_enabled:
+        return None
+    with _caches_lock:
+        if table not in _caches:
+            try:
+                _caches[table] = SqliteCache(cache_db_path, table, ttl_seconds=ttl_seconds, max_entries=max_entries)
+            except Exception as e:
+                log_error(f"Could not open cache table '{table}' in {cache_db_path}: {e}. Continuing without it.")
+                _caches[table] = None
+        return _caches[table]
+
+def get_refinement_cache():
+    return get_cache('refinements', ttl_seconds=refinement_cache_ttl_seconds, max_entries=refinement_cache_max_entries)
+
+def refinement_cache_key(original_query):
+    # Normalized query + Gemini model + prompt template: any change to the latter two misses the old entries
+    return text_hash(GEMINI_MODEL_NAME, GEMINI_REFINEMENT_TEMPLATE_HASH, normalize_query_text(original_query))
+
+def log_cache_lookup(label, cache, hit):
+    lifetime_hits, lifetime_misses = cache.lifetime_counters()
+    log_debug(f"{label} cache {'HIT' if hit else 'MISS'} (this process: {cache.hits} hits / {cache.misses} misses; "
+              f"lifetime: {lifetime_hits} hits / {lifetime_misses} misses)")
+
+# --- Gemini Query Refinement Function ---
+def refine_query_with_gemini(original_query, api_key, timeout=None):
+    """
+    Uses Gemini to refine the user query for better RAG retrieval.
+    `timeout` (seconds) bounds the Gemini request itself; None uses the client default.
+    """
+    log_debug(f"Refining query with Gemini ({GEMINI_MODEL_NAME}): '{original_query}'")
+    cache = get_refinement_cache()
+    cache_key = refinement_cache_key(original_query)
+    if cache is not None:
+        try:
+            cached_queries = cache.get(cache_key)
+            log_cache_lookup("Refinement", cache, hit=cached_queries is not None)
+            if cached_queries:
+                log_debug(f"Using cached refined queries: {cached_queries}")
+                return cached_queries
+        except Exception as e:
+            log_error(f"Refinement cache lookup failed: {e}")
+
+    if not api_key:
+        log_error("GOOGLE_API_KEY is not set. Cannot use Gemini for refinement.")
+        return [original_query] # Fallback to original query
+
+    try:
+        genai = timed_import('google.generativeai')
+        genai.configure(api_key=api_key)
+        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+
+        # Construct the prompt for Gemini
+        gemini_prompt = build_gemini_refinement_prompt(original_query)
         # log_debug(f"Gemini Prompt:\n{gemini_prompt}") # Uncomment for debugging the prompt
 
-        response = model.generate_content(gemini_prompt)
+        request_options = {'timeout': timeout} if timeout else None
+        response = model.generate_content(gemini_prompt, request_options=request_options)
         # log_debug(f"Raw Gemini Response Text:\n{response.text}") # Uncomment for debugging
 
         # Clean potential markdown fences if Gemini adds them
@@ -123,6 +460,9 @@ def refine_query_with_gemini(original_query, api_key):
 
         if isinstance(refined_queries, list) and all(isinstance(q, str) for q in refined_queries) and refined_queries:
             log_debug(f"Gemini returned refined queries: {refined_queries}")
+            if cache is not None:
+                try: cache.put(cache_key, refined_queries) # Only successful refinements are cached, never fallbacks
+                except Exception as cache_ex: log_error(f"Could not store refinement in cache: {cache_ex}")
             return refined_queries
         else:
             log_error(f"Gemini response was not a valid JSON list of non-empty strings: {cleaned_response_text}")
@@ -136,146 +476,839 @@ def refine_query_with_gemini(original_query, api_key):
         log_error(f"Error during Gemini query refinement: {e}")
         return [original_query] # Fallback
 
-# --- Main Script Logic ---
-if __name__ == "__main__":
-    # --- 0. Argument Parsing ---
-    parser = argparse.ArgumentParser(description='Generate an LLM prompt for a Revit API query using Gemini refinement and RAG.')
-    parser.add_argument('query', type=str, help='The user query/question for the Revit API.')
+# --- Query Embeddings ---
+def active_collection_name():
+    """
+    The collection queries go to: `collection_name`, or its Matryoshka-truncated copy when embedding_dimensions is set.
+    """
+    return f"{collection_name}_d{embedding_dimensions}" if embedding_dimensions else collection_name
 
-    original_query_text = None
-    client = None
-    collection = None
-    google_api_key = None
+def create_embedding_function(standalone=False):
+    """
+    Query embedding function for the active collection: the model (or the projected small encoder),
+    truncated to embedding_dimensions if set. `standalone` embedders never import chromadb (see load_embedding_model).
+    """
+    resolve_active_pair()
+    embedding_function = load_projected_query_encoder(standalone) if query_encoder == 'projected' else None
+    if embedding_function is None:
+        embedding_function = load_embedding_model(standalone=standalone)
+    if embedding_dimensions:
+        log_debug(f"Matryoshka mode: query embeddings truncated to {embedding_dimensions} dims and re-normalized.")
+        embedding_function = TruncatedEmbeddingFunction(embedding_function, embedding_dimensions)
+    return embedding_function
+
+def load_embedding_model(name=None, stage='load embedding model', documents=False, standalone=False):
+    """
+    Loads the embedding function for `name` (default: model_name) with the configured `embedding_backend`
+    (the multi-second step), truncating and length-bucketing its input. The ONNX backends expect the model
+    exported by export-onnx. For `documents` (migrate-model), texts keep the model's own length limit.
+    The torch backend uses Chroma's SentenceTransformer wrapper unless `standalone` or a flat retrieval_backend
+    (same vectors, no chromadb import).
+    """
+    name = name or model_name
+    if embedding_backend in ONNX_BACKENDS:
+        model_directory = onnx_export_directory(onnx_model_directory, name)
+        log_debug(f"Configuring ONNX Runtime embedding function ('{name}', {embedding_backend}) from {model_directory}...")
+        timed_import('onnxruntime'); timed_import('tokenizers')
+        cpu_settings = apply_cpu_settings()
+        with startup_timer.stage(stage):
+            embedding_function = OnnxEmbeddingFunction(model_directory, quantized=embedding_backend == 'onnx-int8',
+                                                       threads=cpu_settings['intra_op_threads'],
+                                                       inter_op_threads=cpu_settings['inter_op_threads'],
+                                                       shared_weights=shared_model_weights)
+    else:
+        device = resolve_transformer_device()
+        log_debug(f"Configuring embedding function ('{name}') on '{device}'...")
+        if standalone or retrieval_backend in FLAT_BACKENDS:
+            timed_import('sentence_transformers')
+            with startup_timer.stage(stage):
+                embedding_function = SentenceTransformerFunction(name, device=device, trust_remote_code=True)
+        else:
+            embedding_functions = timed_import('chromadb.utils.embedding_functions')
+            with startup_timer.stage(stage):
+                embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
+                    model_name=name, device=device, trust_remote_code=True) # trust_remote_code needed for some SentenceTransformer models
+        if shared_model_weights and device == 'cpu':
+            weights_path = shared_weights_file(shared_weights_directory, name)
+            with startup_timer.stage('map shared weights'):
+                if share_torch_weights(embedding_function._model, weights_path):
+                    log_debug(f"Wrote shared weights for '{name}' to {weights_path}.")
+    if documents:
+        return LengthBucketedEmbeddingFunction(embedding_function, DOCUMENT_LENGTH_BUCKETS)
+    return LengthBucketedEmbeddingFunction(embedding_function, embedding_length_buckets, max_tokens=embedding_max_tokens)
+
+def load_projected_query_encoder(standalone=False):
+    """
+    Small query encoder + the projection trained by train-projection, falling back to the full model for
+    low-confidence queries. Returns None (full model only) if the projection is missing or was trained for other vectors.
+    """
+    try:
+        with startup_timer.stage('load query projection'):
+            projection = QueryProjection.load(query_projection_path)
+    except Exception as e:
+        log_error(f"Could not load the query projection from {query_projection_path} ({e}); run train-projection. Using the full model.")
+        return None
+    if projection.teacher_model != teacher_model_tag():
+        log_error(f"Query projection was trained for '{projection.teacher_model}', not '{teacher_model_tag()}'. Using the full model.")
+        return None
+    student = load_embedding_model(projection.student_model, stage='load query encoder', standalone=standalone)
+    threshold = projection.min_confidence if query_projection_min_confidence is None else query_projection_min_confidence
+    log_debug(f"Projected query encoder: '{projection.student_model}' -> '{projection.teacher_model}', "
+              f"full-model fallback below confidence {threshold:.3f}. Training stats: {projection.stats}")
+
+    def report_fallback(texts, confidence):
+        log_debug(f"Query projection confidence too low for {len(texts)} quer{'y' if len(texts) == 1 else 'ies'} "
+                  f"({', '.join(f'{c:.3f}' for c in confidence)}); embedding with the full model.")
+    return ProjectedQueryEmbeddingFunction(student, projection, load_fallback=lambda: load_embedding_model(standalone=standalone),
+                                           min_confidence=query_projection_min_confidence, on_fallback=report_fallback)
+
+def teacher_model_tag():
+    # Identifies the full model's vectors: int8 quantization changes them, fp32 ONNX does not
+    return f"{model_name}#int8" if embedding_backend == 'onnx-int8' else model_name
+
+def embedding_model_tag():
+    """
+    Identifies the query vectors in use: the full model's (see teacher_model_tag), token truncation,
+    the projected encoder's (per projection file and threshold) and Matryoshka truncation.
+    """
+    tag = teacher_model_tag()
+    if embedding_max_tokens:
+        tag += f"#t{embedding_max_tokens}"
+    if query_encoder == 'projected':
+        try:
+            stat = os.stat(query_projection_path)
+            tag += f"#proj{text_hash(str(stat.st_size), str(stat.st_mtime_ns), str(query_projection_min_confidence))[:12]}"
+        except OSError:
+            pass # No projection: the full model is used
+    return f"{tag}#d{embedding_dimensions}" if embedding_dimensions else tag
+
+def get_embedding_cache():
+    """
+    Returns the process-wide on-disk query-embedding cache for embedding_model_tag() (None if caching is disabled or unavailable).
+    """
+    if not cache_enabled:
+        return None
+    with _caches_lock:
+        if 'embeddings' not in _caches:
+            try:
+                _caches['embeddings'] = EmbeddingCache(cache_db_path, embedding_cache_path, embedding_model_tag(), embedding_cache_capacity)
+            except Exception as e:
+                log_error(f"Could not open the query-embedding cache at {embedding_cache_path}: {e}. Continuing without it.")
+                _caches['embeddings'] = None
+        return _caches['embeddings']
 
+class QueryEmbedder:
+    """
+    Embeds query strings, serving repeated strings from the on-disk embedding cache and
+    running the model only for the misses.
+    """
+    def __init__(self, embedding_function, cache=None):
+        self.embedding_function = embedding_function
+        self.cache = cache
+
+    def __call__(self, texts):
+        texts = list(texts)
+        cached = {}
+        if self.cache is not None:
+            try:
+                cached = self.cache.get_many(texts)
+            except Exception as e:
+                log_error(f"Query-embedding cache lookup failed: {e}")
+        missing = list(dict.fromkeys(t for t in texts if t not in cached)) # Unique, order kept
+        if missing:
+            computed = [list(map(float, vector)) for vector in self.embedding_function(missing)]
+            if self.cache is not None:
+                try: self.cache.put_many(missing, computed)
+                except Exception as e: log_error(f"Could not store query embeddings in cache: {e}")
+            cached.update(zip(missing, computed))
+        if self.cache is not None:
+            log_debug(f"Query embeddings: {len(texts) - len(missing)} cached, {len(missing)} computed "
+                      f"(cache size {self.cache.size()}, this process: {self.cache.hits} hits / {self.cache.misses} misses)")
+        return [list(map(float, cached[t])) for t in texts]
+
+# --- Embedding Cache Warm-Up ---
+# Log lines (see log_debug calls) that carry queries from past runs
+_HISTORICAL_QUERY_LIST_PATTERN = re.compile(
+    r" - DEBUG - (?:Gemini returned refined queries|Using cached refined queries|Using refined queries for retrieval|"
+    r"Using queries for retrieval): (\[.*\])\s*$")
+_HISTORICAL_QUERY_PATTERN = re.compile(r" - DEBUG - (?:Received original query|\[serve\] Request [^:]*): (.+?)\s*$")
+
+def collect_historical_queries():
+    """
+    Gathers original and refined queries from past runs: the refinement cache plus the RAG log file.
+    """
+    queries = []
+    refinement_cache = get_refinement_cache()
+    if refinement_cache is not None:
+        for refined in refinement_cache.values():
+            queries.extend(q for q in refined if isinstance(q, str))
+    if os.path.isfile(log_file_path):
+        with open(log_file_path, 'r', encoding='utf-8', errors='replace') as log_file:
+            for line in log_file:
+                list_match = _HISTORICAL_QUERY_LIST_PATTERN.search(line)
+                if list_match:
+                    try:
+                        queries.extend(q for q in ast.literal_eval(list_match.group(1)) if isinstance(q, str))
+                    except (ValueError, SyntaxError):
+                        pass
+                    continue
+                query_match = _HISTORICAL_QUERY_PATTERN.search(line)
+                if query_match:
+                    queries.append(query_match.group(1))
+    return list(dict.fromkeys(q for q in queries if q.strip())) # Unique, order kept
+
+_PURPOSE_PATTERN = re.compile(r"^#\s*Purpose:\s*(.+?)\s*$", re.MULTILINE)
+
+def generated_code_scripts():
+    return sorted(name for name in os.listdir(generated_code_directory) if name.endswith('.py')) \
+        if os.path.isdir(generated_code_directory) else []
+
+def read_script_purpose(file_name):
+    # The script's '# Purpose:' line, or None
+    with open(os.path.join(generated_code_directory, file_name), 'r', encoding='utf-8-sig', errors='replace') as f:
+        match = _PURPOSE_PATTERN.search(f.read())
+    return match.group(1) if match else None
+
+def generated_code_purposes():
+    """
+    The '# Purpose:' lines of the scripts in GeneratedSuccessfulCode (one task description per script).
+    """
+    purposes = (read_script_purpose(file_name) for file_name in generated_code_scripts())
+    return list(dict.fromkeys(purpose for purpose in purposes if purpose))
+
+# --- Past Request Index (GeneratedSuccessfulCode purposes) ---
+_purpose_index = None # (file stat, PurposeIndex)
+
+def purpose_index_file():
+    base, extension = os.path.splitext(purpose_index_path)
+    return f"{base}_{text_hash(embedding_model_tag())[:16]}{extension}" # Vectors must come from the query embedding path
+
+def update_purpose_index(embedding_function, batch_size=64, limit=None):
+    """
+    Brings the index up to date with GeneratedSuccessfulCode: embeds the purpose lines of scripts saved since the
+    last update (new file names, in filename-timestamp order) and drops deleted ones. Returns (index, added, removed).
+    With `limit`, at most that many new scripts are embedded; the rest stay new for the next update.
+    """
+    index_file = purpose_index_file()
     try:
-        args = parser.parse_args()
-        original_query_text = args.query
-        log_debug(f"Received original query: {original_query_text}")
-        if not original_query_text or not original_query_text.strip():
-             log_error("Original query text cannot be empty."); sys.exit(1)
+        index = PurposeIndex.load(index_file)
+    except FileNotFoundError:
+        index = PurposeIndex.empty(embedding_model_tag())
+    new_files, removed = index.changes(generated_code_scripts())
+    files, purposes = [], []
+    for file_name in new_files:
+        purpose = read_script_purpose(file_name)
+        if purpose:
+            files.append(file_name)
+            purposes.append(purpose)
+            if len(files) == limit:
+                break
+    if not files and not removed:
+        return index, 0, 0
+    vectors = [vector for chunk in batched(purposes, batch_size) for vector in embedding_function(chunk)]
+    index = index.updated(files, purposes, vectors, removed)
+    index.save(index_file)
+    return index, len(files), len(removed)
+
+def load_purpose_index():
+    """
+    The saved index for the current embedding model (reloaded when the file changes), or None if not built yet.
+    """
+    global _purpose_index
+    try:
+        stat = os.stat(purpose_index_file())
+    except OSError:
+        return None
+    signature = (stat.st_size, stat.st_mtime_ns)
+    if _purpose_index is None or _purpose_index[0] != signature:
+        _purpose_index = (signature, PurposeIndex.load(purpose_index_file()))
+    return _purpose_index[1]
+
+def similar_past_requests(query_vector, k=5):
+    """
+    The `k` saved scripts whose purpose is closest to the query embedding ([] if the index is not built).
+    """
+    index = load_purpose_index()
+    return index.nearest(query_vector, k) if index is not None else []
 
-        # --- Check for Google API Key ---
-        google_api_key = os.environ.get("GOOGLE_API_KEY")
-        if not google_api_key:
-            # Log as warning, not error, as script can fallback
-            log_debug("Warning: GOOGLE_API_KEY environment variable not set. Will fallback to using original query for retrieval.")
-        else:
-            log_debug("GOOGLE_API_KEY found. Gemini refinement will be attempted.")
+def warm_embedding_cache(batch_size=64):
+    """
+    Pre-computes embeddings for every historical query so later runs find them in the cache.
+    """
+    resolve_active_pair() # The cache is keyed by the active pair's model
+    cache = get_embedding_cache()
+    if cache is None:
+        log_error("Embedding cache is disabled or unavailable; nothing to warm.")
+        return 0
+    queries = collect_historical_queries()
+    cached = cache.get_many(queries)
+    pending = [q for q in queries if q not in cached]
+    log_debug(f"Embedding-cache warm-up: {len(queries)} historical queries, {len(cached)} already cached, {len(pending)} to embed.")
+    if pending:
+        embedder = QueryEmbedder(create_embedding_function(), cache)
+        for start in range(0, len(pending), batch_size):
+            embedder(pending[start:start + batch_size])
+    log_debug(f"Embedding-cache warm-up finished. Cache now holds {cache.size()} vectors.")
+    return len(pending)
+
+# --- ChromaDB Connection ---
+class CollectionRetriever:
+    """
+    Pairs the Chroma collection with the query embedder so queries are embedded (and cached)
+    by us and passed to collection.query as query_embeddings.
+    """
+    def __init__(self, collection, embedder):
+        self.collection = collection
+        self.embedder = embedder
 
-        log_debug(f"Using ChromaDB path: {os.path.abspath(persist_directory)}")
-        log_debug(f"Using collection: {collection_name}")
-        log_debug(f"Using embedding model for queries: {model_name} via Chroma EF")
-        log_debug(f"Retrieving {num_results_per_query} results per refined query, aiming for {final_num_results} final results.")
+    def count(self):
+        return self.collection.count()
 
-    except Exception as e: log_error(f"Error during initial setup or argument parsing: {e}"); sys.exit(1)
+    def query(self, query_texts, n_results, include, where=None, query_embeddings=None):
+        # `query_embeddings` (of query_texts) lets several searches share one embedding call
+        if query_embeddings is None:
+            query_embeddings = self.embedder(query_texts)
+        return self.collection.query(query_embeddings=query_embeddings, n_results=n_results, include=include, where=where)
 
-    # --- 1. Refine Query with Gemini ---
-    # This function now handles the Gemini call and fallbacks
-    refined_queries = refine_query_with_gemini(original_query_text, google_api_key)
-    if not refined_queries: # Should theoretically always contain at least the original query
-         log_error("Query refinement failed unexpectedly and returned empty list."); sys.exit(1)
-    log_debug(f"Using queries for retrieval: {refined_queries}") # Log the queries actually used
+    def get(self, ids, include):
+        return self.collection.get(ids=ids, include=include)
 
-    # --- 2. Connect to ChromaDB ---
+def open_chroma_client():
+    """
+    Opens the persistent ChromaDB client at persist_directory (raises if the directory is missing).
+    """
     if not os.path.isdir(persist_directory):
-        log_error(f"ChromaDB directory not found at: {os.path.abspath(persist_directory)}"); sys.exit(1)
-    try:
-        log_debug(f"Connecting to ChromaDB at: {persist_directory}")
-        client = chromadb.PersistentClient(path=persist_directory)
-        log_debug(f"Configuring embedding function for Chroma collection ('{model_name}')...")
+        raise FileNotFoundError(f"ChromaDB directory not found at: {os.path.abspath(persist_directory)}")
+    chromadb = timed_import('chromadb')
+    log_debug(f"Connecting to ChromaDB at: {persist_directory}")
+    with startup_timer.stage('open chroma client'):
+        return chromadb.PersistentClient(path=persist_directory)
+
+def open_collection(coalesce=False, embedding_function=None):
+    """
+    Connects to the persistent ChromaDB (or, with a flat retrieval_backend, opens the exported flat index)
+    and returns a CollectionRetriever for the configured collection.
+    The embedding function is created with create_embedding_function() unless one is given.
+    With `coalesce`, model calls from concurrent requests are micro-batched (see EmbeddingCoalescer).
+    Raises on any failure so the caller can decide whether to exit or report the error.
+    """
+    if retrieval_backend in FLAT_BACKENDS:
+        resolve_active_pair()
+        if embedding_function is None:
+            embedding_function = create_embedding_function()
+        collection = open_flat_index()
+    else:
+        client = open_chroma_client()
+        resolve_active_pair(client)
         # Configure EF using the correct model name
-        embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name=model_name, device=transformer_device, trust_remote_code=True) # trust_remote_code needed for some SentenceTransformer models
-        log_debug(f"Getting collection: {collection_name}")
+        if embedding_function is None:
+            embedding_function = create_embedding_function()
+        log_debug(f"Getting collection: {active_collection_name()}")
         # Get collection associated with the EF
-        collection = client.get_collection(name=collection_name, embedding_function=embedding_function)
-        log_debug(f"Successfully connected to collection '{collection_name}'. Count: {collection.count()}")
-    except Exception as e: log_error(f"Error accessing ChromaDB collection '{collection_name}': {e}"); sys.exit(1)
-
-    # --- 3. Query ChromaDB with Refined Queries ---
-    all_results_dict = {} # Use dict to store best result per ID {id: {'doc':..., 'meta':..., 'dist':...}}
-    context_documents = [] # Initialize in case of errors
-    try:
-        log_debug(f"Querying ChromaDB with {len(refined_queries)} refined queries...")
-        # Let Chroma handle embedding the query texts using the collection's EF
-        results = collection.query(
-            query_texts=refined_queries, # Pass the list of refined query strings
-            n_results=num_results_per_query,
-            include=['metadatas', 'documents', 'distances']
-        )
-
-        # --- 4. Combine, De-duplicate, and Rank Results ---
-        log_debug("Combining and de-duplicating results...")
-        if results and results.get('ids'):
-            # Iterate through results for each refined query
-            # Note: results['ids'] is a list of lists, one inner list per query_text
-            for i in range(len(results['ids'])): # Index corresponds to refined_queries[i]
-                 # Check if the current query actually returned results and ids are not None
-                if results['ids'][i] is None or not results['ids'][i]:
-                    log_debug(f"No results found for refined query {i+1}: '{refined_queries[i]}'")
-                    continue
-
-                query_ids = results['ids'][i]
-                query_docs = results['documents'][i]
-                query_metas = results['metadatas'][i]
-                query_dists = results['distances'][i]
+        with startup_timer.stage('open collection'):
+            collection = client.get_collection(name=active_collection_name(), embedding_function=embedding_function)
+    verify_collection_model(collection)
+    log_debug(f"Successfully connected to collection '{active_collection_name()}'. Count: {collection.count()}")
+    if coalesce:
+        log_debug(f"Coalescing concurrent query embeddings: {embedding_batch_window_ms:g} ms window, "
+                  f"up to {embedding_max_batch_size} texts per batch.")
+        embedding_function = EmbeddingCoalescer(embedding_function, window_seconds=embedding_batch_window_ms / 1000.0,
+                                                max_batch_size=embedding_max_batch_size)
+    return CollectionRetriever(collection, QueryEmbedder(embedding_function, get_embedding_cache()))
+
+def embedding_batch_stats(retriever):
+    """
+    Batch-size and queue-wait histograms of the retriever's embedding coalescer (None if it has none).
+    """
+    embedding_function = retriever.embedder.embedding_function
+    return embedding_function.histograms() if isinstance(embedding_function, EmbeddingCoalescer) else None
 
-                # Ensure all lists have the same length for this query's results
-                if not (len(query_ids) == len(query_docs) == len(query_metas) == len(query_dists)):
-                    log_error(f"Inconsistent result lengths for query {i+1}. Skipping.")
-                    continue
+# --- Flat Index Backend (No chromadb) ---
+# export-flat-index dumps a collection to flat files (see rag_index.FlatIndex); with retrieval_backend = 'flat'
+# queries are answered from them by one matrix product, with 'binary' by a sign-bit Hamming shortlist rescored
+# exactly (rag_index.BinaryQuantizedIndex). Either way chromadb is never imported.
+FLAT_ACTIVE_PAIR_FILE = "active_pair.json"
 
-                for j in range(len(query_ids)):
-                    doc_id = query_ids[j]
-                    distance = query_dists[j]
-                    document = query_docs[j]
-                    metadata = query_metas[j]
-
-                    # Basic check for valid data before processing
-                    if not doc_id or document is None or metadata is None or distance is None:
-                         log_debug(f"Skipping invalid result entry (ID: {doc_id}) for query {i+1}.")
-                         continue
-
-                    # If ID is new OR this result is better (lower distance) than existing, store it
-                    if doc_id not in all_results_dict or distance < all_results_dict[doc_id]['distance']:
-                        all_results_dict[doc_id] = {
-                            'document': document,
-                            'metadata': metadata,
-                            'distance': distance,
-                            'id': doc_id # Store id for debugging if needed
-                        }
-
-            log_debug(f"Found {len(all_results_dict)} unique results from refined queries.")
-
-            # Sort unique results by distance (ascending)
-            sorted_results = sorted(all_results_dict.values(), key=lambda item: item['distance'])
-
-            # Get the top N final results
-            top_results = sorted_results[:final_num_results]
-            log_debug(f"Selected top {len(top_results)} results after ranking.")
-
-            context_documents = [res['document'] for res in top_results]
-            # Log retrieved results details
-            for i, res in enumerate(top_results):
-                 snippet = repr(res['document'][:100]) if res.get('document') else "N/A"
-                 meta = res.get('metadata', {})
-                 dist = res.get('distance', float('inf'))
-                 log_debug(f"  Final Result {i+1}: ID={res.get('id','N/A')} | Distance={dist:.4f} | API={meta.get('api_element_name', 'N/A')} | Type={meta.get('element_type','N/A')} | Snippet={snippet}...")
+def flat_index_path(name=None):
+    """
+    Exported index of collection `name` (default: the active one): its export-flat-index directory,
+    or else the snapshot file installed by import-snapshot.
+    """
+    directory = os.path.join(flat_index_directory, name or active_collection_name())
+    snapshot = directory + SNAPSHOT_SUFFIX
+    return snapshot if os.path.isfile(snapshot) and not os.path.isdir(directory) else directory
 
+def read_flat_active_pair():
+    """
+    The pair export-flat-index last exported ({'collection', 'embedding_model'}), or None if nothing was exported.
+    """
+    try:
+        with open(os.path.join(flat_index_directory, FLAT_ACTIVE_PAIR_FILE), 'r', encoding='utf-8') as f:
+            pair = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return pair if pair.get('collection') and pair.get('embedding_model') else None
+
+def write_flat_active_pair(pair):
+    write_json_file(os.path.join(flat_index_directory, FLAT_ACTIVE_PAIR_FILE), pair)
+
+def write_json_file(path, data):
+    # Readers see the old or the new file, never a partial one
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    os.replace(temporary, path)
+
+def open_flat_index():
+    """
+    Opens the flat index of the active collection (two-stage for retrieval_backend = 'binary').
+    Warns (without failing) when the Chroma files changed since the export.
+    """
+    path = flat_index_path()
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Flat index not found at: {path} (run the 'export-flat-index' or 'import-snapshot' subcommand first)")
+    log_debug(f"Opening flat index: {path} ({retrieval_backend})")
+    with startup_timer.stage('open flat index'):
+        if retrieval_backend == 'binary':
+            index = BinaryQuantizedIndex(path, candidates_per_result=binary_candidates_per_result)
         else:
-            log_debug("Warning: No relevant documents found in ChromaDB for any refined query.")
-            context_documents = [] # Ensure empty if no results
+            index = FlatIndex(path)
+    fingerprint = index.header.get('source_fingerprint') # Only in local exports; snapshots come from another machine
+    if fingerprint and os.path.isdir(persist_directory) and fingerprint != collection_fingerprint(persist_directory, name=index.name):
+        log_debug(f"Warning: the ChromaDB files changed since '{index.name}' was exported on {index.header.get('exported_at')}; "
+                  f"rerun export-flat-index to pick up the changes.")
+    return index
+
+def collection_space(collection):
+    """
+    The collection's distance space ('cosine', 'l2' or 'ip'): hnsw:space metadata (or the copy kept by
+    update_collection_metadata), else the collection configuration (newer Chroma versions), else Chroma's default 'l2'.
+    """
+    metadata = collection.metadata or {}
+    space = metadata.get('hnsw:space') or metadata.get('distance_space')
+    if space is None:
+        try:
+            space = (collection.configuration or {}).get('hnsw', {}).get('space')
+        except Exception:
+            pass
+    return space or 'l2'
+
+# --- Embedding Model Pinning ---
+# Every collection built by this script records the model that embedded it; the pointer collection
+# (active_pair_collection) records which pair is live, so switching models is one metadata write.
+DOCUMENT_LENGTH_BUCKETS = (64, 128, 256, 512, 1024) # migrate-model: documents are far longer than queries
+_active_pair = None
+_mirrored_pair = None # (pair,) while the pair read from active_pair_mirror_path has not been checked against Chroma
+_active_pair_lock = threading.Lock()
+
+def read_active_pair(client):
+    """
+    The pointer's metadata ({'collection', 'embedding_model', ...}), or None if no pair was ever switched to.
+    """
+    try:
+        pointer = client.get_collection(name=active_pair_collection, embedding_function=None)
+    except Exception: # ValueError or NotFoundError depending on the Chroma version
+        return None
+    metadata = pointer.metadata or {}
+    return metadata if metadata.get('collection') and metadata.get('embedding_model') else None
+
+def read_active_pair_mirror():
+    """
+    Returns (True, pair or None) from the copy of the pointer collection for this persist_directory,
+    or (False, None) if there is no usable copy (Chroma has to be read).
+    """
+    try:
+        with open(active_pair_mirror_path, 'r', encoding='utf-8') as f:
+            mirror = json.load(f)
+    except (OSError, ValueError):
+        return False, None
+    if mirror.get('persist_directory') != os.path.abspath(persist_directory):
+        return False, None
+    return True, mirror.get('pair')
+
+def write_active_pair_mirror(pair):
+    try:
+        write_json_file(active_pair_mirror_path, {'persist_directory': os.path.abspath(persist_directory), 'pair': pair})
+    except OSError as e:
+        log_debug(f"Could not write the active-pair copy {active_pair_mirror_path}: {e}")
 
+def resolve_active_pair(client=None, mirror_only=False):
+    """
+    Once per process: replaces `collection_name` / `model_name` with the pair recorded in the pointer collection
+    (for the flat backend: the pair last exported), if there is one (the configured pair otherwise).
+    Without a `client`, the pointer is taken from its copy at active_pair_mirror_path when there is one, so
+    entry points that may never query (cache lookups, similar-requests) do not import chromadb; with a `client`
+    the pointer itself is read and the copy refreshed. With `mirror_only`, ChromaDB is never opened: without a
+    copy, None is returned and the pair stays unresolved until a later call (open_collection resolves it).
+    Call this before anything keyed by embedding_model_tag() or active_collection_name(). Returns (collection_name, model_name).
+    """
+    global _active_pair, _mirrored_pair, collection_name, model_name
+    pair_key = lambda pair: (pair['collection'], pair['embedding_model']) if pair else None
+    with _active_pair_lock:
+        if _active_pair is not None and client is not None and _mirrored_pair is not None:
+            pair, (mirrored,) = read_active_pair(client), _mirrored_pair
+            _mirrored_pair = None
+            if pair_key(pair) != pair_key(mirrored):
+                write_active_pair_mirror(pair)
+                log_error(f"The pointer collection '{active_pair_collection}' changed without switch-model (now {pair_key(pair)}); "
+                          f"this process keeps '{_active_pair[0]}' with '{_active_pair[1]}' until restarted.")
+        if _active_pair is None:
+            if retrieval_backend in FLAT_BACKENDS:
+                pair, source = read_flat_active_pair(), os.path.join(flat_index_directory, FLAT_ACTIVE_PAIR_FILE)
+            else:
+                mirrored, pair = (False, None) if client is not None else read_active_pair_mirror()
+                source = active_pair_mirror_path
+                if mirrored:
+                    _mirrored_pair = (pair,)
+                elif mirror_only:
+                    return None
+                else:
+                    pair, source = read_active_pair(client or open_chroma_client()), active_pair_collection
+                    write_active_pair_mirror(pair)
+            if pair and (pair['collection'], pair['embedding_model']) != (collection_name, model_name):
+                log_debug(f"Active pair from '{source}': collection '{pair['collection']}' with "
+                          f"'{pair['embedding_model']}' (configured: '{collection_name}' with '{model_name}').")
+                collection_name, model_name = pair['collection'], pair['embedding_model']
+            _active_pair = (collection_name, model_name)
+        return _active_pair
+
+def active_pair_resolved():
+    return _active_pair is not None
+
+def verify_collection_model(collection):
+    """
+    Refuses to query a collection embedded by a different model than the one embedding the queries (the distances
+    would be meaningless) or one that migrate-model has not finished. Collections without a recorded model pass.
+    """
+    metadata = collection.metadata or {}
+    recorded = metadata.get('embedding_model')
+    if recorded is None:
+        log_debug(f"Collection '{collection.name}' does not record its embedding model; cannot verify it matches '{model_name}'.")
+    elif recorded != model_name:
+        raise RuntimeError(f"Collection '{collection.name}' was embedded with '{recorded}' but queries would be embedded "
+                           f"with '{model_name}'. Set model_name to match, or run switch-model.")
+    if metadata.get('migration_state', 'complete') != 'complete':
+        raise RuntimeError(f"Collection '{collection.name}' is still being built by migrate-model ({metadata['migration_state']}).")
+
+def update_collection_metadata(chroma_collection, **values):
+    """
+    Merges `values` into the collection's metadata. Chroma replaces metadata wholesale on modify(), and newer
+    versions reject hnsw:* keys there (they live in the collection configuration), so those are retried without,
+    keeping the distance space as 'distance_space' so collection_space() still finds it.
+    """
+    metadata = dict(chroma_collection.metadata or {}, **values)
+    try:
+        chroma_collection.modify(metadata=metadata)
+    except ValueError:
+        retry = {key: value for key, value in metadata.items() if not key.startswith('hnsw:')}
+        if 'hnsw:space' in metadata:
+            retry['distance_space'] = metadata['hnsw:space']
+        chroma_collection.modify(metadata=retry)
+
+def switch_active_pair(client, target_collection, target_model):
+    """
+    Points every process started from now on at `target_collection` / `target_model` (one metadata write).
+    Running workers keep the pair they loaded until restarted.
+    """
+    current = read_active_pair(client) or {'collection': collection_name, 'embedding_model': model_name}
+    pointer = client.get_or_create_collection(name=active_pair_collection, embedding_function=None)
+    update_collection_metadata(pointer, collection=target_collection, embedding_model=target_model,
+                               previous_collection=current['collection'], previous_embedding_model=current['embedding_model'],
+                               switched_at=time.strftime('%Y-%m-%d %H:%M:%S'))
+    write_active_pair_mirror(read_active_pair(client))
+
+def load_retrieval_branch():
+    """
+    Retrieval branch of a single-query run: retrieval imports, embedding model load and collection open.
+    Runs on the main thread while the Gemini refinement runs on its own, so the critical path is
+    max(refine, load), not their sum; a prompt-cache hit skips it entirely.
+    """
+    with startup_timer.stage('branch: retrieval init'):
+        preload_retrieval_modules()
+        retriever = open_collection()
+    log_debug(f"[retrieval-init] Collection ready after {startup_timer.timings['branch: retrieval init']:.3f}s.")
+    return retriever
+
+# --- Warm-Up (Cold-Start Mitigation) ---
+def model_weight_files():
+    """
+    Files of the locally cached `model_name` snapshot: Hugging Face hub cache (HF_HUB_CACHE / HF_HOME)
+    and the legacy sentence-transformers cache. Symlinked snapshot files are resolved to their blobs once.
+    The ONNX backends only read their export directory.
+    """
+    if embedding_backend in ONNX_BACKENDS:
+        return unique_files([onnx_export_directory(onnx_model_directory, model_name)])
+    hub_cache = os.environ.get('HF_HUB_CACHE') or os.path.join(
+        os.environ.get('HF_HOME') or os.path.join(os.path.expanduser("~"), ".cache", "huggingface"), "hub")
+    st_cache = os.environ.get('SENTENCE_TRANSFORMERS_HOME') or os.path.join(os.path.expanduser("~"), ".cache", "torch", "sentence_transformers")
+    model_directories = [os.path.join(hub_cache, "models--" + model_name.replace('/', '--')),
+                         os.path.join(st_cache, model_name.replace('/', '_'))]
+    return unique_files(model_directories)
+
+def unique_files(directories):
+    paths = {}
+    for directory in directories:
+        if os.path.isfile(directory): # A single-file index snapshot
+            paths[os.path.realpath(directory)] = None
+        for root, _, files in os.walk(directory):
+            for file_name in files:
+                real_path = os.path.realpath(os.path.join(root, file_name))
+                if os.path.isfile(real_path):
+                    paths[real_path] = None
+    return list(paths)
+
+def read_into_page_cache(paths, chunk_bytes=8 * 1024 * 1024):
+    """
+    Reads each file sequentially so the OS keeps it in the page cache. Returns (files read, bytes read).
+    """
+    buffer = bytearray(chunk_bytes)
+    files_read = bytes_read = 0
+    for path in paths:
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                while True:
+                    n = f.readinto(buffer)
+                    if not n:
+                        break
+                    bytes_read += n
+            files_read += 1
+        except OSError as e:
+            log_debug(f"[warmup] Could not read {path}: {e}")
+    return files_read, bytes_read
+
+def run_warmup():
+    """
+    Brings a cold machine to warm-query speed: reads the model weights and the Chroma files into the
+    page cache, opens the collection (imports + model load) and runs one dummy embedding and query so
+    the HNSW index is loaded, then embeds up to warmup_purpose_limit new past-request purposes.
+    Each step is recorded in startup_timer; returns {step: detail} notes.
+    """
+    notes = {}
+    resolve_active_pair() # Warm the model that will actually be loaded
+    with startup_timer.stage('read model weights'):
+        files_read, bytes_read = read_into_page_cache(model_weight_files())
+    notes['read model weights'] = f"{files_read} files, {bytes_read / 2**20:.1f} MB"
+    if not files_read:
+        notes['read model weights'] += " (model not found in the local Hugging Face caches; it will be downloaded on load)"
+    with startup_timer.stage('read collection files'):
+        files_read, bytes_read = read_into_page_cache(unique_files([retrieval_data_directory()]))
+    notes['read collection files'] = f"{files_read} files, {bytes_read / 2**20:.1f} MB"
+
+    preload_retrieval_modules()
+    retriever = open_collection()
+    notes['open collection'] = f"{retriever.count()} chunks"
+    with startup_timer.stage('dummy embedding'):
+        # Straight to the model: the query-embedding cache would otherwise answer after the first warm-up
+        embedding = retriever.embedder.embedding_function(["Revit API warm-up query"])
+    with startup_timer.stage('dummy query (loads index)'):
+        retriever.collection.query(query_embeddings=[list(map(float, embedding[0]))], n_results=1, include=['distances'])
+    with startup_timer.stage('update past-request index'):
+        index, added, removed = update_purpose_index(retriever.embedder.embedding_function, limit=warmup_purpose_limit)
+    notes['update past-request index'] = f"{len(index.files)} scripts ({added} added, {removed} removed, at most {warmup_purpose_limit} added per warm-up)"
+    return notes
+
+def run_warmup_command(argv):
+    """
+    `generate_rag_prompt.py warmup`: runs run_warmup() and prints a timing report to stdout.
+    Meant to run in the background when Revit starts, so the first real query does not pay the cold-start cost.
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py warmup',
+                                     description='Read the model weights and ChromaDB files into the OS page cache, open the '
+                                                 'collection and run a dummy embedding and query, reporting how long each step took.')
+    parser.parse_args(argv)
+    log_debug("[warmup] Warming model weights, ChromaDB files and the embedding model...")
+    try:
+        notes = run_warmup()
     except Exception as e:
-        log_error(f"Error querying ChromaDB or processing results: {e}")
-        context_documents = [] # Ensure context_documents is empty on error
+        log_error(f"[warmup] Warm-up failed: {e}")
+        return 1
+    emit_report([format_startup_report(startup_timer)] + [f"  {step}: {detail}" for step, detail in notes.items()])
+    return 0
 
-    # --- 5. Construct the Final Prompt ---
-    log_debug("Constructing final prompt for code generation LLM...")
-    context_string = "\n\n---\n\n".join(context_documents)
+# --- Retrieval: Query, Combine, De-duplicate and Rank ---
+def query_collection(retriever, query_texts, lazy=None, where=None, query_embeddings=None):
+    """
+    Runs one batched query for the given query strings (raises on Chroma errors).
+    With `lazy` (default: lazy_document_fetch) only ids and distances are returned; see fetch_documents.
+    `where` is a Chroma metadata filter applied to every query of the batch. Pass `query_embeddings`
+    (retriever.embedder(query_texts)) when the same texts are searched more than once.
+    """
+    lazy = lazy_document_fetch if lazy is None else lazy
+    log_debug(f"Querying ChromaDB with {len(query_texts)} queries{f' (where {where})' if where else ''}...")
+    return retriever.query(
+        query_texts, # Embedded by the retriever's QueryEmbedder (cache first, then the model)
+        n_results=num_results_per_query,
+        include=['distances'] if lazy else ['metadatas', 'documents', 'distances'],
+        where=where,
+        query_embeddings=query_embeddings
+    )
+
+# --- Query Planner: Metadata-Prefiltered Search for Revit API Identifiers ---
+# Tokens of identifier characters and dots: CamelCase names with two or more humps (FilteredElementCollector,
+# ElementId) and dotted member references whose first part is a type (BuiltInParameter.ROOM_NAME, Wall.Flip)
+# count as API identifiers. Single-word types only count in dotted references; alone they are ordinary words.
+API_IDENTIFIER_PATTERN = re.compile(r'\b[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)+\b|\b[A-Z][a-z0-9]+(?:[A-Z][A-Za-z0-9]*)+\b')
+API_CAMEL_CASE_PATTERN = re.compile(r'^[A-Z][a-z0-9]+[A-Z]')
+API_NAMESPACE_PARTS = {'Autodesk', 'Revit', 'DB', 'UI', 'ApplicationServices', 'Creation', 'System', 'Collections', 'Generic',
+                       'Architecture', 'Structure', 'Mechanical', 'Electrical', 'Plumbing', 'Analysis', 'Events', 'Selection'}
+API_SINGLE_WORD_TYPES = {'Application', 'Arc', 'Area', 'Category', 'Ceiling', 'Curve', 'Dimension', 'Document', 'Duct',
+                         'Element', 'Ellipse', 'Face', 'Family', 'Floor', 'Grid', 'Group', 'Level', 'Line', 'Material',
+                         'Options', 'Outline', 'Parameter', 'Phase', 'Pipe', 'Railing', 'Reference', 'Room', 'Solid',
+                         'Space', 'Stairs', 'Transaction', 'Transform', 'UV', 'View', 'Viewport', 'Wall', 'Wire',
+                         'Workset', 'XYZ', 'Zone'}
+API_PREFILTER_MAX_NAMES = 12 # Chroma $in lists stay short; further identifiers only take part in the unfiltered search
+
+def api_identifiers(query_texts):
+    """
+    Returns the api_element_name values the queries refer to, in order of first mention: each identifier as
+    written without its namespace (Document.Create.NewFloor), its type (Document) and its member (NewFloor).
+    Dotted words whose first part is not a type (file names such as Main.py, variables such as doc.GetElement) are skipped.
+    """
+    names = []
+    for text in query_texts:
+        for token in API_IDENTIFIER_PATTERN.findall(text or ''):
+            parts = [part for part in token.split('.') if part not in API_NAMESPACE_PARTS]
+            if not parts or not (API_CAMEL_CASE_PATTERN.match(parts[0]) or parts[0] in API_SINGLE_WORD_TYPES):
+                continue
+            names.extend(['.'.join(parts)] + ([parts[0], parts[-1]] if len(parts) > 1 else []))
+    return list(dict.fromkeys(names))[:API_PREFILTER_MAX_NAMES]
+
+def api_prefilter_where(names):
+    """
+    Chroma `where` filter for the chunks of the named API elements (optionally of api_prefilter_element_types only).
+    """
+    where = {'api_element_name': {'$in': list(names)}}
+    if api_prefilter_element_types:
+        where = {'$and': [where, {'element_type': {'$in': list(api_prefilter_element_types)}}]}
+    return where
+
+def retrieve_prefiltered(retriever, all_results_dict, query_texts, names, query_embeddings=None):
+    """
+    Alongside the unfiltered search: queries only the chunks whose api_element_name is one of `names` and merges
+    the hits into all_results_dict marked as prefiltered (see rank_results). Returns the number of hits.
+    `query_embeddings` are the unfiltered search's vectors for query_texts, so nothing is embedded twice.
+    """
+    if not api_prefilter or not names:
+        return 0
+    results = query_collection(retriever, query_texts, where=api_prefilter_where(names), query_embeddings=query_embeddings)
+    merge_query_results(all_results_dict, results, query_texts, prefiltered=True)
+    hits = sum(len(ids or []) for ids in results.get('ids') or [])
+    log_debug(f"Prefiltered search for {names}: {hits} hit(s) from {len(query_texts)} queries.")
+    return hits
+
+def merge_query_results(all_results_dict, results, query_texts, prefiltered=False):
+    """
+    Folds one collection.query result into all_results_dict ({id: {'document', 'metadata', 'distance', 'id'}}),
+    keeping the best (lowest) distance per chunk ID. For a lazy (ids and distances only) result, document and
+    metadata stay None until fetch_documents. Chunks of a `prefiltered` result are flagged 'prefiltered'.
+    """
+    if not results or not results.get('ids'):
+        log_debug(f"No results returned for queries: {query_texts}")
+        return all_results_dict
+    # Note: results['ids'] is a list of lists, one inner list per query_text
+    for i in range(len(results['ids'])): # Index corresponds to query_texts[i]
+         # Check if the current query actually returned results and ids are not None
+        if results['ids'][i] is None or not results['ids'][i]:
+            log_debug(f"No results found for query {i+1}: '{query_texts[i]}'")
+            continue
+
+        query_ids = results['ids'][i]
+        lazy = results.get('documents') is None
+        query_docs = [None] * len(query_ids) if lazy else results['documents'][i]
+        query_metas = [None] * len(query_ids) if lazy else results['metadatas'][i]
+        query_dists = results['distances'][i]
+
+        # Ensure all lists have the same length for this query's results
+        if not (len(query_ids) == len(query_docs) == len(query_metas) == len(query_dists)):
+            log_error(f"Inconsistent result lengths for query {i+1}. Skipping.")
+            continue
+
+        for j in range(len(query_ids)):
+            doc_id = query_ids[j]
+            distance = query_dists[j]
+            document = query_docs[j]
+            metadata = query_metas[j]
+
+            # Basic check for valid data before processing
+            if not doc_id or distance is None or (not lazy and (document is None or metadata is None)):
+                 log_debug(f"Skipping invalid result entry (ID: {doc_id}) for query {i+1}.")
+                 continue
+
+            # If ID is new OR this result is better (lower distance) than existing, store it
+            if doc_id not in all_results_dict or distance < all_results_dict[doc_id]['distance']:
+                all_results_dict[doc_id] = {
+                    'document': document,
+                    'metadata': metadata,
+                    'distance': distance,
+                    'id': doc_id, # Store id for debugging if needed
+                    'prefiltered': prefiltered or all_results_dict.get(doc_id, {}).get('prefiltered', False)
+                }
+            elif prefiltered:
+                all_results_dict[doc_id]['prefiltered'] = True
+    return all_results_dict
+
+def rank_results(all_results_dict):
+    """
+    Ranks the merged results by distance and returns the top `final_num_results` entries. The best
+    `api_prefilter_reserved_results` prefiltered chunks are kept even if closer unfiltered chunks would push them out.
+    """
+    if not all_results_dict:
+        log_debug("Warning: No relevant documents found in ChromaDB for any query.")
+        return []
+    log_debug(f"Found {len(all_results_dict)} unique results from all queries.")
+
+    # Sort unique results by distance (ascending)
+    sorted_results = sorted(all_results_dict.values(), key=lambda item: item['distance'])
+
+    # Get the top N final results
+    top_results = sorted_results[:final_num_results]
+    reserved = [item for item in sorted_results if item.get('prefiltered')][:api_prefilter_reserved_results]
+    promoted = [item for item in reserved[:final_num_results] if item not in top_results]
+    if promoted:
+        top_results = sorted(top_results[:final_num_results - len(promoted)] + promoted, key=lambda item: item['distance'])
+        log_debug(f"Kept {len(promoted)} prefiltered API result(s) that ranked below the top {final_num_results}.")
+    log_debug(f"Selected top {len(top_results)} results after ranking.")
+    return top_results
+
+def fetch_documents(retriever, results):
+    """
+    Fills in document and metadata of the ranked entries that came from lazy queries, with ONE get() call for
+    all of them (any number of requests). Entries whose chunk has no document are dropped from each list.
+    Returns (chunks fetched, bytes of text and metadata fetched).
+    """
+    missing = list(dict.fromkeys(res['id'] for top_results in results for res in top_results if res['document'] is None))
+    if not missing:
+        return 0, 0
+    fetched = retriever.get(ids=missing, include=['documents', 'metadatas'])
+    found = {doc_id: (document, metadata) for doc_id, document, metadata
+             in zip(fetched['ids'], fetched['documents'], fetched['metadatas'])}
+    for top_results in results:
+        for res in top_results:
+            if res['document'] is None:
+                res['document'], res['metadata'] = found.get(res['id'], (None, None))
+        dropped = [res['id'] for res in top_results if res['document'] is None]
+        if dropped:
+            log_debug(f"Skipping {len(dropped)} result(s) without a document: {dropped}")
+            top_results[:] = [res for res in top_results if res['document'] is not None]
+    size = sum(len(document.encode('utf-8')) + len(json.dumps(metadata or {})) for document, metadata in found.values() if document)
+    log_debug(f"Fetched text and metadata of {len(found)} final result(s) ({size / 1024:.1f} KB) in one call.")
+    return len(found), size
+
+def final_documents(top_results):
+    """
+    Logs the final results and returns their documents.
+    """
+    for i, res in enumerate(top_results):
+         snippet = repr(res['document'][:100]) if res.get('document') else "N/A"
+         meta = res.get('metadata') or {}
+         dist = res.get('distance', float('inf'))
+         log_debug(f"  Final Result {i+1}: ID={res.get('id','N/A')} | Distance={dist:.4f} | API={meta.get('api_element_name', 'N/A')} | Type={meta.get('element_type','N/A')} | Snippet={snippet}...")
+    return [res['document'] for res in top_results]
 
-    # <<< FINAL PROMPT TEMPLATE (No changes needed here - it uses the ORIGINAL query) >>>
-    prompt_template = """ROLE: You are an expert Revit API assistant generating Python code.
+# --- Final Prompt Template ---
+# <<< FINAL PROMPT TEMPLATE (No changes needed here - it uses the ORIGINAL query) >>>
+prompt_template = """ROLE: You are an expert Revit API assistant generating Python code.
 
 TASK: Generate Python code only, suitable for direct execution in Revit Python Shell or pyRevit using IronPython. Follow the format demonstrated in the example below.
 
@@ -378,20 +1411,1781 @@ USER QUESTION:
 PYTHON SCRIPT:
 """ # End of the prompt_template definition
 
+# --- Prompt Assembly ---
+def build_final_prompt(original_query, context_documents):
+    """
+    Fills the final prompt template with the retrieved context and the ORIGINAL user query.
+    Raises ValueError if the template is missing its placeholders.
+    """
+    if '{context_placeholder}' not in prompt_template or '{query_placeholder}' not in prompt_template:
+        raise ValueError("Prompt template is missing required placeholders.")
+    context_string = "\n\n---\n\n".join(context_documents)
+    # Use the ORIGINAL user query in the final prompt for the generation LLM
+    return prompt_template.format(
+        context_placeholder=(context_string if context_string else "# No relevant documentation snippets found."),
+        query_placeholder=original_query # Use the original, unmodified query here
+    )
+
+# --- Final-Prompt Cache ---
+def retrieval_data_directory():
+    # Files queries are answered from: the ChromaDB folder, or the active collection's flat index
+    return flat_index_path() if retrieval_backend in FLAT_BACKENDS else persist_directory
+
+def collection_fingerprint(directory=None, name=None):
+    """
+    Cheap fingerprint of the collection's on-disk state, computed without importing chromadb: collection name
+    (default: active_collection_name()) plus the size and last-modified time of every file under `directory`
+    (default: retrieval_data_directory()). Any add/update/delete (and so any change in count) rewrites chroma.sqlite3 or the index segments.
+    """
+    directory = directory or retrieval_data_directory()
+    name = name or active_collection_name()
+    if os.path.isfile(directory): # A single-file index snapshot
+        stat = os.stat(directory)
+        return text_hash(name, f"{os.path.basename(directory)}:{stat.st_size}:{stat.st_mtime_ns}")
+    entries = []
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            if file_name.endswith(('-wal', '-shm', '-journal')):
+                continue # Transient SQLite files; their content is folded into the main file on checkpoint
+            path = os.path.join(root, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append(f"{os.path.relpath(path, directory)}:{stat.st_size}:{stat.st_mtime_ns}")
+    return text_hash(name, *sorted(entries))
+
+# Everything besides the query and the collection that decides the prompt's content
+PROMPT_TEMPLATE_HASH = text_hash(prompt_template, GEMINI_MODEL_NAME, GEMINI_REFINEMENT_TEMPLATE_HASH, model_name,
+                                 str(num_results_per_query), str(final_num_results),
+                                 str((api_prefilter, api_prefilter_element_types, api_prefilter_reserved_results)))
+
+def get_prompt_cache():
+    return get_cache('prompts', ttl_seconds=prompt_cache_ttl_seconds, max_entries=prompt_cache_max_entries)
+
+def prompt_cache_key(original_query, fingerprint=None, with_gemini=True):
+    # `with_gemini`: whether refinement is attempted (an API key is set); contexts built without it are kept apart
+    return text_hash(PROMPT_TEMPLATE_HASH, embedding_model_tag(), fingerprint or collection_fingerprint(),
+                     f"gemini={with_gemini}", normalize_query_text(original_query))
+
+def lookup_prompt_context(original_query, fingerprint=None, with_gemini=True):
+    """
+    Returns (cache key, cached context documents or None). The key is None if the prompt cache is unavailable.
+    """
+    prompt_cache = get_prompt_cache()
+    if prompt_cache is None:
+        return None, None
+    try:
+        prompt_key = prompt_cache_key(original_query, fingerprint, with_gemini)
+        cached_context = prompt_cache.get(prompt_key)
+    except Exception as e:
+        log_error(f"Prompt cache lookup failed: {e}. Building the prompt from scratch.")
+        return None, None
+    log_cache_lookup("Prompt", prompt_cache, hit=cached_context is not None)
+    return prompt_key, cached_context
+
+def store_prompt_context(prompt_key, context_documents, complete):
+    """
+    Memoizes complete results only: refined, or built without an API key (then the unrefined context is the result).
+    A refinement that was attempted but missed its deadline or failed would otherwise pin a degraded context.
+    """
+    if prompt_key is None or not context_documents or not complete:
+        return
+    try:
+        get_prompt_cache().put(prompt_key, context_documents)
+    except Exception as e:
+        log_error(f"Could not store the prompt context in the cache: {e}")
+
+def generate_prompt(original_query, api_key, get_retriever, timer=None, refine_budget=None):
+    """
+    Builds the final prompt with speculative retrieval:
+      - Gemini refinement starts immediately on a background thread.
+      - As soon as the collection is available, the ORIGINAL query is retrieved (speculative results).
+      - Refined queries are retrieved and merged only if refinement finishes within `refine_budget`
+        seconds of the call (default: refinement_budget_seconds); otherwise the original-query results are used.
+    `get_retriever` is called after refinement has started, so a caller can still be loading it in the background.
+    If the prompt cache holds the context for this query, collection state and template, neither refinement
+    nor `get_retriever` is touched.
+    Returns (prompt, timings) where timings maps stage name -> seconds.
+    """
+    timer = timer or StageTimer()
+    budget = refinement_budget_seconds if refine_budget is None else refine_budget
+
+    # --- 0. Prompt Cache: same query against an unchanged collection and template ---
+    # The key names the active pair's model; if it is not known yet (no copy of the pointer collection), the lookup
+    # is skipped rather than importing chromadb before refinement starts, and the key is made once get_retriever() resolved it
+    pair_resolved = active_pair_resolved()
+    with timer.stage('prompt cache lookup'):
+        prompt_key, cached_context = (lookup_prompt_context(original_query, with_gemini=bool(api_key)) if pair_resolved
+                                      else (None, None))
+    if cached_context is not None:
+        with timer.stage('assemble'):
+            # The context is cached, not the prompt, so the query is quoted exactly as typed this time
+            prompt_for_llm = build_final_prompt(original_query, cached_context)
+        log_debug(f"Stage timings (s): {timer.timings}")
+        return prompt_for_llm, timer.timings
+    deadline = time.perf_counter() + budget
+
+    # --- 1. Refine Query with Gemini (background, bounded by the budget) ---
+    def refine():
+        with timer.stage('refine'):
+            return refine_query_with_gemini(original_query, api_key, timeout=budget)
+    refine_future = run_in_background('gemini-refine', refine)
+
+    # --- 2. Speculative Retrieval on the Original Query ---
+    with timer.stage('wait for collection'):
+        retriever = get_retriever()
+    all_results_dict, retrieval_complete = {}, True # A failed search keeps the context out of the prompt cache
+    try:
+        with timer.stage('retrieve original'):
+            embeddings = retriever.embedder([original_query]) # Shared by the unfiltered and the prefiltered search
+            merge_query_results(all_results_dict, query_collection(retriever, [original_query], query_embeddings=embeddings),
+                                [original_query])
+        with timer.stage('retrieve prefiltered'):
+            retrieve_prefiltered(retriever, all_results_dict, [original_query], api_identifiers([original_query]), embeddings)
+    except Exception as e:
+        log_error(f"Error querying ChromaDB with the original query: {e}")
+        retrieval_complete = False
+
+    # --- 3. Fold in Refined-Query Results if Refinement Beat the Deadline ---
+    refined_queries, refinement_finished = None, False
+    with timer.stage('wait for refinement'):
+        try:
+            refined_queries = refine_future.result(timeout=max(0.0, deadline - time.perf_counter()))
+            refinement_finished = True
+        except FutureTimeoutError:
+            log_debug(f"Gemini refinement missed the {budget:.1f}s budget. Using original-query results only.")
+        except Exception as e:
+            log_error(f"Gemini refinement failed: {e}")
+    extra_queries = [q for q in (refined_queries or []) if q.strip() and q != original_query]
+    if extra_queries:
+        log_debug(f"Using refined queries for retrieval: {extra_queries}") # Log the queries actually used
+        try:
+            with timer.stage('retrieve refined'):
+                embeddings = retriever.embedder(extra_queries)
+                merge_query_results(all_results_dict, query_collection(retriever, extra_queries, query_embeddings=embeddings),
+                                    extra_queries)
+            with timer.stage('retrieve prefiltered refined'):
+                retrieve_prefiltered(retriever, all_results_dict, extra_queries, api_identifiers(extra_queries + [original_query]),
+                                     embeddings)
+        except Exception as e:
+            log_error(f"Error querying ChromaDB with refined queries: {e}")
+            refinement_finished = retrieval_complete = False
+
+    with timer.stage('rank'):
+        top_results = rank_results(all_results_dict)
+    try:
+        with timer.stage('fetch documents'):
+            fetch_documents(retriever, [top_results])
+    except Exception as e:
+        log_error(f"Error fetching the documents of the final results: {e}")
+        top_results = []
+    selected_documents = final_documents(top_results)
+
+    # --- 4. Construct the Final Prompt ---
+    log_debug("Constructing final prompt for code generation LLM...")
+    with timer.stage('assemble'):
+        prompt_for_llm = build_final_prompt(original_query, selected_documents)
+
+    if not pair_resolved and get_prompt_cache() is not None:
+        prompt_key = prompt_cache_key(original_query, with_gemini=bool(api_key))
+    store_prompt_context(prompt_key, selected_documents, complete=refinement_finished and retrieval_complete and (bool(extra_queries) or not api_key))
+
+    log_debug(f"Stage timings (s): {timer.timings}")
+    return prompt_for_llm, timer.timings
+
+# --- Serve Mode (Long-Lived Worker) ---
+class ClientLatencyLog:
+    """
+    Thread-safe per-client request counters and latencies (the last `window` requests per client).
+    """
+    def __init__(self, window=1000):
+        self.window = window
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def record(self, client, seconds=None):
+        # seconds=None records a failed request
+        with self._lock:
+            stats = self._clients.setdefault(client, {'requests': 0, 'errors': 0, 'latencies': []})
+            stats['requests'] += 1
+            if seconds is None:
+                stats['errors'] += 1
+            else:
+                stats['latencies'] = (stats['latencies'] + [seconds])[-self.window:]
+
+    def snapshot(self):
+        """
+        Returns {client: {'requests', 'errors', 'mean', 'p50', 'p95', 'max'}} with latencies in seconds.
+        """
+        with self._lock:
+            clients = {client: dict(stats, latencies=sorted(stats['latencies'])) for client, stats in self._clients.items()}
+        summary = {}
+        for client, stats in clients.items():
+            latencies = stats['latencies']
+            percentile = lambda q: round(latencies[int(round(q * (len(latencies) - 1)))], 4) if latencies else None
+            summary[client] = {'requests': stats['requests'], 'errors': stats['errors'],
+                               'mean': round(sum(latencies) / len(latencies), 4) if latencies else None,
+                               'p50': percentile(0.5), 'p95': percentile(0.95), 'max': latencies[-1] if latencies else None}
+        return summary
+
+def serve_requests(retriever, api_key, startup_timings=None, input_stream=None, output_stream=None, default_refine_budget=None,
+                   client='stdin', latency_log=None):
+    """
+    Answers newline-delimited JSON requests until EOF or a {"command": "shutdown"} request,
+    keeping the embedding model and collection warm between queries.
+
+    Request:  {"id": <any>, "query": "<user query>", "refine_budget": <optional seconds>, "client": <optional name>}
+    Response: {"id": <same>, "ok": true, "prompt": "...", "timings": {...}}
+              {"id": <same>, "ok": false, "error": "..."}
+    {"command": "stats"} answers {"id": <same>, "ok": true, "clients": {<client>: {latency summary}},
+                                  "embedding_batches": {histograms} or null, "memory": {process_memory()}}.
+    {"command": "similar", "query": "...", "k": 5} answers {"id": <same>, "ok": true, "matches": [{"file", "purpose",
+                                  "score"}], "seconds": ...}: the closest saved scripts (see similar_past_requests).
+    A {"event": "ready", ...} line is written once the worker can accept requests.
+    Latencies are recorded per client in `latency_log` under the request's "client" name, or `client` if absent.
+    """
+    input_stream = input_stream or sys.stdin
+    output_stream = output_stream or sys.stdout
+    latency_log = latency_log or ClientLatencyLog()
+
+    def send(payload):
+        # ensure_ascii keeps the stream safe regardless of the console/pipe encoding
+        output_stream.write(json.dumps(payload, ensure_ascii=True) + "\n")
+        output_stream.flush()
+
+    send({'event': 'ready', 'pid': os.getpid(), 'timings': startup_timings or {}, 'memory': process_memory()})
+    requests_served = 0
+    for line in input_stream:
+        line = line.strip()
+        if not line:
+            continue
+        request_id, request_client = None, client
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object.")
+            request_id = request.get('id')
+            request_client = str(request.get('client') or client)
+            if request.get('command') == 'shutdown':
+                send({'id': request_id, 'ok': True, 'event': 'shutdown'})
+                break
+            if request.get('command') == 'stats':
+                send({'id': request_id, 'ok': True, 'clients': latency_log.snapshot(),
+                      'embedding_batches': embedding_batch_stats(retriever), 'memory': process_memory()})
+                continue
+            if request.get('command') == 'similar':
+                started = time.perf_counter()
+                matches = similar_past_requests(retriever.embedder([str(request.get('query') or '')])[0], int(request.get('k') or 5))
+                send({'id': request_id, 'ok': True, 'matches': matches,
+                      'seconds': round(time.perf_counter() - started, 4)})
+                continue
+            query = request.get('query')
+            if not isinstance(query, str) or not query.strip():
+                raise ValueError("Request 'query' must be a non-empty string.")
+
+            log_debug(f"[serve] Request {request_id!r}: {query}")
+            started = time.perf_counter()
+            refine_budget = request.get('refine_budget', default_refine_budget)
+            prompt_for_llm, timings = generate_prompt(query, api_key, lambda: retriever, refine_budget=refine_budget)
+            timings['total'] = round(time.perf_counter() - started, 4)
+            requests_served += 1
+            latency_log.record(request_client, timings['total'])
+            send({'id': request_id, 'ok': True, 'prompt': prompt_for_llm, 'timings': timings})
+            log_debug(f"[serve] Request {request_id!r} from {request_client} answered in {timings['total']:.3f}s ({requests_served} served).")
+        except Exception as e:
+            log_error(f"[serve] Failed to answer request {request_id!r} from {request_client}: {e}")
+            latency_log.record(request_client)
+            send({'id': request_id, 'ok': False, 'error': str(e)})
+    log_debug(f"[serve] Input closed after {requests_served} request(s). Shutting down worker.")
+
+# --- Socket Service (Host-Wide, Many Clients) ---
+def parse_service_address(address):
+    """
+    'unix:/path' -> ('unix', '/path'); 'host:port' -> ('tcp', (host, port)); 'port' -> ('tcp', ('127.0.0.1', port)).
+    """
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or '127.0.0.1', int(port))
+
+def create_socket_service(retriever, api_key, address, startup_timings=None, default_refine_budget=None):
+    """
+    Binds the socket service (see run_socket_service) without serving yet. The returned server carries
+    `family`, `bind_address` and the shared `latency_log`; a TCP port of 0 binds a free port (see server_address).
+    """
+    import io
+    import socketserver
+    family, bind_address = parse_service_address(address)
+    latency_log = ClientLatencyLog()
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            peer = self.client_address if family == 'tcp' else None
+            client = f"{peer[0]}/{peer[1]}" if peer else f"unix/{threading.current_thread().name}"
+            log_debug(f"[service] Client {client} connected.")
+            input_stream = io.TextIOWrapper(self.rfile, encoding='utf-8', newline='\n')
+            output_stream = io.TextIOWrapper(self.wfile, encoding='utf-8', newline='\n', write_through=True)
+            try:
+                serve_requests(retriever, api_key, startup_timings, input_stream, output_stream,
+                               default_refine_budget=default_refine_budget, client=client, latency_log=latency_log)
+            except (ConnectionError, OSError) as e:
+                log_debug(f"[service] Client {client} dropped: {e}")
+            finally:
+                try: output_stream.detach(); input_stream.detach() # The handler closes the socket files itself
+                except Exception: pass
+            log_debug(f"[service] Client {client} disconnected. Latency by client (s): {latency_log.snapshot()}")
+
+    if family == 'unix':
+        if not hasattr(socketserver, 'ThreadingUnixStreamServer'):
+            raise OSError("Unix sockets are not supported by this Python build; use a host:port address.")
+        if os.path.exists(bind_address):
+            os.remove(bind_address) # Stale socket from a previous run
+        class ServiceServer(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+    else:
+        class ServiceServer(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = sys.platform != 'win32' # On Windows SO_REUSEADDR would allow port hijacking
+    server = ServiceServer(bind_address, RequestHandler)
+    server.family, server.bind_address, server.latency_log = family, bind_address, latency_log
+    return server
+
+def run_socket_service(retriever, api_key, address, startup_timings=None, default_refine_budget=None):
+    """
+    Serves the stdin worker protocol (see serve_requests) to any number of concurrent clients on a local
+    TCP or Unix socket, sharing this process's single copy of the embedding model and collection.
+    Each connection gets its own 'ready' line and may send any number of requests. Runs until interrupted.
+    """
+    with create_socket_service(retriever, api_key, address, startup_timings, default_refine_budget) as server:
+        family, bind_address = server.family, server.bind_address
+        log_debug(f"[service] Listening on {address} ({family}). Model and collection are shared by all clients.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            log_debug("[service] Interrupted. Shutting down.")
+    if family == 'unix' and os.path.exists(bind_address):
+        os.remove(bind_address)
+    log_debug(f"[service] Final latency by client (s): {server.latency_log.snapshot()}")
+    log_debug(f"[service] Embedding batches: {embedding_batch_stats(retriever)}")
+
+# --- Batch Mode (Bulk Prompt Generation) ---
+def read_batch_requests(path):
+    """
+    Streams (request id, query, error) tuples from a JSONL file ('-' reads stdin).
+    Each line is a JSON string or an object with 'query' (or 'body' / 'title'), plus an optional 'id' / 'request_id';
+    lines without a usable query yield an error message instead of a query.
+    """
+    stream = sys.stdin if path == '-' else open(path, 'r', encoding='utf-8')
     try:
-        if '{context_placeholder}' not in prompt_template or '{query_placeholder}' not in prompt_template:
-             log_error("Prompt template is missing required placeholders."); sys.exit(1)
-        # Use the ORIGINAL user query in the final prompt for the generation LLM
-        prompt_for_llm = prompt_template.format(
-            context_placeholder=(context_string if context_string else "# No relevant documentation snippets found."),
-            query_placeholder=original_query_text # Use the original, unmodified query here
-        )
-    except KeyError as key_err:
-         log_error(f"Error formatting the prompt string: Missing key {key_err}."); sys.exit(1)
-    except Exception as fmt_ex:
-        log_error(f"Error formatting the prompt string: {fmt_ex}"); sys.exit(1)
-
-    # --- 6. Output the Final Prompt ---
+        for line_number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            request_id = line_number
+            try:
+                record = json.loads(line)
+                if isinstance(record, dict):
+                    request_id = record.get('id', record.get('request_id', line_number))
+                    query = record.get('query') or record.get('body') or record.get('title')
+                else:
+                    query = record
+                if not isinstance(query, str) or not query.strip():
+                    raise ValueError("Request has no non-empty 'query', 'body' or 'title'.")
+                yield request_id, query, None
+            except Exception as e:
+                yield request_id, None, f"Line {line_number}: {e}"
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+def batched(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def split_query_results(results, index):
+    """
+    Returns the single-query slice `index` of a multi-query collection.query result, in the same shape.
+    """
+    return {key: [results[key][index]] for key in ('ids', 'documents', 'metadatas', 'distances')
+            if results.get(key) is not None}
+
+def generate_prompts_batch(requests, api_key, retriever, output_stream, size=None, refine_concurrency=None, refine_timeout=None):
+    """
+    Builds prompts for a stream of (id, query, error) requests and writes one JSON line per request, in input order:
+      {"id": <id>, "ok": true, "prompt": "...", "cached": <bool>}  or  {"id": <id>, "ok": false, "error": "..."}
+
+    Per chunk of `size` requests: prompt-cache hits are answered directly; the rest are embedded together and
+    retrieved with ONE collection.query for the original queries and ONE for all refined queries of the chunk.
+    Gemini refinements run on a pool of `refine_concurrency` threads and are submitted one chunk ahead, so the
+    next chunk is being refined while the current one is retrieved.
+    Returns a dict of counters.
+    """
+    size = size or batch_size
+    fingerprint = collection_fingerprint() # Collection is not modified during the run
+    counters = {'requests': 0, 'ok': 0, 'cached': 0, 'failed': 0}
+
+    def send(payload):
+        output_stream.write(json.dumps(payload, ensure_ascii=True) + "\n")
+        output_stream.flush()
+
+    def prepare(chunk, pool):
+        # Prompt-cache lookups, then refinement submissions for the misses
+        prepared = []
+        for request_id, query, error in chunk:
+            entry = {'id': request_id, 'query': query, 'error': error, 'key': None, 'context': None, 'refine': None}
+            if error is None:
+                entry['key'], entry['context'] = lookup_prompt_context(query, fingerprint, with_gemini=bool(api_key))
+                if entry['context'] is None:
+                    entry['refine'] = pool.submit(refine_query_with_gemini, query, api_key, timeout=refine_timeout)
+            prepared.append(entry)
+        return prepared
+
+    def process(prepared):
+        started = time.perf_counter()
+        pending = [entry for entry in prepared if entry['error'] is None and entry['context'] is None]
+        merged = {id(entry): {} for entry in pending}
+        if pending:
+            # --- Original queries: one embedding batch and one vectorized query ---
+            originals = [entry['query'] for entry in pending]
+            searched = {id(entry): ([], []) for entry in pending} # Texts and vectors, reused by the prefiltered searches
+            original_failed = False
+            try:
+                vectors = retriever.embedder(originals)
+                results = query_collection(retriever, originals, query_embeddings=vectors)
+                for i, entry in enumerate(pending):
+                    merge_query_results(merged[id(entry)], split_query_results(results, i), [entry['query']])
+                    searched[id(entry)][0].append(entry['query'])
+                    searched[id(entry)][1].append(vectors[i])
+            except Exception as e:
+                log_error(f"[batch] Error querying ChromaDB with {len(originals)} original queries: {e}")
+                original_failed = True
+            # --- Refined queries of the whole chunk: again one batch and one query ---
+            refined_texts, owners = [], []
+            for entry in pending:
+                try:
+                    refined = entry['refine'].result()
+                    finished = True
+                except Exception as e:
+                    log_error(f"[batch] Gemini refinement failed for request {entry['id']!r}: {e}")
+                    refined, finished = [], False
+                extra_queries = [q for q in refined if q.strip() and q != entry['query']]
+                entry['complete'] = finished and not original_failed and (bool(extra_queries) or not api_key) # See store_prompt_context
+                refined_texts.extend(extra_queries)
+                owners.extend([entry] * len(extra_queries))
+            if refined_texts:
+                try:
+                    vectors = retriever.embedder(refined_texts)
+                    results = query_collection(retriever, refined_texts, query_embeddings=vectors)
+                    for i, entry in enumerate(owners):
+                        merge_query_results(merged[id(entry)], split_query_results(results, i), [refined_texts[i]])
+                        searched[id(entry)][0].append(refined_texts[i])
+                        searched[id(entry)][1].append(vectors[i])
+                except Exception as e:
+                    log_error(f"[batch] Error querying ChromaDB with {len(refined_texts)} refined queries: {e}")
+                    for entry in owners: entry['complete'] = False
+            # --- Prefiltered searches: one per request that names Revit API elements (filters differ per request) ---
+            for entry in pending:
+                texts, vectors = searched[id(entry)]
+                try:
+                    if texts:
+                        retrieve_prefiltered(retriever, merged[id(entry)], texts, api_identifiers(texts), vectors)
+                except Exception as e:
+                    log_error(f"[batch] Prefiltered search failed for request {entry['id']!r}: {e}")
+                    entry['complete'] = False
+        # --- Rank, fetch the final results' text for the whole chunk in one call, then assemble in input order ---
+        for entry in pending:
+            entry['top'] = rank_results(merged[id(entry)])
+        try:
+            fetch_documents(retriever, [entry['top'] for entry in pending])
+        except Exception as e:
+            log_error(f"[batch] Error fetching the documents of the final results: {e}")
+            for entry in pending: entry['error'] = f"Could not fetch the documents of the final results: {e}"
+        for entry in prepared:
+            counters['requests'] += 1
+            try:
+                if entry['error'] is not None:
+                    raise ValueError(entry['error'])
+                cached = entry['context'] is not None
+                if cached:
+                    selected_documents = entry['context']
+                else:
+                    selected_documents = final_documents(entry['top'])
+                    store_prompt_context(entry['key'], selected_documents, complete=entry['complete'])
+                send({'id': entry['id'], 'ok': True, 'prompt': build_final_prompt(entry['query'], selected_documents), 'cached': cached})
+                counters['ok'] += 1
+                counters['cached'] += cached
+            except Exception as e:
+                log_error(f"[batch] Failed to build the prompt for request {entry['id']!r}: {e}")
+                send({'id': entry['id'], 'ok': False, 'error': str(e)})
+                counters['failed'] += 1
+        log_debug(f"[batch] Chunk of {len(prepared)} request(s) ({len(prepared) - len(pending)} cached or invalid) "
+                  f"written in {time.perf_counter() - started:.3f}s. Totals so far: {counters}")
+
+    with ThreadPoolExecutor(max_workers=refine_concurrency or batch_refine_concurrency, thread_name_prefix='gemini-refine') as pool:
+        chunks = batched(requests, size)
+        current = prepare(next(chunks, []), pool)
+        while current:
+            upcoming = prepare(next(chunks, []), pool) # Refine ahead while this chunk is retrieved
+            process(current)
+            current = upcoming
+    return counters
+
+# --- Embedding Backends: ONNX Export and Benchmark ---
+# Used when neither the refinement cache nor the log has queries yet (README example prompts)
+BENCHMARK_SAMPLE_QUERIES = (
+    "Color all walls thicker than 150mm red in the current view.",
+    "Apply the 'Architectural Plan' view template to the current view.",
+    "Export the 'Room Schedule' to an Excel file on my Desktop.",
+    "Select all doors located on 'Level 1'.",
+    "Hide all furniture elements in the active 3D view.",
+    "Create a text note saying 'Please verify dimensions' near the currently selected element.",
+)
+
+def benchmark_queries(limit):
+    return (collect_historical_queries() or list(BENCHMARK_SAMPLE_QUERIES))[:limit]
+
+# --- Benchmark Subcommands: Probe Processes and Reports ---
+@contextmanager
+def probe_input_file(data):
+    """
+    Writes `data` to a temporary JSON file for probe processes to read and yields its path (removed afterwards).
+    """
+    import tempfile
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False, encoding='utf-8') as f:
+        json.dump(data, f)
+    try:
+        yield f.name
+    finally:
+        os.remove(f.name)
+
+def run_probe(argv):
+    """
+    Runs `generate_rag_prompt.py <argv>` in a fresh process (thread pools, model memory and peak RSS are per process).
+    Returns (the last JSON line it printed, None), or (None, the last stderr line) if it failed.
+    """
+    import subprocess
+    process = subprocess.run([sys.executable, os.path.abspath(__file__)] + list(argv),
+                             capture_output=True, text=True, encoding='utf-8', errors='replace')
+    result_lines = [line for line in process.stdout.splitlines() if line.startswith('{')]
+    if process.returncode != 0 or not result_lines:
+        return None, (process.stderr.strip().splitlines() or ['no output'])[-1]
+    return json.loads(result_lines[-1]), None
+
+def emit_report(lines, data=None, output=None):
+    """
+    Prints the report lines to stdout and the log; with `output`, also writes `data` there as JSON.
+    """
+    report = "\n".join(lines)
+    print(report)
+    if logging: logging.debug(report)
+    if output:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+
+def run_export_onnx_command(argv):
+    """
+    `generate_rag_prompt.py export-onnx`: exports `model_name` for the 'onnx' / 'onnx-int8' embedding backends.
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py export-onnx',
+                                     description='Export the embedding model to ONNX (and a dynamic int8 copy) for the ONNX Runtime backends.')
+    parser.add_argument('--output-dir', default=None, help='Export directory (default: the one the onnx backends load from).')
+    parser.add_argument('--no-quantize', action='store_true', help='Skip the dynamic int8 model.')
+    parser.add_argument('--opset', type=int, default=17, help='ONNX opset version (default: 17).')
+    args = parser.parse_args(argv)
+    resolve_active_pair() # Export the model queries will actually use
+    args.output_dir = args.output_dir or onnx_export_directory(onnx_model_directory, model_name)
+    log_debug(f"[export-onnx] Exporting '{model_name}' to {args.output_dir} (int8: {not args.no_quantize})...")
+    with startup_timer.stage('export onnx'):
+        files = export_onnx_model(model_name, args.output_dir, quantize=not args.no_quantize, opset=args.opset)
+    for file_name, size in files.items():
+        print(f"  {file_name:<32} {size / 2**20:>10.1f} MB")
+    print(f"Exported to {args.output_dir} in {startup_timer.timings['export onnx']:.1f}s. "
+          f"Set embedding_backend = 'onnx' or 'onnx-int8' to use it.")
+    return 0
+
+def run_backend_probe_command(argv):
+    """
+    `benchmark-backend` (internal, run by benchmark-backends in a fresh process so RSS is per backend):
+    loads one backend, embeds each query on its own, retrieves the top k and prints one JSON result line.
+    """
+    global embedding_backend, intra_op_threads, inter_op_threads
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py benchmark-backend')
+    parser.add_argument('--backend', required=True, choices=('torch',) + ONNX_BACKENDS)
+    parser.add_argument('--queries-file', required=True)
+    parser.add_argument('--k', type=int, default=final_num_results)
+    parser.add_argument('--intra-op-threads', type=int, default=None)
+    parser.add_argument('--inter-op-threads', type=int, default=None)
+    args = parser.parse_args(argv)
+    embedding_backend = args.backend
+    intra_op_threads = args.intra_op_threads or intra_op_threads
+    inter_op_threads = args.inter_op_threads or inter_op_threads
+    with open(args.queries_file, 'r', encoding='utf-8') as f:
+        queries = json.load(f)
+    memory_before = process_memory()
+    load_started = time.perf_counter()
+    preload_retrieval_modules()
+    embedding_function = create_embedding_function()
+    load_seconds = time.perf_counter() - load_started
+    embedding_function(["Revit API warm-up query"]) # First-call allocations are not part of the per-query latency
+    latencies, vectors = [], []
+    for query in queries:
+        started = time.perf_counter()
+        vector = embedding_function([query])[0] # Directly: the query-embedding cache would hide the backend
+        latencies.append(time.perf_counter() - started)
+        vectors.append(list(map(float, vector)))
+    memory_after = process_memory()
+    retriever = open_collection(embedding_function=embedding_function)
+    results = retriever.collection.query(query_embeddings=vectors, n_results=args.k, include=['distances'])
+    print(json.dumps({'backend': args.backend, 'cpu_settings': apply_cpu_settings(),
+                      'load_seconds': round(load_seconds, 3), 'latency': latency_summary(latencies),
+                      'memory_before': memory_before, 'memory_after': memory_after, 'top_ids': results['ids']}))
+    return 0
+
+def run_backend_benchmark_command(argv):
+    """
+    `generate_rag_prompt.py benchmark-backends`: compares embedding backends on the same queries, each in its
+    own process: model load time, per-query embedding latency, RSS, and top-k overlap with the first backend.
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py benchmark-backends',
+                                     description='Compare embedding backends: latency, RSS and top-k agreement with the reference backend.')
+    parser.add_argument('--backends', default='torch,' + ','.join(ONNX_BACKENDS),
+                        help='Comma-separated backends; the first is the reference for top-k overlap (default: %(default)s).')
+    parser.add_argument('--queries', type=int, default=50, help='Number of historical queries to use (default: 50).')
+    parser.add_argument('--k', type=int, default=final_num_results, help=f'Top-k for the overlap (default: {final_num_results}).')
+    parser.add_argument('--output', default=None, help='Also write the full results as JSON to this file.')
+    args = parser.parse_args(argv)
+    backends = [backend.strip() for backend in args.backends.split(',') if backend.strip()]
+    queries = benchmark_queries(args.queries)
+    results = []
+    with probe_input_file(queries) as queries_file:
+        for backend in backends:
+            log_debug(f"[benchmark] Measuring the '{backend}' backend on {len(queries)} queries...")
+            result, error = run_probe(['benchmark-backend', '--backend', backend, '--queries-file', queries_file, '--k', str(args.k)])
+            if error:
+                log_error(f"[benchmark] Backend '{backend}' failed: {error}")
+                result = {'backend': backend, 'error': error}
+            results.append(result)
+    reference = next((result for result in results if 'error' not in result), None)
+    lines = [f"--- Embedding Backend Benchmark ({len(queries)} queries, top-{args.k}; reference: "
+             f"{reference['backend'] if reference else 'n/a'}) ---",
+             f"  {'backend':<10} {'load s':>8} {'p50 ms':>8} {'p95 ms':>8} {'RSS MB':>8} {'peak MB':>8} {'overlap':>8}"]
+    for result in results:
+        if 'error' in result:
+            lines.append(f"  {result['backend']:<10} failed: {result['error']}")
+            continue
+        result['top_k_overlap'] = top_k_overlap(reference['top_ids'], result['top_ids'])
+        memory = result['memory_after']
+        lines.append(f"  {result['backend']:<10} {result['load_seconds']:>8.2f} {result['latency']['p50_ms']:>8.1f} "
+                     f"{result['latency']['p95_ms']:>8.1f} {memory['rss_mb'] or 0:>8.0f} {memory['peak_rss_mb'] or 0:>8.0f} "
+                     f"{result['top_k_overlap']:>8.3f}")
+    emit_report(lines, {'queries': queries, 'k': args.k, 'results': results}, args.output)
+    return 0 if reference else 1
+
+# --- CPU Threads: Auto-Tuning ---
+def default_thread_candidates():
+    # Powers of two up to the cores this process may use (pinned cores if cpu_affinity is set), plus that count
+    if cpu_affinity:
+        available = len(cpu_affinity)
+    elif hasattr(os, 'sched_getaffinity'):
+        available = len(os.sched_getaffinity(0))
+    else:
+        available = os.cpu_count() or 1
+    candidates, n = [], 1
+    while n < available:
+        candidates.append(n)
+        n *= 2
+    return candidates + [available]
+
+def run_tune_threads_command(argv):
+    """
+    `generate_rag_prompt.py tune-threads`: measures single-query embedding latency for each intra-/inter-op
+    thread count (each in a fresh process, as thread pools are sized once) and records the best setting in
+    cpu_tuning_path. "Best" is the fewest threads within --tolerance of the lowest p50, leaving the rest to Revit.
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py tune-threads',
+                                     description='Sweep embedding thread counts on this machine and save the fastest setting.')
+    parser.add_argument('--threads', default=','.join(map(str, default_thread_candidates())),
+                        help='Comma-separated intra-op thread counts to try (default: %(default)s).')
+    parser.add_argument('--inter-op-threads', default='1', help='Comma-separated inter-op thread counts to try (default: %(default)s).')
+    parser.add_argument('--backend', choices=('torch',) + ONNX_BACKENDS, default=embedding_backend,
+                        help='Backend to tune (default: %(default)s).')
+    parser.add_argument('--queries', type=int, default=30, help='Number of historical queries to embed per setting (default: 30).')
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help='Prefer fewer threads if their p50 is within this fraction of the best (default: %(default)s).')
+    parser.add_argument('--output', default=cpu_tuning_path, help='Tuning file (default: %(default)s).')
+    args = parser.parse_args(argv)
+    settings = [(intra, inter) for intra in sorted({int(t) for t in args.threads.split(',') if t.strip()})
+                for inter in sorted({int(t) for t in args.inter_op_threads.split(',') if t.strip()})]
+    queries = benchmark_queries(args.queries)
+    sweep = []
+    with probe_input_file(queries) as queries_file:
+        for intra, inter in settings:
+            log_debug(f"[tune-threads] {args.backend}: {intra} intra-op / {inter} inter-op threads...")
+            result, error = run_probe(['benchmark-backend', '--backend', args.backend, '--queries-file', queries_file, '--k', '1',
+                                       '--intra-op-threads', str(intra), '--inter-op-threads', str(inter)])
+            if error:
+                log_error(f"[tune-threads] {intra}/{inter} threads failed: {error}")
+                continue
+            latency = result['latency']
+            sweep.append({'intra_op_threads': intra, 'inter_op_threads': inter,
+                          'p50_ms': latency['p50_ms'], 'p95_ms': latency['p95_ms']})
+    if not sweep:
+        log_error("[tune-threads] No setting could be measured; tuning file not written.")
+        return 1
+    fastest = min(row['p50_ms'] for row in sweep)
+    best = min((row for row in sweep if row['p50_ms'] <= fastest * (1.0 + args.tolerance)),
+               key=lambda row: (row['intra_op_threads'] + row['inter_op_threads'], row['p50_ms']))
+    try:
+        with open(args.output, 'r', encoding='utf-8') as f:
+            tuning = json.load(f)
+    except (OSError, ValueError):
+        tuning = {}
+    tuning.setdefault('backends', {})[args.backend] = dict(best, cpu_count=os.cpu_count(), cpu_affinity=cpu_affinity,
+                                                           tuned_at=time.strftime('%Y-%m-%d %H:%M:%S'), sweep=sweep)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(tuning, f, indent=2)
+    lines = [f"--- Thread Tuning ({args.backend}, {len(queries)} queries, {os.cpu_count()} logical cores"
+             f"{f', pinned to {cpu_affinity}' if cpu_affinity else ''}) ---",
+             f"  {'intra':>6} {'inter':>6} {'p50 ms':>8} {'p95 ms':>8}"]
+    for row in sweep:
+        marker = '  <- saved' if row is best else ''
+        lines.append(f"  {row['intra_op_threads']:>6} {row['inter_op_threads']:>6} {row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f}{marker}")
+    emit_report(lines)
+    print(f"Saved to {args.output}; used unless intra_op_threads / inter_op_threads are set.")
+    return 0
+
+# --- Embedding Throughput Benchmark ---
+def run_embedding_probe_command(argv):
+    """
+    `benchmark-embedding-probe` (internal, run by benchmark-embedding in a fresh process per thread count so
+    thread pools and peak RSS are per setting): embeds the texts at each batch size and prints one JSON line.
+    """
+    global intra_op_threads
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py benchmark-embedding-probe')
+    parser.add_argument('--texts-file', required=True)
+    parser.add_argument('--batch-sizes', required=True)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args(argv)
+    intra_op_threads = args.threads or intra_op_threads
+    with open(args.texts_file, 'r', encoding='utf-8') as f:
+        texts = json.load(f)
+    preload_retrieval_modules()
+    embedding_function = create_embedding_function() # Directly: the query-embedding cache would hide the model
+    embedding_function(texts[:8]) # First-call allocations are not measured
+    rows = []
+    for size in [int(b) for b in args.batch_sizes.split(',') if b.strip()]:
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(max(1, args.repeat)):
+            for chunk in batched(texts, size):
+                call_started = time.perf_counter()
+                embedding_function(chunk)
+                latencies.append(time.perf_counter() - call_started)
+        elapsed = time.perf_counter() - started
+        rows.append({'batch_size': size, 'texts_per_second': round(len(texts) * max(1, args.repeat) / elapsed, 1),
+                     'batch_latency': latency_summary(latencies)})
+    print(json.dumps({'threads': apply_cpu_settings()['intra_op_threads'], 'results': rows, 'memory': process_memory()}))
+    return 0
+
+def run_embedding_benchmark_command(argv):
+    """
+    `generate_rag_prompt.py benchmark-embedding`: throughput of the configured embedding path on a fixed text set
+    (the GeneratedSuccessfulCode purpose lines) for each batch size and thread count: texts/second, p50/p95 latency
+    per model call and peak RSS. Results go to JSON; --compare prints the change against an earlier run.
+    """
+    import platform
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py benchmark-embedding',
+                                     description='Measure embedding throughput across batch sizes and thread counts.')
+    parser.add_argument('--batch-sizes', default='1,8,32,64', help='Comma-separated batch sizes (default: %(default)s).')
+    parser.add_argument('--threads', default=','.join(map(str, default_thread_candidates())),
+                        help='Comma-separated intra-op thread counts, one process each (default: %(default)s).')
+    parser.add_argument('--texts', type=int, default=0, help='Use only the first N texts (default: all).')
+    parser.add_argument('--repeat', type=int, default=1, help='Passes over the texts per batch size (default: %(default)s).')
+    parser.add_argument('--output', default=None, help='Results file (default: embedding_benchmark_<time>.json in the cache folder).')
+    parser.add_argument('--compare', default=None, help='Earlier results file to compare texts/second against.')
+    args = parser.parse_args(argv)
+    resolve_active_pair() # Results are labelled with the active pair's model tag
+    texts = generated_code_purposes() or benchmark_queries(1000)
+    texts = texts[:args.texts] if args.texts > 0 else texts
+    runs = []
+    with probe_input_file(texts) as texts_file:
+        for threads in [int(t) for t in args.threads.split(',') if t.strip()]:
+            log_debug(f"[benchmark] Embedding {len(texts)} texts with {threads} thread(s) at batch sizes {args.batch_sizes}...")
+            result, error = run_probe(['benchmark-embedding-probe', '--texts-file', texts_file, '--batch-sizes', args.batch_sizes,
+                                       '--threads', str(threads), '--repeat', str(args.repeat)])
+            if error:
+                log_error(f"[benchmark] {threads} thread(s) failed: {error}")
+                result = {'threads': threads, 'error': error}
+            runs.append(result)
+    results = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'model': embedding_model_tag(), 'backend': embedding_backend,
+               'max_tokens': embedding_max_tokens, 'length_buckets': list(embedding_length_buckets),
+               'texts': len(texts), 'repeat': args.repeat, 'cpu_count': os.cpu_count(), 'cpu_affinity': cpu_affinity,
+               'platform': platform.platform(), 'python': platform.python_version(), 'runs': runs}
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            for run in json.load(f).get('runs', []):
+                for row in run.get('results', []):
+                    baseline[(run['threads'], row['batch_size'])] = row['texts_per_second']
+    lines = [f"--- Embedding Throughput ({results['model']}, {embedding_backend}, {len(texts)} texts) ---",
+             f"  {'threads':>7} {'batch':>6} {'texts/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'peak MB':>8}"
+             + (f" {'vs base':>8}" if baseline else '')]
+    for run in runs:
+        if 'error' in run:
+            lines.append(f"  {run['threads']:>7} failed: {run['error']}")
+            continue
+        for row in run['results']:
+            before = baseline.get((run['threads'], row['batch_size']))
+            change = f" {row['texts_per_second'] / before - 1.0:>+8.1%}" if before else (f" {'n/a':>8}" if baseline else '')
+            lines.append(f"  {run['threads']:>7} {row['batch_size']:>6} {row['texts_per_second']:>9.1f} "
+                         f"{row['batch_latency']['p50_ms']:>9.2f} {row['batch_latency']['p95_ms']:>9.2f} "
+                         f"{run['memory']['peak_rss_mb'] or 0:>8.0f}{change}")
+    output = args.output or os.path.join(cache_directory, f"embedding_benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    emit_report(lines, results, output)
+    print(f"Saved to {output}.")
+    return 0 if any('error' not in run for run in runs) else 1
+
+# --- Matryoshka Collections: Build and Recall Report ---
+def build_truncated_collection(dims, batch_size=1000, overwrite=False):
+    """
+    Creates "<collection_name>_d<dims>" from the stored full-width embeddings of `collection_name`
+    (truncated and re-normalized; the model is not run on any document). Returns the number of chunks copied.
+    """
+    client = open_chroma_client()
+    resolve_active_pair(client)
+    source = client.get_collection(name=collection_name, embedding_function=None)
+    target_name = f"{collection_name}_d{dims}"
+    try:
+        client.get_collection(name=target_name, embedding_function=None)
+        exists = True
+    except Exception: # ValueError or NotFoundError depending on the Chroma version
+        exists = False
+    if exists:
+        if not overwrite:
+            raise ValueError(f"Collection '{target_name}' already exists (use --overwrite to rebuild it).")
+        client.delete_collection(name=target_name)
+    # Distance settings must be fixed at creation; the source's hnsw:* metadata is carried over
+    metadata = {key: value for key, value in (source.metadata or {}).items() if key.startswith('hnsw:')}
+    metadata.update({'matryoshka_source': collection_name, 'matryoshka_dims': dims, 'embedding_model': model_name})
+    target = client.create_collection(name=target_name, metadata=metadata, embedding_function=None)
+    copied, total = 0, source.count()
+    while copied < total:
+        page = source.get(limit=batch_size, offset=copied, include=['embeddings', 'documents', 'metadatas'])
+        if not page['ids']:
+            break
+        documents, metadatas = page.get('documents'), page.get('metadatas')
+        target.add(ids=page['ids'], embeddings=truncate_embeddings(page['embeddings'], dims).tolist(),
+                   documents=list(documents) if documents else None,
+                   metadatas=[metadata or None for metadata in metadatas] if metadatas else None)
+        copied += len(page['ids'])
+        log_debug(f"[build-truncated] {copied}/{total} chunks copied to '{target_name}'.")
+    if target.count() != total:
+        raise RuntimeError(f"'{target_name}' holds {target.count()} chunks, expected {total}.")
+    return copied
+
+def run_build_truncated_command(argv):
+    """
+    `generate_rag_prompt.py build-truncated --dims 256`: builds the collection used when embedding_dimensions = 256.
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py build-truncated',
+                                     description='Build a Matryoshka-truncated copy of the collection from its stored embeddings.')
+    parser.add_argument('--dims', type=int, required=True, help='Dimensions to keep (e.g. 256 or 384).')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Chunks copied per get/add round trip (default: 1000).')
+    parser.add_argument('--overwrite', action='store_true', help='Replace the truncated collection if it exists.')
+    args = parser.parse_args(argv)
+    with startup_timer.stage('build truncated collection'):
+        copied = build_truncated_collection(args.dims, batch_size=max(1, args.batch_size), overwrite=args.overwrite)
+    print(f"Built '{collection_name}_d{args.dims}' with {copied} chunks in {startup_timer.timings['build truncated collection']:.1f}s. "
+          f"Set embedding_dimensions = {args.dims} to query it.")
+    return 0
+
+def run_matryoshka_benchmark_command(argv):
+    """
+    `generate_rag_prompt.py benchmark-matryoshka`: recall@k and query latency of the truncated collections
+    against the full-width collection, on the same historical queries (embedded once, truncated per width).
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py benchmark-matryoshka',
+                                     description='Report recall@k vs search latency of truncated collections against the full one.')
+    parser.add_argument('--dims', default='256,384', help='Comma-separated truncated widths to compare (default: %(default)s).')
+    parser.add_argument('--queries', type=int, default=50, help='Number of historical queries to use (default: 50).')
+    parser.add_argument('--k', type=int, default=final_num_results, help=f'k for recall@k (default: {final_num_results}).')
+    parser.add_argument('--output', default=None, help='Also write the results as JSON to this file.')
+    args = parser.parse_args(argv)
+    client = open_chroma_client()
+    resolve_active_pair(client) # Truncate the pinned model's vectors and compare its collections, not the configured ones
+    queries = benchmark_queries(args.queries)
+    preload_retrieval_modules()
+    import numpy as np
+    full_vectors = np.asarray(load_embedding_model()(queries), dtype=np.float32) # Full width, straight from the model
+
+    def measure(collection, vectors):
+        collection.query(query_embeddings=[list(map(float, vectors[0]))], n_results=args.k, include=['distances']) # Loads the index
+        top_ids, latencies = [], []
+        for vector in vectors:
+            started = time.perf_counter()
+            result = collection.query(query_embeddings=[list(map(float, vector))], n_results=args.k, include=['distances'])
+            latencies.append(time.perf_counter() - started)
+            top_ids.append(result['ids'][0])
+        return top_ids, latencies
+
+    full_dims = full_vectors.shape[1]
+    reference_ids, latencies = measure(client.get_collection(name=collection_name, embedding_function=None), full_vectors)
+    rows = [{'dims': full_dims, 'collection': collection_name, 'recall_at_k': 1.0, 'latency': latency_summary(latencies)}]
+    for dims in [int(d) for d in args.dims.split(',') if d.strip()]:
+        name = f"{collection_name}_d{dims}"
+        try:
+            collection = client.get_collection(name=name, embedding_function=None)
+        except Exception:
+            rows.append({'dims': dims, 'collection': name, 'error': f"missing (run: build-truncated --dims {dims})"})
+            continue
+        top_ids, latencies = measure(collection, truncate_embeddings(full_vectors, dims))
+        rows.append({'dims': dims, 'collection': name, 'recall_at_k': top_k_overlap(reference_ids, top_ids),
+                     'latency': latency_summary(latencies)})
+
+    lines = [f"--- Matryoshka Recall Report ({len(queries)} queries, recall@{args.k} against {full_dims} dims) ---",
+             f"  {'dims':>6} {'recall':>8} {'p50 ms':>8} {'p95 ms':>8} {'vector B':>9}  collection"]
+    for row in rows:
+        if 'error' in row:
+            lines.append(f"  {row['dims']:>6} {row['error']}")
+            continue
+        lines.append(f"  {row['dims']:>6} {row['recall_at_k']:>8.3f} {row['latency']['p50_ms']:>8.2f} "
+                     f"{row['latency']['p95_ms']:>8.2f} {row['dims'] * 4:>9}  {row['collection']}")
+    emit_report(lines, {'queries': queries, 'k': args.k, 'results': rows}, args.output)
+    return 0
+
+# --- Past Request Index: Build and Lookup ---
+def run_index_purposes_command(argv):
+    """
+    `generate_rag_prompt.py index-purposes`: embeds the purpose lines of new GeneratedSuccessfulCode scripts
+    into the past-request index (all of them the first time).
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py index-purposes',
+                                     description="Embed the '# Purpose:' lines of GeneratedSuccessfulCode scripts saved since the last run.")
+    parser.add_argument('--rebuild', action='store_true', help='Re-embed every script.')
+    args = parser.parse_args(argv)
+    resolve_active_pair() # The index file is keyed by the active pair's model
+    if args.rebuild and os.path.exists(purpose_index_file()):
+        os.remove(purpose_index_file())
+    preload_retrieval_modules()
+    with startup_timer.stage('update past-request index'):
+        index, added, removed = update_purpose_index(create_embedding_function())
+    print(f"Past-request index: {len(index.files)} scripts ({added} added, {removed} removed) in "
+          f"{startup_timer.timings['update past-request index']:.1f}s -> {purpose_index_file()} "
+          f"({os.path.getsize(purpose_index_file()) / 2**10 if index.files else 0:.0f} KB)")
+    return 0
+
+def run_similar_requests_command(argv):
+    """
+    `generate_rag_prompt.py similar-requests "query"`: prints the saved scripts closest to the query. The model is
+    loaded only if the query embedding is not cached. chromadb is not imported: the active pair comes from its copy
+    (see resolve_active_pair), which only the first run after an upgrade has to create from the pointer collection.
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py similar-requests',
+                                     description='Show the GeneratedSuccessfulCode scripts whose purpose is closest to a query.')
+    parser.add_argument('query')
+    parser.add_argument('--k', type=int, default=5, help='Number of scripts to show (default: %(default)s).')
+    args = parser.parse_args(argv)
+    resolve_active_pair() # The index and the embedding cache are keyed by the active pair's model
+    if load_purpose_index() is None:
+        log_error(f"No past-request index at {purpose_index_file()}; run index-purposes first.")
+        return 1
+    model = []
+    def embed(texts): # Loads the model only on a query-embedding cache miss
+        if not model:
+            model.append(create_embedding_function(standalone=True))
+        return model[0](texts)
+    started = time.perf_counter()
+    query_vector = QueryEmbedder(embed, get_embedding_cache())([args.query])[0]
+    embedded = time.perf_counter()
+    matches = similar_past_requests(query_vector, args.k)
+    finished = time.perf_counter()
+    for match in matches:
+        print(f"  {match['score']:.3f}  {match['purpose']}\n         {match['file']}")
+    print(f"Query embedding {(embedded - started) * 1000.0:.1f} ms ({'model' if model else 'cache'}), "
+          f"lookup {(finished - embedded) * 1000.0:.2f} ms over {len(load_purpose_index().files)} scripts.")
+    return 0
+
+# --- Length Bucketing: Micro-Benchmark ---
+def refinement_query_lists(limit, list_size=5):
+    """
+    Query lists shaped like refine_query_with_gemini output: cached refinement lists, else historical
+    queries (or the sample queries) taken `list_size` at a time.
+    """
+    lists = []
+    refinement_cache = get_refinement_cache()
+    if refinement_cache is not None:
+        lists = [[q for q in refined if isinstance(q, str)] for refined in refinement_cache.values()]
+        lists = [refined for refined in lists if len(refined) > 1]
+    if not lists:
+        lists = [chunk for chunk in batched(benchmark_queries(limit * list_size), list_size) if len(chunk) > 1]
+    return lists[:limit]
+
+def run_bucketing_benchmark_command(argv):
+    """
+    `generate_rag_prompt.py benchmark-bucketing`: CPU time, wall time and padded tokens for embedding typical
+    refinement lists in one padded batch versus per length bucket.
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py benchmark-bucketing',
+                                     description='Measure the CPU time saved by length-bucketed query batches.')
+    parser.add_argument('--lists', type=int, default=50, help='Number of refinement lists to embed (default: %(default)s).')
+    parser.add_argument('--repeat', type=int, default=3, help='Passes over the lists per mode (default: %(default)s).')
+    parser.add_argument('--output', default=None, help='Also write the results as JSON to this file.')
+    args = parser.parse_args(argv)
+    query_lists = refinement_query_lists(args.lists)
+    if not query_lists:
+        log_error("[benchmark] No query lists to embed.")
+        return 1
+    preload_retrieval_modules()
+    bucketed = load_embedding_model()
+    if bucketed.count_tokens is None:
+        log_error("[benchmark] The embedding function exposes no tokenizer; bucketing does not apply.")
+        return 1
+    modes = {'single batch': lambda texts: bucketed.embedding_function(texts), 'bucketed': bucketed}
+    bucketed(["Revit API warm-up query", "Revit API warm-up query " * 20]) # First-call allocations are not measured
+    results = {}
+    for name, embed in modes.items():
+        cpu_seconds, wall = 0.0, []
+        for _ in range(max(1, args.repeat)):
+            for texts in query_lists:
+                cpu_started, started = time.process_time(), time.perf_counter()
+                embed(texts)
+                wall.append(time.perf_counter() - started)
+                cpu_seconds += time.process_time() - cpu_started # All threads of this process
+        results[name] = {'cpu_ms_per_list': round(cpu_seconds * 1000.0 / len(wall), 3), 'latency': latency_summary(wall)}
+    lengths = [bucketed.count_tokens(texts) for texts in query_lists]
+    results['single batch']['padded_tokens'] = sum(padded_token_count(l, [list(range(len(l)))]) for l in lengths)
+    results['bucketed']['padded_tokens'] = sum(padded_token_count(l, length_buckets(l, bucketed.bounds)) for l in lengths)
+    tokens = sum(map(sum, lengths))
+    single, split = results['single batch'], results['bucketed']
+    saved = 1.0 - split['cpu_ms_per_list'] / single['cpu_ms_per_list'] if single['cpu_ms_per_list'] else 0.0
+    lines = [f"--- Length Bucketing ({len(query_lists)} lists, {sum(map(len, query_lists)) / len(query_lists):.1f} queries/list, "
+             f"{tokens} real tokens, max {embedding_max_tokens} tokens, bounds {list(bucketed.bounds)}) ---",
+             f"  {'mode':<14} {'CPU ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'padded tok':>11}"]
+    for name, result in results.items():
+        lines.append(f"  {name:<14} {result['cpu_ms_per_list']:>8.2f} {result['latency']['p50_ms']:>8.2f} "
+                     f"{result['latency']['p95_ms']:>8.2f} {result['padded_tokens']:>11}")
+    lines.append(f"  CPU time saved per list: {saved:.1%}")
+    emit_report(lines, {'lists': query_lists, 'tokens': tokens, 'results': results, 'cpu_saved_fraction': round(saved, 4)},
+                args.output)
+    return 0
+
+# --- Projected Query Encoder: Training ---
+def run_train_projection_command(argv):
+    """
+    `generate_rag_prompt.py train-projection`: fits the linear map from a small query encoder into `model_name`'s
+    space on historical queries and GeneratedSuccessfulCode purposes (each embedded by both models), calibrates the
+    full-model fallback threshold, and reports the query-side latency of both encoders.
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py train-projection',
+                                     description="Train the projection used by query_encoder = 'projected'.")
+    parser.add_argument('--student', default=query_encoder_model, help='Small query encoder (default: %(default)s).')
+    parser.add_argument('--ridge', type=float, default=1.0, help='Ridge regularization strength (default: %(default)s).')
+    parser.add_argument('--target-cosine', type=float, default=0.85,
+                        help='Cosine to the full-model embedding that 90%% of accepted validation queries must reach '
+                             '(sets the fallback threshold; default: %(default)s).')
+    parser.add_argument('--output', default=query_projection_path, help='Projection file (default: %(default)s).')
+    parser.add_argument('--min-pairs', type=int, default=50, help='Refuse to train on fewer texts (default: %(default)s).')
+    args = parser.parse_args(argv)
+    texts = list(dict.fromkeys(collect_historical_queries() + generated_code_purposes()))
+    if len(texts) < args.min_pairs:
+        log_error(f"[train-projection] Only {len(texts)} training texts (need {args.min_pairs}); run more queries first.")
+        return 1
+    resolve_active_pair() # The projection maps into the active pair's model
+    log_debug(f"[train-projection] Embedding {len(texts)} texts with '{model_name}' and '{args.student}'...")
+    preload_retrieval_modules()
+    teacher = load_embedding_model()
+    student = load_embedding_model(args.student, stage='load query encoder')
+    teacher_vectors, student_vectors = [], []
+    with startup_timer.stage('embed training texts'):
+        for chunk in batched(texts, 64):
+            teacher_vectors.extend(teacher(chunk))
+            student_vectors.extend(student(chunk))
+    with startup_timer.stage('fit projection'):
+        projection = QueryProjection.fit(student_vectors, teacher_vectors, args.student, teacher_model_tag(),
+                                         ridge=args.ridge, target_cosine=args.target_cosine)
+    projection.save(args.output)
+
+    def single_query_latency(embedding_function):
+        latencies = []
+        for text in texts[:50]:
+            started = time.perf_counter()
+            embedding_function([text])
+            latencies.append(time.perf_counter() - started)
+        return latency_summary(latencies)
+    latency = {'full': single_query_latency(teacher), 'student': single_query_latency(student)}
+    lines = [f"--- Query Projection ('{args.student}' -> '{teacher_model_tag()}', {len(texts)} texts) ---"]
+    lines += [f"  {key:<28} {value}" for key, value in projection.stats.items()]
+    lines += [f"  {name + ' encoder p50/p95 ms':<28} {summary['p50_ms']} / {summary['p95_ms']}" for name, summary in latency.items()]
+    emit_report(lines)
+    print(f"Saved to {args.output}. Set query_encoder = 'projected' to use it.")
+    return 0
+
+# --- Embedding Model Migration ---
+def migrate_collection(source, target, embedding_function, page_size):
+    """
+    Re-embeds every document of `source` into `target` with `embedding_function`, `page_size` chunks at a time.
+    Chunks already in `target` are skipped, so an interrupted migration resumes where it stopped. Returns the
+    number of chunks embedded by this call.
+    """
+    total, offset, embedded = source.count(), 0, 0
+    started = time.perf_counter()
+    while offset < total:
+        page = source.get(limit=page_size, offset=offset, include=['documents', 'metadatas'])
+        if not page['ids']:
+            break
+        offset += len(page['ids'])
+        present = set(target.get(ids=page['ids'], include=[])['ids'])
+        rows = [i for i, chunk_id in enumerate(page['ids']) if chunk_id not in present]
+        if not rows:
+            continue
+        documents = [page['documents'][i] for i in rows]
+        if any(document is None for document in documents):
+            raise ValueError(f"Collection '{source.name}' has chunks without stored documents; they cannot be re-embedded.")
+        metadatas = page.get('metadatas')
+        metadatas = [metadatas[i] or None for i in rows] if metadatas else None
+        target.add(ids=[page['ids'][i] for i in rows], documents=documents, metadatas=metadatas,
+                   embeddings=[list(map(float, vector)) for vector in embedding_function(documents)])
+        embedded += len(rows)
+        rate = embedded / max(time.perf_counter() - started, 1e-9)
+        log_debug(f"[migrate-model] {offset}/{total} chunks ({embedded} embedded, {rate:.1f}/s, "
+                  f"~{(total - offset) / rate if rate else 0:.0f}s left).")
+    return embedded
+
+def run_migrate_model_command(argv):
+    """
+    `generate_rag_prompt.py migrate-model --model NEW`: re-embeds the active collection's documents with NEW into a
+    new collection while queries keep using the active pair, then switches the pointer to the new pair once every
+    chunk is in. Safe to interrupt and rerun.
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py migrate-model',
+                                     description='Re-embed the collection with another model in the background, then switch to it.')
+    parser.add_argument('--model', required=True, help='Embedding model to migrate to.')
+    parser.add_argument('--collection', default=None,
+                        help='Name of the new collection (default: the active one plus a hash of the model name).')
+    parser.add_argument('--page-size', type=int, default=64, help='Chunks read and embedded per round trip (default: %(default)s).')
+    parser.add_argument('--no-switch', action='store_true', help='Build the collection but keep serving the current pair.')
+    parser.add_argument('--normal-priority', action='store_true', help='Do not lower the process priority.')
+    args = parser.parse_args(argv)
+    if not args.normal_priority:
+        try: lower_process_priority()
+        except Exception as e: log_error(f"[migrate-model] Could not lower the process priority: {e}")
+    client = open_chroma_client()
+    source_name, source_model = resolve_active_pair(client)
+    if args.model == source_model:
+        log_error(f"[migrate-model] '{source_name}' is already embedded with '{args.model}'.")
+        return 1
+    target_name = args.collection or f"{source_name}_m{text_hash(args.model)[:8]}"
+    source = client.get_collection(name=source_name, embedding_function=None)
+    # Distance settings must be fixed at creation; the source's hnsw:* metadata is carried over
+    metadata = {key: value for key, value in (source.metadata or {}).items() if key.startswith('hnsw:')}
+    metadata.update({'embedding_model': args.model, 'migration_source': source_name,
+                     'migration_source_model': source_model, 'migration_state': 'building'})
+    target = client.get_or_create_collection(name=target_name, metadata=metadata, embedding_function=None)
+    if (target.metadata or {}).get('embedding_model') != args.model:
+        log_error(f"[migrate-model] Collection '{target_name}' exists with model '{(target.metadata or {}).get('embedding_model')}'.")
+        return 1
+    log_debug(f"[migrate-model] Re-embedding '{source_name}' ({source.count()} chunks, '{source_model}') into "
+              f"'{target_name}' with '{args.model}'; queries keep using '{source_name}' until it is complete.")
+    preload_retrieval_modules()
+    embedding_function = load_embedding_model(args.model, stage='load migration model', documents=True)
+    with startup_timer.stage('re-embed documents'):
+        embedded = migrate_collection(source, target, embedding_function, max(1, args.page_size))
+    if target.count() != source.count():
+        log_error(f"[migrate-model] '{target_name}' holds {target.count()} chunks, expected {source.count()}; rerun to resume.")
+        return 1
+    update_collection_metadata(target, migration_state='complete', migrated_at=time.strftime('%Y-%m-%d %H:%M:%S'))
+    if (source.metadata or {}).get('embedding_model') is None: # Lets switch-model roll back with the same check
+        update_collection_metadata(source, embedding_model=source_model)
+    print(f"Re-embedded {embedded} chunks into '{target_name}' in {startup_timer.timings['re-embed documents']:.1f}s.")
+    if args.no_switch:
+        print(f"Not switched. Run: switch-model --collection {target_name}")
+        return 0
+    switch_active_pair(client, target_name, args.model)
+    print(f"Switched to '{target_name}' with '{args.model}'. Restart running workers and the service to pick it up.")
+    return 0
+
+def run_switch_model_command(argv):
+    """
+    `generate_rag_prompt.py switch-model [--collection NAME]`: points new processes at a complete collection and the
+    model it records (default: the previous pair, i.e. a rollback). With --status, only prints the pairs.
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py switch-model',
+                                     description='Switch the active model/collection pair, or show it with --status.')
+    parser.add_argument('--collection', default=None, help='Collection to switch to (default: the previous active one).')
+    parser.add_argument('--status', action='store_true', help='Print the active pair and each collection\'s model, then exit.')
+    args = parser.parse_args(argv)
+    client = open_chroma_client()
+    pointer = read_active_pair(client)
+    if args.status:
+        print(f"Active: {pointer['collection']} ({pointer['embedding_model']}), switched {pointer.get('switched_at')}" if pointer
+              else f"Active: {collection_name} ({model_name}) from the configuration")
+        for name in sorted(getattr(c, 'name', c) for c in client.list_collections()): # Names or Collection objects
+            if name != active_pair_collection:
+                metadata = client.get_collection(name=name, embedding_function=None).metadata or {}
+                print(f"  {name:<48} {metadata.get('embedding_model', '(model not recorded)')}  "
+                      f"{metadata.get('migration_state', '')}")
+        return 0
+    target_name = args.collection or (pointer or {}).get('previous_collection')
+    if not target_name:
+        log_error("[switch-model] No previous pair to roll back to; pass --collection.")
+        return 1
+    target = client.get_collection(name=target_name, embedding_function=None)
+    target_model = (target.metadata or {}).get('embedding_model')
+    if not target_model:
+        log_error(f"[switch-model] Collection '{target_name}' does not record its embedding model.")
+        return 1
+    if (target.metadata or {}).get('migration_state', 'complete') != 'complete':
+        log_error(f"[switch-model] Collection '{target_name}' is not complete; finish migrate-model first.")
+        return 1
+    switch_active_pair(client, target_name, target_model)
+    print(f"Switched to '{target_name}' with '{target_model}'. Restart running workers and the service to pick it up.")
+    return 0
+
+# --- Flat Index: Export and Agreement Check ---
+def read_collection(name=None, page_size=1000, label='export'):
+    """
+    Every stored chunk of collection `name` (default: the active collection), paged through collection.get.
+    Returns (Chroma collection, ids, float32 embeddings, documents, metadatas, header describing the collection).
+    The header records the active pair when `name` is the active collection.
+    """
+    import numpy as np
+    client = open_chroma_client()
+    resolve_active_pair(client)
+    name = name or active_collection_name()
+    source = client.get_collection(name=name, embedding_function=None)
+    ids, embeddings, documents, metadatas = [], [], [], []
+    total = source.count()
+    while len(ids) < total:
+        page = source.get(limit=page_size, offset=len(ids), include=['embeddings', 'documents', 'metadatas'])
+        if not page['ids']:
+            break
+        ids.extend(page['ids'])
+        embeddings.extend(page['embeddings'])
+        documents.extend(page.get('documents') or [None] * len(page['ids']))
+        metadatas.extend(page.get('metadatas') or [None] * len(page['ids']))
+        log_debug(f"[{label}] {len(ids)}/{total} chunks read from '{name}'.")
+    header = {'collection': name, 'metadata': source.metadata or {}, 'space': collection_space(source),
+              'embedding_model': model_name, 'exported_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+    if name == active_collection_name():
+        header['pair'] = {'collection': collection_name, 'embedding_model': model_name}
+    return source, ids, np.asarray(embeddings, dtype=np.float32), documents, metadatas, header
+
+def export_flat_index(name=None, page_size=1000, dtype='float16'):
+    """
+    Dumps collection `name` (default: the active collection) to <flat_index_directory>/<name>/ (see read_collection).
+    Exporting the active collection also records the pair in active_pair.json for the flat backends.
+    Returns (Chroma collection, float32 embeddings, FlatIndex).
+    """
+    source, ids, embeddings, documents, metadatas, header = read_collection(name, page_size, label='export-flat-index')
+    header['source_fingerprint'] = collection_fingerprint(persist_directory, name=header['collection'])
+    directory = os.path.join(flat_index_directory, header['collection'])
+    write_flat_index(directory, ids, embeddings, documents, metadatas, header, dtype=dtype)
+    if 'pair' in header:
+        write_flat_active_pair(dict(header['pair'], exported_at=header['exported_at']))
+    return source, embeddings, FlatIndex(directory)
+
+def chunk_query_vectors(embeddings, count, seed=0):
+    # Midpoints of random pairs of stored chunks: query vectors near real content that are not themselves chunks
+    import numpy as np
+    pairs = np.random.default_rng(seed).integers(0, len(embeddings), size=(count, 2))
+    return (embeddings[pairs[:, 0]] + embeddings[pairs[:, 1]]) / 2.0
+
+def timed_top_k(collection, vectors, k):
+    """
+    Queries `collection` (Chroma or flat) one vector at a time. Returns (top-k ids per vector, latencies in seconds).
+    """
+    collection.query(query_embeddings=[list(map(float, vectors[0]))], n_results=k, include=['distances']) # Loads the index
+    top_ids, latencies = [], []
+    for vector in vectors:
+        started = time.perf_counter()
+        result = collection.query(query_embeddings=[list(map(float, vector))], n_results=k, include=['distances'])
+        latencies.append(time.perf_counter() - started)
+        top_ids.append(result['ids'][0])
+    return top_ids, latencies
+
+def compare_flat_index(source, index, embeddings, queries=20, k=final_num_results):
+    """
+    Runs the same query vectors (see chunk_query_vectors) through Chroma and the flat index.
+    Returns top-k agreement and per-query latency of each.
+    """
+    vectors = chunk_query_vectors(embeddings, queries)
+    results = {label: timed_top_k(collection, vectors, k) for label, collection in (('chroma', source), ('flat', index))}
+    reference_ids, candidate_ids = results['chroma'][0], results['flat'][0]
+    return {'queries': queries, 'k': k,
+            'same_order': sum(reference == candidate for reference, candidate in zip(reference_ids, candidate_ids)),
+            'top_k_overlap': top_k_overlap(reference_ids, candidate_ids),
+            'latency': {label: latency_summary(latencies) for label, (_, latencies) in results.items()}}
+
+def run_export_flat_index_command(argv):
+    """
+    `generate_rag_prompt.py export-flat-index`: writes the flat index used by retrieval_backend = 'flat',
+    then checks that it returns Chroma's top-k on sample queries.
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py export-flat-index',
+                                     description='Export the collection to a memory-mapped matrix plus id, document and metadata '
+                                                 'files for exact search without ChromaDB, and compare its top-k with Chroma.')
+    parser.add_argument('--collection', default=None, help='Collection to export (default: the active collection).')
+    parser.add_argument('--dtype', choices=('float16', 'float32'), default='float16',
+                        help='Stored embedding precision (default: %(default)s; float32 doubles the size).')
+    parser.add_argument('--page-size', type=int, default=1000, help='Chunks read per collection.get call (default: 1000).')
+    parser.add_argument('--verify', type=int, default=20, help='Sample queries compared against Chroma (default: 20; 0 skips).')
+    parser.add_argument('--k', type=int, default=final_num_results, help=f'Top-k compared (default: {final_num_results}).')
+    parser.add_argument('--output', default=None, help='Also write the report as JSON to this file.')
+    args = parser.parse_args(argv)
+    with startup_timer.stage('export flat index'):
+        source, embeddings, index = export_flat_index(args.collection, page_size=max(1, args.page_size), dtype=args.dtype)
+    size = sum(os.path.getsize(path) for path in unique_files([index.path]))
+    lines = ["--- Flat Index Export ---",
+             f"  '{index.name}': {index.count()} chunks x {index.header['dim']} dims ({index.header['dtype']}, {index.space}), "
+             f"{size / 2**20:.1f} MB in {index.path}",
+             f"  Exported in {startup_timer.timings['export flat index']:.1f}s."]
+    report = {'collection': index.name, 'count': index.count(), 'directory': index.path, 'bytes': size}
+    if args.verify > 0 and index.count():
+        comparison = compare_flat_index(source, index, embeddings, queries=args.verify, k=args.k)
+        report['comparison'] = comparison
+        lines += [f"--- Flat Index vs Chroma ({comparison['queries']} queries, top-{comparison['k']}) ---",
+                  f"  Same ranking: {comparison['same_order']}/{comparison['queries']} queries; "
+                  f"top-k overlap: {comparison['top_k_overlap']:.3f}",
+                  f"  {'backend':<8} {'p50 ms':>8} {'p95 ms':>8}"]
+        for label, latency in comparison['latency'].items():
+            lines.append(f"  {label:<8} {latency['p50_ms']:>8.2f} {latency['p95_ms']:>8.2f}")
+    emit_report(lines, report, args.output)
+    return 0
+
+# --- Binary-Quantized Index: Recall and Latency Report ---
+def run_binary_benchmark_command(argv):
+    """
+    `generate_rag_prompt.py benchmark-binary`: recall@k and per-query latency of the two-stage sign-bit index
+    (one row per shortlist size) next to collection.query and exact flat search, on the same query vectors.
+    Recall is measured against exact search; 'vs chroma' is the top-k overlap with collection.query.
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py benchmark-binary',
+                                     description='Report recall@k and latency of the sign-bit shortlist + rescoring index '
+                                                 'against collection.query and exact search.')
+    parser.add_argument('--candidates', default='2,5,10,20',
+                        help='Comma-separated shortlist sizes, as rows per requested result (default: %(default)s).')
+    parser.add_argument('--queries', type=int, default=50, help='Number of historical queries to embed (default: 50).')
+    parser.add_argument('--chunk-queries', type=int, default=0,
+                        help='Also query with this many midpoints of stored chunks (no model needed; default: 0).')
+    parser.add_argument('--k', type=int, default=final_num_results, help=f'k for recall@k (default: {final_num_results}).')
+    parser.add_argument('--output', default=None, help='Also write the results as JSON to this file.')
+    args = parser.parse_args(argv)
+    import numpy as np
+    client = open_chroma_client()
+    resolve_active_pair(client)
+    path = flat_index_path()
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Flat index not found at: {path} (run the 'export-flat-index' or 'import-snapshot' subcommand first)")
+    flat = FlatIndex(path)
+    vectors = []
+    queries = benchmark_queries(args.queries) if args.queries > 0 else []
+    if queries:
+        preload_retrieval_modules()
+        vectors.extend(np.asarray(create_embedding_function()(queries), dtype=np.float32))
+    if args.chunk_queries > 0:
+        vectors.extend(chunk_query_vectors(np.asarray(flat.embeddings, dtype=np.float32), args.chunk_queries))
+    if not vectors:
+        raise ValueError("No query vectors (use --queries or --chunk-queries).")
+    vectors = np.asarray(vectors, dtype=np.float32)
+
+    reference_ids, latencies = timed_top_k(flat, vectors, args.k)
+    chroma_ids, chroma_latencies = timed_top_k(client.get_collection(name=active_collection_name(), embedding_function=None),
+                                               vectors, args.k)
+    words = -(-flat.header['dim'] // 64)
+    row_bytes = flat.header['dim'] * np.dtype(flat.header['dtype']).itemsize
+    rows = [{'index': 'chroma', 'recall_at_k': top_k_overlap(reference_ids, chroma_ids), 'vs_chroma': 1.0,
+             'latency': latency_summary(chroma_latencies), 'scanned_bytes': None},
+            {'index': 'flat', 'recall_at_k': 1.0, 'vs_chroma': top_k_overlap(chroma_ids, reference_ids),
+             'latency': latency_summary(latencies), 'scanned_bytes': flat.count() * row_bytes}]
+    for candidates in [int(c) for c in args.candidates.split(',') if c.strip()]:
+        index = BinaryQuantizedIndex(path, candidates_per_result=candidates)
+        top_ids, latencies = timed_top_k(index, vectors, args.k)
+        shortlist = min(index.count(), max(args.k * candidates, index.min_candidates))
+        rows.append({'index': f'binary x{candidates}', 'candidates_per_result': candidates, 'shortlist': shortlist,
+                     'recall_at_k': top_k_overlap(reference_ids, top_ids), 'vs_chroma': top_k_overlap(chroma_ids, top_ids),
+                     'latency': latency_summary(latencies), 'scanned_bytes': index.count() * words * 8 + shortlist * row_bytes})
+
+    lines = [f"--- Binary-Quantized Index Report ({len(vectors)} queries, recall@{args.k} against exact search, "
+             f"{flat.count()} chunks x {flat.header['dim']} dims) ---",
+             f"  {'index':<12} {'recall':>8} {'vs chroma':>9} {'p50 ms':>8} {'p95 ms':>8} {'scanned KB':>10}"]
+    for row in rows:
+        scanned = f"{row['scanned_bytes'] / 1024:>10.0f}" if row['scanned_bytes'] is not None else f"{'-':>10}"
+        lines.append(f"  {row['index']:<12} {row['recall_at_k']:>8.3f} {row['vs_chroma']:>9.3f} "
+                     f"{row['latency']['p50_ms']:>8.2f} {row['latency']['p95_ms']:>8.2f} {scanned}")
+    emit_report(lines, {'queries': queries, 'chunk_queries': args.chunk_queries, 'k': args.k, 'results': rows}, args.output)
+    return 0
+
+# --- Index Snapshots: Export and Import ---
+def run_export_snapshot_command(argv):
+    """
+    `generate_rag_prompt.py export-snapshot`: writes the collection as one versioned, checksummed file
+    (see rag_index.write_index_snapshot) to copy to workstations instead of the ChromaDB folder.
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py export-snapshot',
+                                     description='Write the collection as a single snapshot file: float16 embeddings, '
+                                                 'zstd-compressed documents and metadata columns, with a checksum.')
+    parser.add_argument('--collection', default=None, help='Collection to export (default: the active collection).')
+    parser.add_argument('--output', default=None, help=f'Snapshot file (default: <collection>{SNAPSHOT_SUFFIX} in the current folder).')
+    parser.add_argument('--level', type=int, default=19, help='zstd compression level for documents (default: %(default)s).')
+    parser.add_argument('--page-size', type=int, default=1000, help='Chunks read per collection.get call (default: 1000).')
+    args = parser.parse_args(argv)
+    with startup_timer.stage('export snapshot'):
+        _, ids, embeddings, documents, metadatas, header = read_collection(args.collection, max(1, args.page_size),
+                                                                           label='export-snapshot')
+        output = args.output or f"{header['collection']}{SNAPSHOT_SUFFIX}"
+        header = write_index_snapshot(output, ids, embeddings, documents, metadatas, header, level=args.level)
+    text_bytes = sum(len(document.encode('utf-8')) for document in documents if document)
+    chroma_bytes = sum(os.path.getsize(path) for path in unique_files([persist_directory]))
+    emit_report([
+        "--- Index Snapshot Export ---",
+        f"  '{header['collection']}': {header['count']} chunks x {header['dim']} dims ({header['space']}), "
+        f"{len(header['metadata_columns'])} metadata columns",
+        f"  Documents: {text_bytes / 2**20:.1f} MB of text -> {header['sections']['documents.data'][1] / 2**20:.1f} MB zstd",
+        f"  {output}: {os.path.getsize(output) / 2**20:.1f} MB (ChromaDB folder: {chroma_bytes / 2**20:.1f} MB), "
+        f"written in {startup_timer.timings['export snapshot']:.1f}s",
+        f"  SHA-256 of contents: {header['payload_sha256']}"])
+    return 0
+
+def import_snapshot_to_chroma(path, overwrite=False, page_size=1000):
+    """
+    Rebuilds the snapshot's collection in persist_directory (float16 embeddings widened back to float32) and,
+    if the snapshot holds the active pair, switches to it. Returns the number of chunks added.
+    """
+    import numpy as np
+    index = FlatIndex(path)
+    os.makedirs(persist_directory, exist_ok=True)
+    client = open_chroma_client()
+    try:
+        client.get_collection(name=index.name, embedding_function=None)
+        exists = True
+    except Exception: # ValueError or NotFoundError depending on the Chroma version
+        exists = False
+    if exists:
+        if not overwrite:
+            raise ValueError(f"Collection '{index.name}' already exists in {persist_directory} (use --overwrite to replace it).")
+        client.delete_collection(name=index.name)
+    metadata = dict(index.metadata, **{'hnsw:space': index.space})
+    target = client.create_collection(name=index.name, metadata=metadata, embedding_function=None)
+    for start in range(0, index.count(), page_size):
+        rows = range(start, min(index.count(), start + page_size))
+        target.add(ids=[index.ids[i] for i in rows],
+                   embeddings=np.asarray(index.embeddings[rows.start:rows.stop], dtype=np.float32).tolist(),
+                   documents=[index.documents[i] for i in rows], metadatas=[index.metadatas[i] or None for i in rows])
+        log_debug(f"[import-snapshot] {rows.stop}/{index.count()} chunks added to '{index.name}'.")
+    pair = index.header.get('pair')
+    if pair and pair['collection'] == index.name:
+        switch_active_pair(client, pair['collection'], pair['embedding_model'])
+    return target.count()
+
+def run_import_snapshot_command(argv):
+    """
+    `generate_rag_prompt.py import-snapshot FILE`: verifies a snapshot and installs it for the flat retrieval
+    backends (and, with --chroma, as a ChromaDB collection).
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py import-snapshot',
+                                     description='Verify an index snapshot and install it for retrieval_backend = flat/binary.')
+    parser.add_argument('snapshot', help=f'Snapshot file written by export-snapshot (*{SNAPSHOT_SUFFIX}).')
+    parser.add_argument('--chroma', action='store_true', help='Also rebuild the collection in the ChromaDB folder.')
+    parser.add_argument('--overwrite', action='store_true', help='With --chroma: replace the collection if it exists.')
+    args = parser.parse_args(argv)
+    with startup_timer.stage('verify snapshot'):
+        header = verify_index_snapshot(args.snapshot)
+    os.makedirs(flat_index_directory, exist_ok=True)
+    target = os.path.join(flat_index_directory, header['collection'] + SNAPSHOT_SUFFIX)
+    if os.path.abspath(args.snapshot) != os.path.abspath(target):
+        temporary = f"{target}.{os.getpid()}.tmp"
+        shutil.copyfile(args.snapshot, temporary)
+        os.replace(temporary, target)
+    exported = os.path.join(flat_index_directory, header['collection'])
+    if os.path.isdir(exported):
+        shutil.rmtree(exported, ignore_errors=True) # An export-flat-index directory would take precedence over the snapshot
+        log_debug(f"[import-snapshot] Removed the older flat index export {exported}.")
+    if header.get('pair'):
+        write_flat_active_pair(dict(header['pair'], exported_at=header.get('exported_at')))
+    lines = [f"Verified and installed '{header['collection']}' ({header['count']} chunks, embedded with "
+             f"'{header['embedding_model']}', exported {header.get('exported_at')}) at {target} "
+             f"in {startup_timer.timings['verify snapshot']:.1f}s. Set retrieval_backend = 'flat' or 'binary' to use it."]
+    if args.chroma:
+        with startup_timer.stage('import into chroma'):
+            added = import_snapshot_to_chroma(target, overwrite=args.overwrite)
+        lines.append(f"Added {added} chunks to '{header['collection']}' in {persist_directory} "
+                     f"in {startup_timer.timings['import into chroma']:.1f}s.")
+    emit_report(lines)
+    return 0
+
+# --- Lazy Document Fetch: Measurement ---
+def run_lazy_fetch_benchmark_command(argv):
+    """
+    `generate_rag_prompt.py benchmark-lazy-fetch`: retrieval time and document/metadata bytes materialized per
+    request when every query returns its documents (eager) versus ids and distances first and one get() for the
+    final results (lazy), on refinement-shaped query lists. Query embeddings are computed up front, so only
+    retrieval is timed.
+    """
+    parser = argparse.ArgumentParser(prog='generate_rag_prompt.py benchmark-lazy-fetch',
+                                     description='Compare eager and lazy document fetching: retrieval time and bytes per request.')
+    parser.add_argument('--requests', type=int, default=30, help='Number of query lists (requests) to use (default: 30).')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per request and mode (default: 3).')
+    parser.add_argument('--output', default=None, help='Also write the results as JSON to this file.')
+    args = parser.parse_args(argv)
+    query_lists = refinement_query_lists(args.requests)
+    if not query_lists:
+        raise ValueError("No query lists found (the refinement cache, the RAG log and the sample queries are empty).")
+    preload_retrieval_modules()
+    retriever = open_collection()
+    retriever.embedder([text for texts in query_lists for text in texts]) # Embedded once; both modes then hit the embedding cache
+
+    def retrieve(texts, lazy):
+        merged = {}
+        started = time.perf_counter()
+        results = query_collection(retriever, texts, lazy=lazy)
+        merge_query_results(merged, results, texts)
+        top_results = rank_results(merged)
+        chunks, size = fetch_documents(retriever, [top_results]) if lazy else (0, 0)
+        elapsed = time.perf_counter() - started
+        if not lazy:
+            rows = [(document, metadata) for documents, metadatas in zip(results['documents'], results['metadatas'])
+                    for document, metadata in zip(documents, metadatas) if document is not None]
+            chunks, size = len(rows), sum(len(document.encode('utf-8')) + len(json.dumps(metadata or {})) for document, metadata in rows)
+        return elapsed, chunks, size, [res['id'] for res in top_results]
+
+    modes = {'eager': {'seconds': [], 'chunks': [], 'bytes': []}, 'lazy': {'seconds': [], 'chunks': [], 'bytes': []}}
+    same_results = 0
+    for texts in query_lists:
+        retrieve(texts, lazy=False) # Warm
+        last = {}
+        for _ in range(max(1, args.repeat)):
+            for mode in ('eager', 'lazy'):
+                elapsed, *last[mode] = retrieve(texts, lazy=mode == 'lazy')
+                modes[mode]['seconds'].append(elapsed)
+        for mode, (chunks, size, _) in last.items():
+            modes[mode]['chunks'].append(chunks)
+            modes[mode]['bytes'].append(size)
+        same_results += last['eager'][2] == last['lazy'][2]
+
+    summary = {mode: {'latency': latency_summary(values['seconds']),
+                      'mean_chunks': round(sum(values['chunks']) / len(values['chunks']), 1),
+                      'mean_kb': round(sum(values['bytes']) / len(values['bytes']) / 1024, 1)} for mode, values in modes.items()}
+    eager, lazy = summary['eager'], summary['lazy']
+    lines = [f"--- Lazy Document Fetch ({len(query_lists)} requests, {num_results_per_query} results per query, "
+             f"top {final_num_results} kept) ---",
+             f"  {'mode':<6} {'p50 ms':>8} {'p95 ms':>8} {'chunks':>7} {'KB':>8}"]
+    for mode, row in summary.items():
+        lines.append(f"  {mode:<6} {row['latency']['p50_ms']:>8.2f} {row['latency']['p95_ms']:>8.2f} "
+                     f"{row['mean_chunks']:>7.1f} {row['mean_kb']:>8.1f}")
+    lines.append(f"  Saved per request: {eager['mean_kb'] - lazy['mean_kb']:.1f} KB, "
+                 f"{eager['latency']['p50_ms'] - lazy['latency']['p50_ms']:.2f} ms at p50. "
+                 f"Same final results: {same_results}/{len(query_lists)} requests.")
+    emit_report(lines, {'requests': len(query_lists), 'summary': summary, 'same_results': same_results}, args.output)
+    return 0
+
+# --- Main Script Logic ---
+# Subcommands take the place of the query: `generate_rag_prompt.py warmup [options]`
+SUBCOMMANDS = {'warmup': run_warmup_command,
+               'export-onnx': run_export_onnx_command,
+               'benchmark-backends': run_backend_benchmark_command,
+               'benchmark-backend': run_backend_probe_command,
+               'build-truncated': run_build_truncated_command,
+               'benchmark-matryoshka': run_matryoshka_benchmark_command,
+               'train-projection': run_train_projection_command,
+               'benchmark-bucketing': run_bucketing_benchmark_command,
+               'tune-threads': run_tune_threads_command,
+               'migrate-model': run_migrate_model_command,
+               'switch-model': run_switch_model_command,
+               'index-purposes': run_index_purposes_command,
+               'similar-requests': run_similar_requests_command,
+               'benchmark-embedding': run_embedding_benchmark_command,
+               'benchmark-embedding-probe': run_embedding_probe_command,
+               'export-flat-index': run_export_flat_index_command,
+               'benchmark-binary': run_binary_benchmark_command,
+               'export-snapshot': run_export_snapshot_command,
+               'import-snapshot': run_import_snapshot_command,
+               'benchmark-lazy-fetch': run_lazy_fetch_benchmark_command}
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        try:
+            exit_code = SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        except Exception as e: log_error(f"Error running '{sys.argv[1]}': {e}"); exit_code = 1
+        if logging: logging.info(f"--- Python RAG '{sys.argv[1]}' Finished ---")
+        sys.exit(exit_code)
+
+    # --- 0. Argument Parsing ---
+    parser = argparse.ArgumentParser(description='Generate an LLM prompt for a Revit API query using Gemini refinement and RAG.')
+    parser.add_argument('query', type=str, nargs='?', help='The user query/question for the Revit API.')
+    parser.add_argument('--serve', action='store_true',
+                        help='Run as a long-lived worker: keep the model and collection loaded and answer '
+                             'newline-delimited JSON requests ({"id": ..., "query": ...}) from stdin on stdout.')
+    parser.add_argument('--listen', metavar='ADDRESS', nargs='?', const=service_address, default=None,
+                        help=f'Run as a host-wide service: keep the model and collection loaded and answer the --serve '
+                             f'protocol for many concurrent clients on a TCP ("host:port") or Unix ("unix:/path") socket '
+                             f'(default address: {service_address}).')
+    parser.add_argument('--batch-window-ms', type=float, default=embedding_batch_window_ms,
+                        help=f'--listen: milliseconds to gather concurrent query embeddings into one model call '
+                             f'(default: {embedding_batch_window_ms:g}).')
+    parser.add_argument('--max-embed-batch', type=int, default=embedding_max_batch_size,
+                        help=f'--listen: maximum texts per coalesced embedding call (default: {embedding_max_batch_size}).')
+    parser.add_argument('--refine-budget', type=float, default=None,
+                        help=f'Seconds to wait for Gemini refinement before answering with original-query results '
+                             f'(default: {refinement_budget_seconds}).')
+    parser.add_argument('--batch', metavar='REQUESTS_JSONL', default=None,
+                        help='Generate prompts for every request in a JSONL file ("-" for stdin) and write them as JSONL, '
+                             'then exit. Lines are JSON strings or objects with "query" (or "body"/"title") and "id".')
+    parser.add_argument('--batch-output', metavar='PROMPTS_JSONL', default=None,
+                        help='Output file for --batch (default: stdout).')
+    parser.add_argument('--batch-size', type=int, default=batch_size,
+                        help=f'Requests embedded and queried together in --batch mode (default: {batch_size}).')
+    parser.add_argument('--refine-concurrency', type=int, default=batch_refine_concurrency,
+                        help=f'Concurrent Gemini refinement calls in --batch mode (default: {batch_refine_concurrency}).')
+    parser.add_argument('--warm-embedding-cache', action='store_true',
+                        help='Embed all queries found in the refinement cache and the RAG log into the query-embedding cache, then exit.')
+    parser.add_argument('--embedding-backend', choices=('torch',) + ONNX_BACKENDS, default=embedding_backend,
+                        help=f'Query embedding backend (default: {embedding_backend}); the ONNX backends need export-onnx first.')
+    parser.add_argument('--embedding-dimensions', type=int, default=embedding_dimensions,
+                        help='Matryoshka mode: truncate query embeddings to this many dimensions and query the matching '
+                             'collection built by build-truncated (default: full width).')
+    parser.add_argument('--shared-weights', action='store_true', default=shared_model_weights,
+                        help='Map the embedding model weights from a file shared by every RAG process on this host '
+                             '(written on first use) instead of loading a private copy.')
+    parser.add_argument('--query-encoder', choices=('full', 'projected'), default=query_encoder,
+                        help=f"Query encoder (default: {query_encoder}); 'projected' needs train-projection first.")
+    parser.add_argument('--retrieval-backend', choices=('chroma',) + FLAT_BACKENDS, default=retrieval_backend,
+                        help=f"Vector search backend (default: {retrieval_backend}); 'flat' and 'binary' need export-flat-index first.")
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not read or write the on-disk caches for this run.')
+    parser.add_argument('--startup-report', action='store_true',
+                        help='Print a wall-clock breakdown of interpreter start, each heavy import, model load '
+                             'and collection open to stderr.')
+
+    original_query_text = None
+    retriever = None
+    google_api_key = None
+
+    try:
+        args = parser.parse_args()
+        if args.no_cache: cache_enabled = False
+        embedding_backend = args.embedding_backend
+        embedding_dimensions = args.embedding_dimensions or None
+        query_encoder = args.query_encoder
+        retrieval_backend = args.retrieval_backend
+        shared_model_weights = args.shared_weights
+        embedding_batch_window_ms = max(0.0, args.batch_window_ms)
+        embedding_max_batch_size = max(1, args.max_embed_batch)
+        if not args.serve and not args.listen and not args.warm_embedding_cache and not args.batch:
+            original_query_text = args.query
+            log_debug(f"Received original query: {original_query_text}")
+            if not original_query_text or not original_query_text.strip():
+                 log_error("Original query text cannot be empty."); sys.exit(1)
+        if args.batch and not os.path.isfile(args.batch): # Before the model and collection are loaded for nothing
+            log_error(f"Batch requests file not found: {os.path.abspath(args.batch)}"); sys.exit(1)
+
+        # --- Check for Google API Key ---
+        google_api_key = os.environ.get("GOOGLE_API_KEY")
+        if not google_api_key:
+            # Log as warning, not error, as script can fallback
+            log_debug("Warning: GOOGLE_API_KEY environment variable not set. Will fallback to using original query for retrieval.")
+        else:
+            log_debug("GOOGLE_API_KEY found. Gemini refinement will be attempted.")
+
+        # Before any cache key or index name: they depend on the active pair's model and collection. A single query
+        # reads only the pointer's copy here, so the Gemini refinement does not wait for chromadb; without a copy,
+        # opening the collection resolves the pair after refinement has started
+        if resolve_active_pair(mirror_only=original_query_text is not None) is None:
+            log_debug(f"No copy of the active pair at {active_pair_mirror_path} yet; it is read when the collection is opened.")
+        if retrieval_backend in FLAT_BACKENDS:
+            log_debug(f"Using flat index: {os.path.abspath(flat_index_path())}")
+        else:
+            log_debug(f"Using ChromaDB path: {os.path.abspath(persist_directory)}")
+        log_debug(f"Using collection: {active_collection_name()}")
+        log_debug(f"Using embedding model for queries: {model_name} via Chroma EF ({embedding_backend} backend)")
+        log_debug(f"Retrieving {num_results_per_query} results per refined query, aiming for {final_num_results} final results.")
+
+    except Exception as e: log_error(f"Error during initial setup or argument parsing: {e}"); sys.exit(1)
+
+    # --- 1. Embedding-Cache Warm-Up: embed historical queries and exit ---
+    if args.warm_embedding_cache:
+        try:
+            warm_embedding_cache()
+        except Exception as e: log_error(f"Error warming the query-embedding cache: {e}"); sys.exit(1)
+        if args.startup_report: print_startup_report(startup_timer)
+        sys.exit(0)
+
+    # --- 1a. Batch Mode: load everything up front, then stream requests from the JSONL file ---
+    if args.batch:
+        try:
+            preload_retrieval_modules()
+            retriever = open_collection()
+        except Exception as e: log_error(f"Error accessing ChromaDB collection '{active_collection_name()}': {e}"); sys.exit(1)
+        try:
+            batch_started = time.perf_counter()
+            output_stream = open(args.batch_output, 'w', encoding='utf-8') if args.batch_output else sys.stdout
+            try:
+                counters = generate_prompts_batch(read_batch_requests(args.batch), google_api_key, retriever, output_stream,
+                                                  size=max(1, args.batch_size), refine_concurrency=max(1, args.refine_concurrency),
+                                                  refine_timeout=args.refine_budget)
+            finally:
+                if output_stream is not sys.stdout: output_stream.close()
+            elapsed = time.perf_counter() - batch_started
+            log_debug(f"[batch] Finished {counters['requests']} request(s) in {elapsed:.2f}s "
+                      f"({elapsed / max(1, counters['requests']):.3f}s per request): {counters}")
+        except Exception as e: log_error(f"Error in batch mode: {e}"); sys.exit(1)
+        if args.startup_report: print_startup_report(startup_timer)
+        if logging: logging.info("--- Python RAG Batch Finished ---")
+        sys.exit(1 if counters['failed'] else 0)
+
+    # --- 1b. Serve Mode: load everything up front, then answer requests until stdin closes (or on a socket) ---
+    if args.listen:
+        try:
+            preload_retrieval_modules()
+            retriever = open_collection(coalesce=True)
+        except Exception as e: log_error(f"Error accessing ChromaDB collection '{active_collection_name()}': {e}"); sys.exit(1)
+        log_debug(f"[listen] Service {os.getpid()} memory after load (shared weights: {shared_model_weights}): {process_memory()}")
+        if args.startup_report: print_startup_report(startup_timer)
+        try:
+            run_socket_service(retriever, google_api_key, args.listen, startup_timings=startup_timer.timings,
+                               default_refine_budget=args.refine_budget)
+        except Exception as e: log_error(f"Error running the RAG service on {args.listen}: {e}"); sys.exit(1)
+        if logging: logging.info("--- Python RAG Service Finished ---")
+        sys.exit(0)
+    if args.serve:
+        try:
+            preload_retrieval_modules()
+            retriever = open_collection()
+        except Exception as e: log_error(f"Error accessing ChromaDB collection '{active_collection_name()}': {e}"); sys.exit(1)
+        log_debug(f"[serve] Worker {os.getpid()} memory after load (shared weights: {shared_model_weights}): {process_memory()}")
+        if args.startup_report: print_startup_report(startup_timer)
+        serve_requests(retriever, google_api_key, startup_timings=startup_timer.timings,
+                       default_refine_budget=args.refine_budget)
+        if logging: logging.info("--- Python RAG Worker Finished ---")
+        sys.exit(0)
+
+    # --- 1c. Single Query: load the retrieval stack (imports, model, collection) on demand ---
+    # --- generate_prompt asks for it once the Gemini refinement round-trip is in flight ---
+    def get_retriever():
+        try:
+            return load_retrieval_branch()
+        except Exception as e: log_error(f"Error accessing ChromaDB collection '{active_collection_name()}': {e}"); sys.exit(1)
+
+    try:
+        prompt_for_llm, stage_timings = generate_prompt(original_query_text, google_api_key, get_retriever, timer=startup_timer,
+                                                         refine_budget=args.refine_budget)
+    except Exception as e:
+        log_error(f"Error generating the prompt: {e}"); sys.exit(1)
+    log_debug(f"Branch timings (s): refine={stage_timings.get('refine', 0.0):.3f} | "
+              f"retrieval init={stage_timings.get('branch: retrieval init', 0.0):.3f} | "
+              f"prompt cache lookup={stage_timings.get('prompt cache lookup', 0.0):.3f}")
+    if args.startup_report: print_startup_report(startup_timer)
+
+    # --- 3. Output the Final Prompt ---
     print(prompt_for_llm) # Print to stdout for the C# wrapper
     log_debug("Successfully generated and printed final LLM prompt to stdout.")
     if logging: logging.info("--- Python RAG Script Finished Successfully ---")
@@ -402,4 +3196,4 @@ PYTHON SCRIPT:
 # Note: sys.exit() terminates the script, so this might not always execute in practice
 # depending on where the exit occurs, but it's good practice conceptually.
 if logging: logging.error("--- Python RAG Script Exited with Error ---")
-# The sys.exit(1) call already happened if there was an error needing termination.
\ No newline at end of file
+# The sys.exit(1) call already happened if there was an error needing termination.
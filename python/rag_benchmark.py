@@ -0,0 +1,88 @@
+"""
+Measurement helpers for the benchmark subcommands of generate_rag_prompt.py.
+
+Stdlib only; psutil is used when installed. Like rag_cache, this module never logs.
+"""
+import os
+import sys
+
+# --- Process Memory ---
+def process_memory():
+    """
+    Returns {'rss_mb', 'peak_rss_mb', 'pss_mb', 'private_mb'} for this process (values are None when unavailable).
+    PSS charges each shared page (e.g. memory-mapped model weights) 1/n to each of the n processes mapping it;
+    private is memory no other process shares (USS; private bytes on Windows, where there is no PSS).
+    Uses psutil when installed, otherwise GetProcessMemoryInfo on Windows or getrusage/procfs elsewhere.
+    """
+    rss = peak = pss = private = None
+    try:
+        import psutil # Optional dependency
+        info = psutil.Process().memory_info()
+        rss = info.rss
+        peak = getattr(info, 'peak_wset', None) # Windows only
+        private = getattr(info, 'private', None) # Windows only
+    except Exception:
+        pass
+    if sys.platform == 'win32' and (rss is None or peak is None):
+        try:
+            import ctypes
+            from ctypes import wintypes
+            class PROCESS_MEMORY_COUNTERS_EX(ctypes.Structure):
+                _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                            ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                            ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                            ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                            ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t),
+                            ('PrivateUsage', ctypes.c_size_t)]
+            counters = PROCESS_MEMORY_COUNTERS_EX()
+            counters.cb = ctypes.sizeof(counters)
+            psapi = ctypes.WinDLL('psapi')
+            if psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+                rss, peak, private = counters.WorkingSetSize, counters.PeakWorkingSetSize, counters.PrivateUsage
+        except Exception:
+            pass
+    elif sys.platform != 'win32':
+        try:
+            import resource
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            peak = max_rss if sys.platform == 'darwin' else max_rss * 1024 # bytes on macOS, KiB on Linux
+        except Exception:
+            pass
+        if rss is None and os.path.exists('/proc/self/statm'):
+            with open('/proc/self/statm') as f:
+                rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        try:
+            with open('/proc/self/smaps_rollup') as f: # Linux 4.14+; first line is the address range
+                fields = dict(line.split()[:2] for line in f if line.rstrip().endswith(' kB'))
+            pss = int(fields['Pss:']) * 1024
+            private = (int(fields['Private_Clean:']) + int(fields['Private_Dirty:'])) * 1024
+        except (OSError, KeyError, ValueError):
+            pass
+    to_mb = lambda value: round(value / 2**20, 1) if value is not None else None
+    return {'rss_mb': to_mb(rss), 'peak_rss_mb': to_mb(peak), 'pss_mb': to_mb(pss), 'private_mb': to_mb(private)}
+
+# --- Latency and Agreement ---
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[int(round(q * (len(sorted_values) - 1)))]
+
+def latency_summary(seconds):
+    """
+    Summarizes a list of durations (seconds) as milliseconds: count, mean, p50, p95, max.
+    """
+    values = sorted(seconds)
+    to_ms = lambda value: round(value * 1000.0, 2) if value is not None else None
+    return {'count': len(values),
+            'mean_ms': to_ms(sum(values) / len(values)) if values else None,
+            'p50_ms': to_ms(percentile(values, 0.5)),
+            'p95_ms': to_ms(percentile(values, 0.95)),
+            'max_ms': to_ms(values[-1]) if values else None}
+
+def top_k_overlap(reference_ids, candidate_ids):
+    """
+    Mean |reference ∩ candidate| / |reference| over queries (1.0 = identical top-k sets).
+    """
+    overlaps = [len(set(reference) & set(candidate)) / len(reference)
+                for reference, candidate in zip(reference_ids, candidate_ids) if reference]
+    return round(sum(overlaps) / len(overlaps), 4) if overlaps else None
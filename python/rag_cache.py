@@ -0,0 +1,304 @@
+"""
+On-disk caches used by generate_rag_prompt.py.
+
+The caches are plain SQLite files (WAL mode + busy timeout) so several Revit sessions / RAG
+processes on the same machine can share them safely. They never log; callers decide what to report.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+# --- Query Normalization ---
+# British -> American spellings that commonly appear in Revit requests ("colour floors by area")
+_SPELLING_VARIANTS = {
+    'colour': 'color', 'colours': 'colors', 'coloured': 'colored', 'colouring': 'coloring',
+    'centre': 'center', 'centres': 'centers', 'centred': 'centered',
+    'metre': 'meter', 'metres': 'meters', 'millimetre': 'millimeter', 'millimetres': 'millimeters',
+    'grey': 'gray', 'greyed': 'grayed',
+    'analyse': 'analyze', 'analysed': 'analyzed', 'organise': 'organize', 'organised': 'organized',
+    'optimise': 'optimize', 'visualise': 'visualize', 'summarise': 'summarize',
+}
+_WORD_PATTERN = re.compile(r"[a-z]+")
+
+def normalize_query_text(text):
+    """
+    Normalizes a query for cache lookups: Unicode NFKC, case-folded, whitespace collapsed,
+    trailing punctuation dropped and British spellings mapped to American ones.
+    """
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    text = " ".join(text.split()).rstrip(" .?!")
+    return _WORD_PATTERN.sub(lambda m: _SPELLING_VARIANTS.get(m.group(0), m.group(0)), text)
+
+def normalize_embedding_text(text):
+    """
+    Lighter normalization for embedding-cache keys: NFKC and collapsed whitespace only.
+    Case is kept because the embedding model is case-sensitive (e.g. "Wall" vs "wall").
+    """
+    return " ".join(unicodedata.normalize('NFKC', text or '').split())
+
+def text_hash(*parts):
+    """
+    Stable SHA-256 hex digest of the given strings (joined with a NUL separator).
+    """
+    return hashlib.sha256("\0".join(parts).encode('utf-8')).hexdigest()
+
+# --- Shared SQLite Plumbing ---
+class _SqliteStore:
+    """
+    Base for stores kept in the shared SQLite cache file: one WAL-mode connection per process,
+    guarded by a lock for the threads of that process, plus hit/miss counters per store name.
+    """
+    def __init__(self, db_path, stats_name):
+        self.db_path = db_path
+        self.stats_name = stats_name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS cache_stats ("
+                               "name TEXT PRIMARY KEY, hits INTEGER NOT NULL DEFAULT 0, misses INTEGER NOT NULL DEFAULT 0)")
+
+    def lifetime_counters(self):
+        """
+        Returns (hits, misses) accumulated in the cache file across all processes.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT hits, misses FROM cache_stats WHERE name = ?", (self.stats_name,)).fetchone()
+        return row if row else (0, 0)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _record(self, hits=0, misses=0):
+        # Caller holds self._lock
+        self.hits += hits
+        self.misses += misses
+        if hits or misses:
+            self._conn.execute("INSERT INTO cache_stats (name, hits, misses) VALUES (?, ?, ?) "
+                               "ON CONFLICT(name) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses",
+                               (self.stats_name, hits, misses))
+
+# --- SQLite Key/Value Cache ---
+class SqliteCache(_SqliteStore):
+    """
+    JSON value cache stored in one table of a shared SQLite file.
+
+    Entries expire after `ttl_seconds` (None = never) and the least recently used entries are
+    evicted once the table holds more than `max_entries`. Hit/miss counters are kept both for
+    this process (`hits`, `misses`) and for the lifetime of the file (`lifetime_counters()`).
+    """
+    def __init__(self, db_path, table, ttl_seconds=None, max_entries=None):
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", table):
+            raise ValueError(f"Invalid cache table name: {table!r}")
+        super().__init__(db_path, stats_name=table)
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        with self._lock:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ("
+                               "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                               "created REAL NOT NULL, last_access REAL NOT NULL)")
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_access ON {table}(last_access)")
+
+    def get(self, key):
+        """
+        Returns the cached value for `key`, or None on a miss (expired entries count as misses).
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self._record(misses=1)
+                return None
+            self._conn.execute(f"UPDATE {self.table} SET last_access = ? WHERE key = ?", (now, key))
+            self._record(hits=1)
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """
+        Stores a JSON-serializable value and evicts expired / least recently used entries.
+        """
+        now = time.time()
+        payload = json.dumps(value)
+        with self._lock:
+            self._conn.execute(f"INSERT OR REPLACE INTO {self.table} (key, value, created, last_access) VALUES (?, ?, ?, ?)",
+                               (key, payload, now, now))
+            self._evict(now)
+
+    def values(self):
+        """
+        Returns every unexpired cached value (used to warm other caches from past requests).
+        """
+        with self._lock:
+            rows = self._conn.execute(f"SELECT value, created FROM {self.table}").fetchall()
+        now = time.time()
+        return [json.loads(value) for value, created in rows
+                if self.ttl_seconds is None or now - created <= self.ttl_seconds]
+
+    def _evict(self, now):
+        if self.ttl_seconds is not None:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE created < ?", (now - self.ttl_seconds,))
+        if self.max_entries is not None:
+            count = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key IN ("
+                                   f"SELECT key FROM {self.table} ORDER BY last_access ASC LIMIT ?)",
+                                   (count - self.max_entries,))
+
+# --- Memory-Mapped Query-Embedding Cache ---
+class EmbeddingCache(_SqliteStore):
+    """
+    Content-addressed cache of query embeddings for one embedding model.
+
+    Vectors are stored as rows of a memory-mapped float16 matrix (`<matrix_path>_<model tag>.f16`,
+    with a small JSON header describing its shape); the (model, text hash) -> row index lives in the
+    shared SQLite file. Once all `capacity` rows are used, the least recently used row is reused.
+    Lookups and inserts take numpy arrays; numpy is imported on first use.
+
+    The matrix is not part of the SQLite transaction, so each row also has a check word (`.keys` file,
+    derived from the text hash; 0 = not valid) that is cleared while the row is rewritten. A lookup only
+    returns a row whose check word matches its key before and after the copy: a row reused by another
+    process for a different text, or left behind by a rolled-back insert, is a miss.
+    """
+    def __init__(self, db_path, matrix_path, model_name, capacity):
+        self.model_tag = text_hash(model_name)[:16]
+        super().__init__(db_path, stats_name=f"embeddings_{self.model_tag}")
+        base, _ = os.path.splitext(matrix_path)
+        self.matrix_path = f"{base}_{self.model_tag}.f16"
+        self.header_path = self.matrix_path + ".json"
+        self.checks_path = self.matrix_path + ".keys"
+        self.model_name = model_name
+        self.capacity = capacity
+        self._matrix = None
+        self._checks = None
+        with self._lock:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS embedding_slots ("
+                               "model TEXT NOT NULL, key TEXT NOT NULL, slot INTEGER NOT NULL, last_access REAL NOT NULL, "
+                               "PRIMARY KEY (model, key), UNIQUE (model, slot))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS embedding_slots_lru ON embedding_slots(model, last_access)")
+
+    @staticmethod
+    def key_for(text):
+        return text_hash(normalize_embedding_text(text))
+
+    @staticmethod
+    def key_check(key):
+        # Check word stored next to the row of `key`; never 0, which marks a row as not valid
+        return int(key[:16], 16) or 1
+
+    def get_many(self, texts):
+        """
+        Returns {text: float32 vector} for the texts that are cached; missing texts are simply absent.
+        """
+        import numpy as np
+        keys = {self.key_for(t): t for t in texts}
+        found = {}
+        with self._lock:
+            matrix = self._open_matrix()
+            if matrix is not None and keys:
+                placeholders = ",".join("?" * len(keys))
+                rows = self._conn.execute(f"SELECT key, slot FROM embedding_slots WHERE model = ? AND key IN ({placeholders})",
+                                          (self.model_tag, *keys)).fetchall()
+                now = time.time()
+                used = []
+                for key, slot in rows:
+                    check = self.key_check(key)
+                    if self._checks[slot] != check:
+                        continue # Reused for another text since the mapping was read, or its insert was rolled back
+                    vector = np.array(matrix[slot], dtype=np.float32)
+                    if self._checks[slot] == check: # Not rewritten during the copy
+                        found[keys[key]] = vector
+                        used.append(key)
+                self._conn.executemany("UPDATE embedding_slots SET last_access = ? WHERE model = ? AND key = ?",
+                                       [(now, self.model_tag, key) for key in used])
+            self._record(hits=len(found), misses=len(set(texts)) - len(found))
+        return found
+
+    def put_many(self, texts, vectors):
+        """
+        Stores one vector per text, reusing least recently used rows once the matrix is full.
+        Rows written before a failure are marked not valid, since rolling back restores their old mapping only.
+        """
+        import numpy as np
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) != len(texts):
+            raise ValueError("Expected one embedding vector per text.")
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE") # Serializes row allocation across processes
+            written = []
+            try:
+                matrix = self._open_matrix(create_dim=vectors.shape[1])
+                if matrix.shape[1] != vectors.shape[1]:
+                    raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match cache matrix {matrix.shape[1]}.")
+                now = time.time()
+                for text, vector in zip(texts, vectors):
+                    key = self.key_for(text)
+                    row = self._conn.execute("SELECT slot FROM embedding_slots WHERE model = ? AND key = ?",
+                                             (self.model_tag, key)).fetchone()
+                    if row is not None:
+                        slot = row[0]
+                    else:
+                        used = self._conn.execute("SELECT COUNT(*) FROM embedding_slots WHERE model = ?",
+                                                  (self.model_tag,)).fetchone()[0]
+                        if used < matrix.shape[0]:
+                            slot = used # Rows are only ever reused, never freed, so used rows are 0..used-1
+                        else:
+                            slot, old_key = self._conn.execute(
+                                "SELECT slot, key FROM embedding_slots WHERE model = ? ORDER BY last_access ASC LIMIT 1",
+                                (self.model_tag,)).fetchone()
+                            self._conn.execute("DELETE FROM embedding_slots WHERE model = ? AND key = ?", (self.model_tag, old_key))
+                    self._checks[slot] = 0 # Readers of the row's old text miss from here on
+                    written.append(slot)
+                    matrix[slot] = vector.astype(np.float16)
+                    self._checks[slot] = self.key_check(key)
+                    self._conn.execute("INSERT OR REPLACE INTO embedding_slots (model, key, slot, last_access) VALUES (?, ?, ?, ?)",
+                                       (self.model_tag, key, slot, now))
+                matrix.flush()
+                self._checks.flush()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                for slot in written:
+                    self._checks[slot] = 0
+                if self._checks is not None:
+                    self._checks.flush()
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def size(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embedding_slots WHERE model = ?", (self.model_tag,)).fetchone()[0]
+
+    def _open_matrix(self, create_dim=None):
+        # Caller holds self._lock. Returns None if no matrix exists yet and create_dim is not given.
+        if self._matrix is not None:
+            return self._matrix
+        import numpy as np
+        header = None
+        if os.path.exists(self.header_path) and os.path.exists(self.matrix_path) and os.path.exists(self.checks_path):
+            with open(self.header_path, 'r', encoding='utf-8') as f:
+                header = json.load(f)
+        if header is not None and header.get('key_checks') == 'uint64':
+            self._checks = np.memmap(self.checks_path, dtype=np.uint64, mode='r+', shape=(header['capacity'],))
+            self._matrix = np.memmap(self.matrix_path, dtype=np.float16, mode='r+',
+                                     shape=(header['capacity'], header['dim']))
+        elif create_dim is not None: # No matrix yet, or one written without check words
+            self._checks = np.memmap(self.checks_path, dtype=np.uint64, mode='w+', shape=(self.capacity,))
+            self._matrix = np.memmap(self.matrix_path, dtype=np.float16, mode='w+', shape=(self.capacity, create_dim))
+            self._conn.execute("DELETE FROM embedding_slots WHERE model = ?", (self.model_tag,)) # Stale rows from a deleted matrix
+            with open(self.header_path, 'w', encoding='utf-8') as f:
+                json.dump({'model': self.model_name, 'dim': create_dim, 'capacity': self.capacity, 'dtype': 'float16',
+                           'key_checks': 'uint64'}, f)
+        return self._matrix
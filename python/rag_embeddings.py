@@ -0,0 +1,600 @@
+"""
+Embedding helpers used by generate_rag_prompt.py.
+
+Like rag_cache, this module never logs; callers decide what to report. Heavy dependencies
+(torch, onnxruntime, tokenizers, numpy) are imported inside the functions that need them.
+"""
+import inspect
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future
+
+# --- Histograms ---
+class Histogram:
+    """
+    Fixed-bucket histogram: a value lands in the first bucket whose upper bound it does not exceed.
+    """
+    def __init__(self, bounds, unit=''):
+        self.bounds = list(bounds)
+        self.unit = unit
+        self.counts = [0] * (len(self.bounds) + 1) # Last bucket: above the largest bound
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def add(self, value):
+        index = next((i for i, bound in enumerate(self.bounds) if value <= bound), len(self.bounds))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+
+    def as_dict(self):
+        labels = [f"<={bound}{self.unit}" for bound in self.bounds] + [f">{self.bounds[-1]}{self.unit}"]
+        return {'count': self.count,
+                'mean': round(self.total / self.count, 3) if self.count else None,
+                'max': round(self.max, 3) if self.max is not None else None,
+                'buckets': {label: n for label, n in zip(labels, self.counts) if n}}
+
+# --- Micro-Batching Coalescer ---
+class EmbeddingCoalescer:
+    """
+    Callable stand-in for an embedding function that is shared by concurrent requests.
+
+    Texts submitted from several threads are gathered for up to `window_seconds` after the first one
+    arrives (or until `max_batch_size` texts are waiting), embedded in ONE call of `embed_batch`, and the
+    vectors are scattered back to the callers. Duplicate texts within a batch are embedded once.
+    `histograms()` reports the batch sizes and the time requests spent queued.
+    """
+    def __init__(self, embed_batch, window_seconds=0.005, max_batch_size=64):
+        self.embed_batch = embed_batch
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self._pending = [] # (texts, future, enqueue time)
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self.batch_sizes = Histogram([1, 2, 4, 8, 16, 32, 64, 128], unit=' texts')
+        self.queue_waits = Histogram([0.5, 1, 2, 5, 10, 20, 50, 100], unit=' ms')
+        self.requests_per_batch = Histogram([1, 2, 4, 8, 16], unit=' requests')
+
+    def __call__(self, texts):
+        texts = list(texts)
+        if not texts:
+            return []
+        future = Future()
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='embedding-coalescer', daemon=True)
+                self._thread.start()
+            self._pending.append((texts, future, time.perf_counter()))
+            self._condition.notify()
+        return future.result()
+
+    def histograms(self):
+        with self._stats_lock:
+            return {'batch_size': self.batch_sizes.as_dict(),
+                    'requests_per_batch': self.requests_per_batch.as_dict(),
+                    'queue_wait': self.queue_waits.as_dict()}
+
+    def _take_batch(self):
+        # Blocks for the first request, then gathers more until the window closes or the batch is full
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            deadline = self._pending[0][2] + self.window_seconds
+            while sum(len(texts) for texts, _, _ in self._pending) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch, size = [], 0
+            while self._pending and (not batch or size + len(self._pending[0][0]) <= self.max_batch_size):
+                batch.append(self._pending.pop(0))
+                size += len(batch[-1][0])
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            started = time.perf_counter()
+            unique_texts = list(dict.fromkeys(text for texts, _, _ in batch for text in texts))
+            try:
+                vectors = dict(zip(unique_texts, self.embed_batch(unique_texts)))
+            except BaseException as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            with self._stats_lock:
+                self.batch_sizes.add(len(unique_texts))
+                self.requests_per_batch.add(len(batch))
+                for _, _, enqueued in batch:
+                    self.queue_waits.add((started - enqueued) * 1000.0)
+            for texts, future, _ in batch:
+                future.set_result([vectors[text] for text in texts])
+
+# --- Matryoshka Truncation ---
+def truncate_embeddings(vectors, dims):
+    """
+    Matryoshka truncation: keeps the first `dims` components of each vector and re-normalizes to unit length.
+    Returns a float32 numpy matrix.
+    """
+    import numpy as np
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if matrix.ndim != 2 or matrix.shape[1] < dims:
+        raise ValueError(f"Cannot truncate embeddings of shape {matrix.shape} to {dims} dimensions.")
+    matrix = matrix[:, :dims]
+    return matrix / np.clip(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12, None)
+
+class TruncatedEmbeddingFunction:
+    """
+    Wraps an embedding function so its vectors are Matryoshka-truncated to `dims` (see truncate_embeddings).
+    """
+    def __init__(self, embedding_function, dims):
+        self.embedding_function = embedding_function
+        self.dims = dims
+
+    def __call__(self, input):
+        texts = list(input)
+        return list(truncate_embeddings(self.embedding_function(texts), self.dims)) if texts else []
+
+# --- Length Bucketing ---
+def token_length_functions(embedding_function):
+    """
+    Returns (count_tokens(texts) -> list of token counts, set_max_tokens(n)) for a Chroma SentenceTransformer
+    or OnnxEmbeddingFunction, or None if the function exposes no tokenizer. Counts include special tokens
+    and respect the current truncation length.
+    """
+    tokenizer = getattr(embedding_function, 'tokenizer', None)
+    if tokenizer is not None and hasattr(tokenizer, 'encode_batch'): # tokenizers.Tokenizer (ONNX backends)
+        def count_tokens(texts):
+            return [sum(encoding.attention_mask) for encoding in tokenizer.encode_batch(list(texts))]
+        def set_max_tokens(max_tokens):
+            tokenizer.enable_truncation(max_length=max_tokens)
+        return count_tokens, set_max_tokens
+    model = getattr(embedding_function, '_model', None)
+    if model is not None and getattr(model, 'tokenizer', None) is not None: # SentenceTransformer
+        def count_tokens(texts):
+            encoded = model.tokenizer(list(texts), truncation=True, max_length=model.max_seq_length)
+            return [len(ids) for ids in encoded['input_ids']]
+        def set_max_tokens(max_tokens):
+            model.max_seq_length = max_tokens
+        return count_tokens, set_max_tokens
+    return None
+
+def length_buckets(lengths, bounds):
+    """
+    Groups indices by token length: bucket i holds lengths <= bounds[i] (and above bounds[i-1]); lengths above
+    the last bound share a final bucket. Returns the non-empty buckets, shortest first.
+    """
+    groups = [[] for _ in range(len(bounds) + 1)]
+    for index, length in enumerate(lengths):
+        groups[next((i for i, bound in enumerate(bounds) if length <= bound), len(bounds))].append(index)
+    return [group for group in groups if group]
+
+def padded_token_count(lengths, groups):
+    # Tokens the model processes when each group is padded to its longest member
+    return sum(len(group) * max(lengths[i] for i in group) for group in groups)
+
+class LengthBucketedEmbeddingFunction:
+    """
+    Wraps a model's embedding function so one call pads less: texts are truncated to `max_tokens`, grouped
+    into token-length buckets (see length_buckets) and each bucket is embedded as its own batch, so a short
+    query is not padded to the length of a long one. Vectors come back in input order.
+    Functions without a tokenizer are called unchanged. `tokens` / `padded_tokens` count the work done.
+    """
+    def __init__(self, embedding_function, bounds=(16, 32, 64), max_tokens=None):
+        self.embedding_function = embedding_function
+        self.bounds = sorted(bounds)
+        self.max_tokens = max_tokens
+        self.tokens = 0
+        self.padded_tokens = 0
+        functions = token_length_functions(embedding_function)
+        self.count_tokens = functions[0] if functions else None
+        if functions and max_tokens:
+            functions[1](max_tokens)
+
+    def __call__(self, input):
+        texts = list(input)
+        if not texts or self.count_tokens is None:
+            return self.embedding_function(texts) if texts else []
+        lengths = self.count_tokens(texts)
+        groups = length_buckets(lengths, self.bounds) if len(texts) > 1 else [[0]]
+        self.tokens += sum(lengths)
+        self.padded_tokens += padded_token_count(lengths, groups)
+        if len(groups) == 1:
+            return list(self.embedding_function(texts))
+        vectors = [None] * len(texts)
+        for group in groups:
+            for index, vector in zip(group, self.embedding_function([texts[i] for i in group])):
+                vectors[index] = vector
+        return vectors
+
+# --- Projected Query Encoder ---
+def _unit_rows(matrix):
+    import numpy as np
+    return matrix / np.clip(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12, None)
+
+class QueryProjection:
+    """
+    Linear map (with bias) from a small query encoder's space into the document embedding space,
+    fitted by ridge regression on (small-model vector, large-model vector) pairs.
+
+    Confidence of a projected query is its highest cosine similarity to the small-model vectors seen
+    in training: queries unlike anything in the training data are not trusted to land in the right place.
+    """
+    def __init__(self, weights, anchors, student_model, teacher_model, min_confidence, stats=None):
+        self.weights = weights # (student dims + 1, teacher dims)
+        self.anchors = anchors # Unit-length training vectors of the small model, float16
+        self.student_model = student_model
+        self.teacher_model = teacher_model
+        self.min_confidence = min_confidence
+        self.stats = stats or {}
+
+    @classmethod
+    def fit(cls, student_vectors, teacher_vectors, student_model, teacher_model, ridge=1.0,
+            validation_fraction=0.1, target_cosine=0.85, seed=0):
+        """
+        Fits the projection on a random (1 - validation_fraction) split and calibrates min_confidence on the rest:
+        the lowest confidence at which 90% of the accepted validation queries still reach `target_cosine`.
+        """
+        import numpy as np
+        X, Y = _unit_rows(np.asarray(student_vectors, dtype=np.float64)), np.asarray(teacher_vectors, dtype=np.float64)
+        order = np.random.default_rng(seed).permutation(len(X))
+        n_validation = max(1, int(len(X) * validation_fraction))
+        validation, train = order[:n_validation], order[n_validation:]
+        Xa = np.hstack([X[train], np.ones((len(train), 1))])
+        regularizer = ridge * np.eye(Xa.shape[1])
+        regularizer[-1, -1] = 0.0 # Bias is not penalized
+        weights = np.linalg.solve(Xa.T @ Xa + regularizer, Xa.T @ Y[train])
+        projection = cls(weights.astype(np.float32), X[train].astype(np.float16), student_model, teacher_model, 0.0)
+
+        projected, confidence = projection.project(X[validation])
+        cosine = (projected * _unit_rows(Y[validation])).sum(axis=1)
+        min_confidence = 1.0
+        for threshold in sorted(confidence):
+            accepted = cosine[confidence >= threshold]
+            if len(accepted) and np.percentile(accepted, 10) >= target_cosine:
+                min_confidence = float(threshold)
+                break
+        projection.min_confidence = min_confidence
+        accepted = confidence >= min_confidence
+        projection.stats = {'train_pairs': int(len(train)), 'validation_pairs': int(n_validation),
+                            'validation_mean_cosine': round(float(cosine.mean()), 4),
+                            'validation_p10_cosine': round(float(np.percentile(cosine, 10)), 4),
+                            'min_confidence': round(min_confidence, 4),
+                            'validation_accepted_fraction': round(float(accepted.mean()), 4),
+                            'accepted_mean_cosine': round(float(cosine[accepted].mean()), 4) if accepted.any() else None}
+        return projection
+
+    def project(self, student_vectors):
+        """
+        Returns (unit-length projected vectors, confidence per vector) as float32 numpy arrays.
+        """
+        import numpy as np
+        X = _unit_rows(np.asarray(student_vectors, dtype=np.float32))
+        projected = _unit_rows(np.hstack([X, np.ones((len(X), 1), dtype=np.float32)]) @ self.weights)
+        confidence = (X @ self.anchors.astype(np.float32).T).max(axis=1) if len(self.anchors) else np.zeros(len(X))
+        return projected.astype(np.float32), confidence.astype(np.float32)
+
+    def save(self, path):
+        import numpy as np
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        header = {'student_model': self.student_model, 'teacher_model': self.teacher_model,
+                  'min_confidence': self.min_confidence, 'stats': self.stats}
+        with open(path, 'wb') as f:
+            np.savez(f, weights=self.weights, anchors=self.anchors, header=np.array(json.dumps(header)))
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+        with np.load(path, allow_pickle=False) as data:
+            header = json.loads(str(data['header']))
+            return cls(data['weights'], data['anchors'], header['student_model'], header['teacher_model'],
+                       header['min_confidence'], header.get('stats'))
+
+class ProjectedQueryEmbeddingFunction:
+    """
+    Embeds queries with the small encoder and projects them into the document space; queries whose
+    projection confidence is below `min_confidence` are embedded by the large model instead.
+    `load_fallback` is called (once) the first time a fallback is needed, and `on_fallback(texts, confidences)`
+    (if given) for every fallback. Counts are in `projected` / `fallbacks`.
+    """
+    def __init__(self, student_function, projection, load_fallback, min_confidence=None, on_fallback=None):
+        self.student_function = student_function
+        self.projection = projection
+        self.load_fallback = load_fallback
+        self.min_confidence = projection.min_confidence if min_confidence is None else min_confidence
+        self.on_fallback = on_fallback
+        self._fallback = None
+        self._fallback_lock = threading.Lock()
+        self.projected = 0
+        self.fallbacks = 0
+
+    def __call__(self, input):
+        texts = list(input)
+        if not texts:
+            return []
+        vectors, confidence = self.projection.project(self.student_function(texts))
+        vectors = list(vectors)
+        low = [i for i, value in enumerate(confidence) if value < self.min_confidence]
+        if low:
+            if self.on_fallback is not None:
+                self.on_fallback([texts[i] for i in low], [float(confidence[i]) for i in low])
+            with self._fallback_lock:
+                if self._fallback is None:
+                    self._fallback = self.load_fallback()
+            for i, vector in zip(low, self._fallback([texts[i] for i in low])):
+                vectors[i] = vector
+        self.fallbacks += len(low)
+        self.projected += len(texts) - len(low)
+        return vectors
+
+# --- Past Request Index ---
+_SCRIPT_STAMP_PATTERN = re.compile(r"_(\d{8}_\d{6})\.py$") # GeneratedSuccessfulCode/<slug>_YYYYMMDD_HHMMSS.py
+
+def script_timestamp(file_name):
+    match = _SCRIPT_STAMP_PATTERN.search(file_name)
+    return match.group(1) if match else ''
+
+class PurposeIndex:
+    """
+    Unit-length float16 embeddings of past requests (the '# Purpose:' lines of saved scripts), one row per
+    script, with the script file names as the id map. Rows are ordered by the timestamp in the file name.
+    Stored as one .npz file; nearest() is one matrix-vector product, with no model or Chroma involved.
+    """
+    def __init__(self, vectors, files, purposes, model):
+        self.vectors = vectors # (rows, dims) float16
+        self.files = list(files)
+        self.purposes = list(purposes)
+        self.model = model
+
+    @classmethod
+    def empty(cls, model):
+        import numpy as np
+        return cls(np.zeros((0, 0), dtype=np.float16), [], [], model)
+
+    @classmethod
+    def load(cls, path):
+        import numpy as np
+        with np.load(path, allow_pickle=False) as data:
+            header = json.loads(str(data['header']))
+            return cls(data['vectors'], header['files'], header['purposes'], header['model'])
+
+    def save(self, path):
+        import numpy as np
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        header = {'model': self.model, 'files': self.files, 'purposes': self.purposes,
+                  'latest_timestamp': max(map(script_timestamp, self.files), default='')}
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as f:
+            np.savez(f, vectors=self.vectors, header=np.array(json.dumps(header)))
+        os.replace(temporary, path) # Readers see the old or the new index, never a partial one
+
+    def changes(self, file_names):
+        """
+        Compares the index with the scripts now present: returns (new file names, oldest first; removed file names).
+        """
+        present, indexed = set(file_names), set(self.files)
+        return sorted(present - indexed, key=lambda name: (script_timestamp(name), name)), sorted(indexed - present)
+
+    def updated(self, files, purposes, vectors, removed=()):
+        """
+        A new index without the `removed` scripts and with the given rows added, kept in timestamp order.
+        """
+        import numpy as np
+        removed = set(removed)
+        rows = [(name, purpose, self.vectors[i]) for i, (name, purpose) in enumerate(zip(self.files, self.purposes))
+                if name not in removed]
+        if len(files):
+            rows += list(zip(files, purposes, _unit_rows(np.asarray(vectors, dtype=np.float32)).astype(np.float16)))
+        rows.sort(key=lambda row: (script_timestamp(row[0]), row[0]))
+        matrix = np.stack([row[2] for row in rows]) if rows else np.zeros((0, 0), dtype=np.float16)
+        return PurposeIndex(matrix, [row[0] for row in rows], [row[1] for row in rows], self.model)
+
+    def nearest(self, query_vector, k=5):
+        """
+        The `k` most similar past requests: [{'file', 'purpose', 'score' (cosine)}], best first.
+        """
+        import numpy as np
+        if not self.files:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32).ravel()
+        scores = self.vectors.astype(np.float32) @ (query / max(float(np.linalg.norm(query)), 1e-12))
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [{'file': self.files[i], 'purpose': self.purposes[i], 'score': round(float(scores[i]), 4)} for i in top]
+
+# --- SentenceTransformer Without chromadb ---
+class SentenceTransformerFunction:
+    """
+    Same calls and vectors as Chroma's SentenceTransformerEmbeddingFunction (model in `._model`, unnormalized
+    float32 output), for code paths that never import chromadb.
+    """
+    def __init__(self, model_name, device='cpu', **kwargs):
+        from sentence_transformers import SentenceTransformer
+        self.model_name = model_name
+        self._model = SentenceTransformer(model_name, device=device, **kwargs)
+
+    def __call__(self, input):
+        import numpy as np
+        embeddings = self._model.encode(list(input), convert_to_numpy=True, normalize_embeddings=False)
+        return [np.array(embedding, dtype=np.float32) for embedding in embeddings]
+
+# --- Shared Model Weights ---
+def shared_weights_file(base_directory, model_name):
+    return os.path.join(base_directory, model_name.replace('/', '--') + ".pt")
+
+def share_torch_weights(module, path):
+    """
+    Re-points `module`'s parameters and buffers at a memory-mapped, read-only-in-practice copy of its state
+    dict in `path` (written on first use). Pages of a file mapping are shared through the OS page cache,
+    so every process doing this for the same model holds the weights once between them instead of each
+    keeping a private copy. Returns True if this call wrote the file.
+    """
+    import torch
+    written = False
+    if not os.path.isfile(path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        try:
+            torch.save(module.state_dict(), temporary)
+            os.replace(temporary, path) # Concurrent writers produce the same content; the last rename wins
+            written = True
+        except OSError:
+            if not os.path.isfile(path): # Otherwise another process finished first (and may have it mapped)
+                raise
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+    state = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    module.load_state_dict(state, assign=True) # assign: use the mapped tensors instead of copying into the old ones
+    return written
+
+def onnx_external_data_copy(model_path):
+    """
+    Path of a copy of the ONNX model whose weights live in a separate '<name>.data' file (written on first
+    use; needs the onnx package). ONNX Runtime maps external weights from the file rather than copying them
+    into each session, so processes using the copy share them through the page cache.
+    """
+    import shutil
+    import tempfile
+    shared_path = os.path.splitext(model_path)[0] + ".shared.onnx"
+    if os.path.isfile(shared_path):
+        return shared_path
+    import onnx
+    graph_name, data_name = os.path.basename(shared_path), os.path.basename(shared_path) + ".data"
+    temporary_directory = tempfile.mkdtemp(dir=os.path.dirname(model_path))
+    try:
+        onnx.save(onnx.load(model_path), os.path.join(temporary_directory, graph_name), save_as_external_data=True,
+                  all_tensors_to_one_file=True, location=data_name, size_threshold=1024)
+        try: # Data first: the graph file appearing marks the copy complete
+            os.replace(os.path.join(temporary_directory, data_name), shared_path + ".data")
+            os.replace(os.path.join(temporary_directory, graph_name), shared_path)
+        except OSError:
+            if not os.path.isfile(shared_path): # Otherwise another process finished first (and may have it mapped)
+                raise
+    finally:
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+    return shared_path
+
+# --- ONNX Runtime Backend ---
+ONNX_BACKENDS = ('onnx', 'onnx-int8')
+ONNX_CONFIG_FILE = "rag_onnx.json"
+ONNX_MODEL_FILES = {'onnx': "model.onnx", 'onnx-int8': "model_int8.onnx"}
+
+def onnx_export_directory(base_directory, model_name):
+    return os.path.join(base_directory, model_name.replace('/', '--'))
+
+def export_onnx_model(model_name, output_directory, quantize=True, opset=17):
+    """
+    Exports the SentenceTransformer `model_name` to `output_directory` for OnnxEmbeddingFunction:
+    model.onnx (fp32 transformer returning last_hidden_state), optionally model_int8.onnx (dynamic int8
+    quantization of the MatMul weights), tokenizer.json and rag_onnx.json (pooling, normalization, max length).
+    Needs torch and sentence_transformers (and onnxruntime for quantization). Returns {file name: bytes}.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    os.makedirs(output_directory, exist_ok=True)
+    model = SentenceTransformer(model_name, device='cpu', trust_remote_code=True)
+    transformer, tokenizer = model[0].auto_model.eval(), model[0].tokenizer
+    pooling = next((module for module in model if type(module).__name__ == 'Pooling'), None)
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in tokenizer.model_input_names]
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.transformer = transformer
+        def forward(self, input_ids, attention_mask, token_type_ids=None):
+            inputs = {'input_ids': input_ids, 'attention_mask': attention_mask, 'token_type_ids': token_type_ids}
+            return self.transformer(**{name: inputs[name] for name in input_names}).last_hidden_state
+
+    sample = tokenizer(["Revit API export sample"], return_tensors='pt')
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names + ['last_hidden_state']}
+    fp32_path = os.path.join(output_directory, ONNX_MODEL_FILES['onnx'])
+    export_options = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        export_options['dynamo'] = False # The TorchScript exporter handles dynamic_axes for HF encoders reliably
+    with torch.no_grad():
+        torch.onnx.export(LastHiddenState(), tuple(sample[name] for name in input_names), fp32_path,
+                          input_names=input_names, output_names=['last_hidden_state'], dynamic_axes=dynamic_axes,
+                          opset_version=opset, do_constant_folding=True, **export_options)
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(fp32_path, os.path.join(output_directory, ONNX_MODEL_FILES['onnx-int8']), weight_type=QuantType.QInt8)
+    tokenizer.save_pretrained(output_directory) # Fast tokenizers write tokenizer.json, all the runtime needs
+    config = {'model': model_name,
+              'pooling': _pooling_mode(pooling),
+              'normalize': any(type(module).__name__ == 'Normalize' for module in model),
+              'max_seq_length': model.max_seq_length,
+              'inputs': input_names,
+              'pad_token': tokenizer.pad_token, 'pad_token_id': tokenizer.pad_token_id,
+              'opset': opset}
+    with open(os.path.join(output_directory, ONNX_CONFIG_FILE), 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=2)
+    return {name: os.path.getsize(os.path.join(output_directory, name)) for name in sorted(os.listdir(output_directory))}
+
+def _pooling_mode(pooling):
+    # sentence-transformers < 5 exposes pooling_mode_* flags, newer versions a single 'pooling_mode' string
+    config = pooling.get_config_dict() if pooling is not None else {'pooling_mode': 'cls'}
+    mode = config.get('pooling_mode')
+    if not isinstance(mode, str):
+        mode = next((name for name in ('cls', 'mean') if config.get(f"pooling_mode_{'cls_token' if name == 'cls' else 'mean_tokens'}")), None)
+    if mode not in ('cls', 'mean'):
+        raise ValueError(f"Unsupported pooling for the ONNX backend: {config}")
+    return mode
+
+class OnnxEmbeddingFunction:
+    """
+    Chroma-compatible embedding function (`__call__(input) -> list of vectors`) running a model exported by
+    export_onnx_model on ONNX Runtime's CPU provider, with `tokenizers` for tokenization (no torch import).
+    Pooling and normalization follow the SentenceTransformer pipeline recorded at export time.
+    With `shared_weights`, weights are mapped from an external-data copy of the model (see onnx_external_data_copy)
+    and not prepacked, which would give each process a private copy again; per-process memory drops to the
+    activations, at some cost in latency.
+    """
+    def __init__(self, model_directory, quantized=False, threads=None, inter_op_threads=None, shared_weights=False):
+        import onnxruntime
+        from tokenizers import Tokenizer
+        with open(os.path.join(model_directory, ONNX_CONFIG_FILE), 'r', encoding='utf-8') as f:
+            self.config = json.load(f)
+        model_path = os.path.join(model_directory, ONNX_MODEL_FILES['onnx-int8' if quantized else 'onnx'])
+        if not os.path.isfile(model_path):
+            raise FileNotFoundError(f"ONNX model not found: {model_path} (run the 'export-onnx' subcommand first)")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if shared_weights:
+            model_path = onnx_external_data_copy(model_path)
+            options.add_session_config_entry('session.disable_prepacking', '1')
+        if threads:
+            options.intra_op_num_threads = threads
+        if inter_op_threads:
+            options.inter_op_num_threads = inter_op_threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_directory, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.config['max_seq_length'])
+        self.tokenizer.enable_padding(pad_id=self.config['pad_token_id'], pad_token=self.config['pad_token'])
+
+    def __call__(self, input):
+        import numpy as np
+        texts = list(input)
+        if not texts:
+            return []
+        encodings = self.tokenizer.encode_batch(texts)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        features = {'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+                    'attention_mask': attention_mask,
+                    'token_type_ids': np.array([e.type_ids for e in encodings], dtype=np.int64)}
+        hidden = self.session.run(['last_hidden_state'], {name: features[name] for name in self.input_names})[0]
+        if self.config['pooling'] == 'cls':
+            vectors = hidden[:, 0]
+        else:
+            mask = attention_mask[:, :, None].astype(hidden.dtype)
+            vectors = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.config['normalize']:
+            vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return [vector.astype(np.float32) for vector in vectors]
@@ -0,0 +1,495 @@
+"""
+Chroma-free vector indexes used by generate_rag_prompt.py.
+
+An exported collection is either a directory of flat files (export-flat-index) or one snapshot file
+(export-snapshot): a memory-mapped embedding matrix, its sign-bit codes and string tables for ids, documents
+and metadata. Like rag_cache, this module never logs; numpy and zstd are imported on first use.
+"""
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import zlib
+
+FLAT_INDEX_VERSION = 1
+FLAT_INDEX_HEADER = "index.json"
+DISTANCE_SPACES = ('cosine', 'l2', 'ip')
+FLAT_BACKENDS = ('flat', 'binary') # retrieval_backend values answered from these files (FlatIndex, BinaryQuantizedIndex)
+
+# --- String Tables ---
+def write_string_table(path, strings):
+    """
+    Writes strings as UTF-8 to `<path>.bin` with their byte offsets (uint64, n + 1 entries) in `<path>.idx`,
+    so any one of them can be read without loading the rest.
+    """
+    import numpy as np
+    offsets = np.zeros(len(strings) + 1, dtype=np.uint64)
+    with open(path + ".bin", 'wb') as f:
+        for i, text in enumerate(strings):
+            data = text.encode('utf-8')
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+    offsets.tofile(path + ".idx")
+
+class StringTable:
+    """
+    Variable-length values stored back to back in `data`, value i being bytes offsets[i]:offsets[i + 1].
+    `table[i]` decodes one value (UTF-8 text unless another `decode` is given); `raw(i)` returns its bytes.
+    """
+    def __init__(self, offsets, data, decode=None):
+        self.offsets = offsets
+        self.data = data
+        self.decode = decode or (lambda value: value.decode('utf-8'))
+
+    @classmethod
+    def open(cls, path, decode=None):
+        # Files written by write_string_table, memory-mapped
+        import numpy as np
+        offsets = np.fromfile(path + ".idx", dtype=np.uint64)
+        size = int(offsets[-1]) if len(offsets) else 0
+        return cls(offsets, np.memmap(path + ".bin", dtype=np.uint8, mode='r') if size else np.zeros(0, dtype=np.uint8), decode)
+
+    def __len__(self):
+        return max(0, len(self.offsets) - 1)
+
+    def raw(self, i):
+        return bytes(self.data[int(self.offsets[i]):int(self.offsets[i + 1])])
+
+    def __getitem__(self, i):
+        return self.decode(self.raw(i))
+
+class MetadataColumns:
+    """
+    Row view over one StringTable of JSON values per metadata key (empty = key absent in that row):
+    `columns[i]` is row i's metadata dict, `column(key)` the raw column for filtering on one key.
+    """
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __getitem__(self, i):
+        row = {}
+        for key, column in self.columns.items():
+            value = column.raw(i)
+            if value:
+                row[key] = json.loads(value)
+        return row
+
+    def column(self, key):
+        return self.columns.get(key)
+
+    def values(self, key, count):
+        # Every row's value for `key` (None where absent); `count` rows when no row has the key
+        column = self.columns.get(key)
+        if column is None:
+            return [None] * count
+        return [json.loads(value) if value else None for value in map(column.raw, range(len(column)))]
+
+# --- Sign-Bit Codes ---
+_POPCOUNT_TABLE = None
+
+def sign_codes(vectors):
+    """
+    1-bit quantization: bit j of row i is set when vectors[i, j] > 0. Bits are packed into uint64 words
+    (rows padded with zero bits to a multiple of 64), so a 1024-dim vector becomes 16 words (128 bytes).
+    """
+    import numpy as np
+    matrix = np.atleast_2d(np.asarray(vectors))
+    words = -(-matrix.shape[1] // 64)
+    bits = np.zeros((matrix.shape[0], words * 64), dtype=bool)
+    bits[:, :matrix.shape[1]] = matrix > 0
+    return np.ascontiguousarray(np.packbits(bits, axis=1)).view(np.uint64)
+
+def hamming_distances(codes, query_code):
+    """
+    Number of differing bits between each row of `codes` and `query_code` (one row of sign_codes).
+    """
+    global _POPCOUNT_TABLE
+    import numpy as np
+    different = np.bitwise_xor(codes, query_code)
+    if hasattr(np, 'bitwise_count'): # numpy 2.0+: hardware popcount
+        return np.bitwise_count(different).sum(axis=1, dtype=np.int32)
+    if _POPCOUNT_TABLE is None:
+        _POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return _POPCOUNT_TABLE[different.view(np.uint8)].sum(axis=1, dtype=np.int32)
+
+# --- Flat (Brute-Force) Index ---
+def stored_matrix(embeddings, space):
+    # float32 matrix as stored: rows normalized for the 'cosine' space
+    import numpy as np
+    if space not in DISTANCE_SPACES:
+        raise ValueError(f"Unsupported distance space '{space}'.")
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if space == 'cosine':
+        matrix = matrix / np.clip(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12, None)
+    return matrix.reshape(len(matrix), -1)
+
+def write_flat_index(directory, ids, embeddings, documents, metadatas, header, dtype='float16'):
+    """
+    Writes a FlatIndex to `directory` (replacing any previous one): embeddings.<dtype> (rows normalized for the
+    'cosine' space), their sign_codes in codes.uint64, ids / documents / metadatas string tables (metadata as JSON)
+    and index.json (`header` plus shape, dtype and format version). Files are written next to the directory and
+    swapped in at the end.
+    """
+    matrix = stored_matrix(embeddings, header.get('space', 'l2'))
+    directory = os.path.abspath(directory)
+    temporary = f"{directory}.{os.getpid()}.tmp"
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    matrix.astype(dtype).tofile(os.path.join(temporary, f"embeddings.{dtype}"))
+    sign_codes(matrix).tofile(os.path.join(temporary, "codes.uint64"))
+    write_string_table(os.path.join(temporary, "ids"), list(ids))
+    write_string_table(os.path.join(temporary, "documents"), [document or '' for document in documents])
+    write_string_table(os.path.join(temporary, "metadatas"), [json.dumps(metadata or {}) for metadata in metadatas])
+    with open(os.path.join(temporary, FLAT_INDEX_HEADER), 'w', encoding='utf-8') as f:
+        json.dump(dict(header, version=FLAT_INDEX_VERSION, count=int(matrix.shape[0]),
+                       dim=int(matrix.shape[1]) if matrix.ndim == 2 else 0, dtype=dtype), f, indent=2)
+    previous = f"{directory}.{os.getpid()}.old"
+    if os.path.isdir(directory):
+        os.replace(directory, previous)
+    os.replace(temporary, directory)
+    shutil.rmtree(previous, ignore_errors=True) # May linger on Windows while another process has it mapped
+
+def read_index_directory(directory):
+    """
+    Opens files written by write_flat_index: (header, embeddings, codes or None, ids, documents, metadatas).
+    """
+    import numpy as np
+    with open(os.path.join(directory, FLAT_INDEX_HEADER), 'r', encoding='utf-8') as f:
+        header = json.load(f)
+    if header.get('version') != FLAT_INDEX_VERSION:
+        raise ValueError(f"Flat index {directory} has format version {header.get('version')}, expected {FLAT_INDEX_VERSION}.")
+    shape = (header['count'], header['dim'])
+    path = os.path.join(directory, f"embeddings.{header['dtype']}")
+    embeddings = np.memmap(path, dtype=header['dtype'], mode='r', shape=shape) if shape[0] else np.zeros(shape)
+    codes_path, words = os.path.join(directory, "codes.uint64"), -(-header['dim'] // 64)
+    codes = None
+    if os.path.isfile(codes_path):
+        codes = np.memmap(codes_path, dtype=np.uint64, mode='r', shape=(shape[0], words)) if shape[0] else np.zeros((0, words), np.uint64)
+    return (header, embeddings, codes, StringTable.open(os.path.join(directory, "ids")),
+            StringTable.open(os.path.join(directory, "documents")),
+            StringTable.open(os.path.join(directory, "metadatas"), decode=json.loads))
+
+# --- Single-File Snapshots ---
+# Layout: a 24-byte preamble (magic, format version, header length, CRC-32 of the header), the JSON header,
+# then the sections, each starting on a 64-byte boundary. Section offsets in the header are relative to the
+# first section; the header also holds the SHA-256 of everything after it (checked by verify_index_snapshot).
+SNAPSHOT_MAGIC = b"RGRAGIDX"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_SUFFIX = ".ragidx"
+_SNAPSHOT_PREAMBLE = struct.Struct('<8sIII4x')
+_SNAPSHOT_ALIGNMENT = 64
+
+def zstd_functions():
+    """
+    (compress(data, level), decompress(data)) from the zstandard package, or from compression.zstd on Python 3.14+.
+    """
+    try:
+        import zstandard # Optional dependency
+        return (lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+                lambda data: zstandard.ZstdDecompressor().decompress(data))
+    except ImportError:
+        pass
+    try:
+        from compression import zstd
+    except ImportError:
+        raise ImportError("Snapshots need zstd: install the 'zstandard' package (or use Python 3.14+).") from None
+    return (lambda data, level: zstd.compress(data, level=level), zstd.decompress)
+
+def _aligned(offset):
+    return -(-offset // _SNAPSHOT_ALIGNMENT) * _SNAPSHOT_ALIGNMENT
+
+def _padding(offset):
+    return bytes(_aligned(offset) - offset)
+
+def _string_sections(name, values):
+    # (offsets, data) sections of a string table of already-encoded values
+    import numpy as np
+    offsets = np.zeros(len(values) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(value) for value in values], dtype=np.uint64) if values else []
+    return [(f"{name}.offsets", offsets.tobytes()), (f"{name}.data", b"".join(values))]
+
+def write_index_snapshot(path, ids, embeddings, documents, metadatas, header, level=19):
+    """
+    Writes the collection as one snapshot file (replacing `path` atomically): float16 embeddings (rows normalized
+    for the 'cosine' space), their sign_codes, ids, documents compressed one zstd frame each so any one can be
+    read alone, and one column of JSON values per metadata key. Returns the header written.
+    """
+    import numpy as np
+    compress, _ = zstd_functions()
+    matrix = stored_matrix(embeddings, header.get('space', 'l2'))
+    metadatas = [metadata or {} for metadata in metadatas]
+    columns = sorted({key for metadata in metadatas for key in metadata})
+    sections = [('embeddings', matrix.astype(np.float16).tobytes()), ('codes', sign_codes(matrix).tobytes())]
+    sections += _string_sections('ids', [str(i).encode('utf-8') for i in ids])
+    sections += _string_sections('documents', [compress(document.encode('utf-8'), level) if document else b""
+                                               for document in documents])
+    for key in columns:
+        sections += _string_sections(f"metadata/{key}", [json.dumps(metadata[key]).encode('utf-8') if key in metadata else b""
+                                                         for metadata in metadatas])
+    layout, payload_size = {}, 0
+    for name, data in sections:
+        layout[name] = [payload_size, len(data)]
+        payload_size = _aligned(payload_size + len(data))
+    digest = hashlib.sha256()
+    for name, data in sections:
+        digest.update(data)
+        digest.update(_padding(layout[name][0] + len(data)))
+    header = dict(header, format='ragidx', version=SNAPSHOT_VERSION, count=int(matrix.shape[0]), dim=int(matrix.shape[1]),
+                  dtype='float16', documents_compression='zstd', metadata_columns=columns, sections=layout,
+                  payload_bytes=payload_size, payload_sha256=digest.hexdigest())
+    header_bytes = json.dumps(header, indent=1).encode('utf-8')
+    preamble = _SNAPSHOT_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header_bytes), zlib.crc32(header_bytes))
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(preamble + header_bytes + _padding(len(preamble) + len(header_bytes)))
+        for name, data in sections:
+            f.write(data)
+            f.write(_padding(layout[name][0] + len(data)))
+    os.replace(temporary, path)
+    return header
+
+def read_snapshot_header(mapped):
+    """
+    (header, offset of the first section) from a snapshot's bytes; raises ValueError if it is not a readable snapshot.
+    """
+    if len(mapped) < _SNAPSHOT_PREAMBLE.size:
+        raise ValueError("File is too short to be an index snapshot.")
+    magic, version, header_length, header_crc = _SNAPSHOT_PREAMBLE.unpack_from(mapped, 0)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("Not an index snapshot (bad magic bytes).")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"Index snapshot has format version {version}, expected {SNAPSHOT_VERSION}.")
+    header_bytes = bytes(mapped[_SNAPSHOT_PREAMBLE.size:_SNAPSHOT_PREAMBLE.size + header_length])
+    if len(header_bytes) != header_length or zlib.crc32(header_bytes) != header_crc:
+        raise ValueError("Index snapshot header is corrupt (CRC mismatch).")
+    return json.loads(header_bytes), _aligned(_SNAPSHOT_PREAMBLE.size + header_length)
+
+def verify_index_snapshot(path, chunk_bytes=8 * 1024 * 1024):
+    """
+    Checks the header CRC, the file size and the SHA-256 of every section. Returns the header; raises ValueError on a mismatch.
+    """
+    with open(path, 'rb') as f:
+        preamble = f.read(_SNAPSHOT_PREAMBLE.size)
+        header_length = _SNAPSHOT_PREAMBLE.unpack_from(preamble, 0)[2] if len(preamble) == _SNAPSHOT_PREAMBLE.size else 0
+        header, start = read_snapshot_header(preamble + f.read(header_length))
+        f.seek(start)
+        digest, remaining = hashlib.sha256(), header['payload_bytes']
+        while remaining:
+            data = f.read(min(chunk_bytes, remaining))
+            if not data:
+                raise ValueError(f"Index snapshot is truncated ({remaining} bytes missing).")
+            digest.update(data)
+            remaining -= len(data)
+    if digest.hexdigest() != header['payload_sha256']:
+        raise ValueError("Index snapshot content does not match its checksum.")
+    return header
+
+def read_index_snapshot(path):
+    """
+    Memory-maps a snapshot: (header, embeddings, codes, ids, documents, metadatas), all views into the map.
+    Only the header is checked (CRC); documents are decompressed when read. See verify_index_snapshot.
+    """
+    import numpy as np
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header, start = read_snapshot_header(mapped)
+    if start + header['payload_bytes'] > len(mapped):
+        raise ValueError("Index snapshot is truncated.")
+
+    def section(name, dtype):
+        offset, length = header['sections'][name]
+        if not length:
+            return np.zeros(0, dtype=dtype)
+        return np.frombuffer(mapped, dtype=dtype, count=length // np.dtype(dtype).itemsize, offset=start + offset)
+
+    def table(name, decode=None):
+        return StringTable(section(f"{name}.offsets", np.uint64), section(f"{name}.data", np.uint8), decode)
+
+    _, decompress = zstd_functions()
+    count, dim = header['count'], header['dim']
+    embeddings = section('embeddings', np.float16).reshape(count, dim)
+    codes = section('codes', np.uint64).reshape(count, -(-dim // 64))
+    documents = table('documents', decode=lambda value: decompress(value).decode('utf-8') if value else '')
+    metadatas = MetadataColumns({key: table(f"metadata/{key}") for key in header['metadata_columns']})
+    return header, embeddings, codes, table('ids'), documents, metadatas
+
+class FlatIndex:
+    """
+    Exact nearest-neighbour search over an exported collection (directory or snapshot file), answering the
+    subset of the Chroma Collection API the retriever uses (count, query, get, name, metadata) with the same
+    distances: cosine = 1 - cos, l2 = squared Euclidean, ip = 1 - dot. Ties are broken by row order.
+
+    The matrix is memory-mapped; the first query converts it to float32 once (BLAS has no float16 path),
+    after which a query is a single matrix product.
+    """
+    def __init__(self, path):
+        self.path = path
+        reader = read_index_snapshot if os.path.isfile(path) else read_index_directory
+        self.header, self.embeddings, self.codes, self.ids, self.documents, self.metadatas = reader(path)
+        self.name = self.header['collection']
+        self.metadata = self.header.get('metadata', {})
+        self.space = self.header['space']
+        self._matrix = None
+        self._squared_norms = None
+        self._row_of = None
+        self._metadata_values = {}
+
+    def count(self):
+        return self.header['count']
+
+    def matrix(self):
+        # float32 working copy, made on first use
+        import numpy as np
+        if self._matrix is None:
+            self._matrix = np.ascontiguousarray(self.embeddings, dtype=np.float32)
+            self._squared_norms = (self._matrix * self._matrix).sum(axis=1)
+        return self._matrix
+
+    def prepare_queries(self, query_embeddings):
+        # float32 rows, unit length for the 'cosine' space (the stored rows are)
+        import numpy as np
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        if self.space == 'cosine':
+            queries = queries / np.clip(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12, None)
+        return queries
+
+    def distances(self, queries, rows=None):
+        """
+        (queries, rows) float32 distances in the index's space, to every row or only to `rows`.
+        `queries` come from prepare_queries.
+        """
+        import numpy as np
+        if rows is None:
+            matrix, squared_norms = self.matrix(), self._squared_norms
+        else:
+            matrix = np.asarray(self.embeddings[rows], dtype=np.float32)
+            squared_norms = (matrix * matrix).sum(axis=1)
+        if self.space in ('cosine', 'ip'):
+            return 1.0 - queries @ matrix.T
+        return np.maximum((queries * queries).sum(axis=1, keepdims=True) + squared_norms - 2.0 * (queries @ matrix.T), 0.0)
+
+    def top_k(self, distances, k):
+        """
+        Row indices of the k smallest distances per query, ordered by (distance, row).
+        """
+        import numpy as np
+        k = min(k, distances.shape[1])
+        if k <= 0:
+            return np.zeros((len(distances), 0), dtype=np.int64)
+        rows = []
+        for row_distances in distances:
+            candidates = np.argpartition(row_distances, k - 1)[:k] if k < len(row_distances) else np.arange(len(row_distances))
+            rows.append(candidates[np.lexsort((candidates, row_distances[candidates]))])
+        return np.array(rows)
+
+    def query(self, query_embeddings, n_results=10, include=('metadatas', 'documents', 'distances'), where=None):
+        """
+        Chroma-shaped top-n_results per query; with a `where` metadata filter (see where_rows) only matching rows are scored.
+        """
+        queries = self.prepare_queries(query_embeddings)
+        if where:
+            subset = self.where_rows(where)
+            distances = self.distances(queries, subset)
+            picked = self.top_k(distances, n_results)
+            return self.result([subset[p] for p in picked], [d[p] for d, p in zip(distances, picked)], include)
+        distances = self.distances(queries)
+        rows = self.top_k(distances, n_results)
+        return self.result(rows, [query_distances[query_rows] for query_distances, query_rows in zip(distances, rows)], include)
+
+    def metadata_values(self, key):
+        # Object array of every row's value for `key` (None where absent), decoded once per key
+        import numpy as np
+        if key not in self._metadata_values:
+            if isinstance(self.metadatas, MetadataColumns):
+                values = self.metadatas.values(key, self.count())
+            else:
+                values = [self.metadatas[i].get(key) for i in range(self.count())]
+            column = np.empty(len(values), dtype=object)
+            column[:] = values
+            self._metadata_values[key] = column
+        return self._metadata_values[key]
+
+    def where_rows(self, where):
+        """
+        Sorted row indices matching a Chroma-style metadata filter: {key: value}, {key: {'$eq' | '$ne' | '$in' | '$nin': ...}},
+        several keys (all must match), and '$and' / '$or' lists of filters.
+        """
+        import numpy as np
+        return np.flatnonzero(self._where_mask(where))
+
+    def _where_mask(self, where):
+        import numpy as np
+        mask = np.ones(self.count(), dtype=bool)
+        for key, condition in where.items():
+            if key in ('$and', '$or'):
+                parts = [self._where_mask(part) for part in condition]
+                mask &= np.logical_and.reduce(parts) if key == '$and' else np.logical_or.reduce(parts)
+                continue
+            values = self.metadata_values(key)
+            for operator, operand in (condition if isinstance(condition, dict) else {'$eq': condition}).items():
+                if operator in ('$eq', '$ne'):
+                    matches = np.fromiter((value == operand for value in values), dtype=bool, count=len(values))
+                elif operator in ('$in', '$nin'):
+                    operand = set(operand)
+                    matches = np.fromiter((value in operand for value in values), dtype=bool, count=len(values))
+                else:
+                    raise ValueError(f"Unsupported metadata filter operator '{operator}'.")
+                mask &= ~matches if operator in ('$ne', '$nin') else matches
+        return mask
+
+    def result(self, rows, distances, include):
+        # Chroma-shaped query result: rows and their distances, one list per query
+        return {'ids': [[self.ids[i] for i in query_rows] for query_rows in rows],
+                'distances': [[float(d) for d in query_distances] for query_distances in distances] if 'distances' in include else None,
+                'documents': [[self.documents[i] for i in query_rows] for query_rows in rows] if 'documents' in include else None,
+                'metadatas': [[self.metadatas[i] for i in query_rows] for query_rows in rows] if 'metadatas' in include else None,
+                'embeddings': None, 'included': list(include)}
+
+    def get(self, ids=None, include=('metadatas', 'documents')):
+        """
+        Chroma-shaped get() by ids (in the given order; unknown ids are skipped), or of every row.
+        """
+        if self._row_of is None:
+            self._row_of = {self.ids[i]: i for i in range(len(self.ids))}
+        rows = [self._row_of[i] for i in ids if i in self._row_of] if ids is not None else list(range(self.count()))
+        return {'ids': [self.ids[i] for i in rows],
+                'documents': [self.documents[i] for i in rows] if 'documents' in include else None,
+                'metadatas': [self.metadatas[i] for i in rows] if 'metadatas' in include else None,
+                'embeddings': [self.embeddings[i] for i in rows] if 'embeddings' in include else None,
+                'included': list(include)}
+
+class BinaryQuantizedIndex(FlatIndex):
+    """
+    Two-stage search over a FlatIndex: Hamming distance between sign_codes (1/16 of the float16 matrix)
+    picks `candidates_per_result` x n_results rows, and only those rows are read from the memory-mapped
+    matrix and rescored with exact distances. No float32 copy of the matrix is made.
+    Recall depends on the shortlist size; see the benchmark-binary subcommand.
+    """
+    def __init__(self, path, candidates_per_result=10, min_candidates=100):
+        super().__init__(path)
+        if self.codes is None:
+            raise FileNotFoundError(f"Sign-bit codes not found in {path} (rerun the 'export-flat-index' subcommand)")
+        self.candidates_per_result = candidates_per_result
+        self.min_candidates = min_candidates
+
+    def query(self, query_embeddings, n_results=10, include=('metadatas', 'documents', 'distances'), where=None):
+        import numpy as np
+        if where: # Filtered sets are small enough to score exactly
+            return super().query(query_embeddings, n_results, include, where)
+        queries = self.prepare_queries(query_embeddings)
+        shortlist_size = min(self.count(), max(n_results * self.candidates_per_result, self.min_candidates))
+        rows, distances = [], []
+        for query, query_code in zip(queries, sign_codes(queries)):
+            hamming = hamming_distances(self.codes, query_code)
+            if shortlist_size < len(hamming):
+                shortlist = np.argpartition(hamming, shortlist_size - 1)[:shortlist_size]
+            else:
+                shortlist = np.arange(len(hamming))
+            shortlist.sort() # Sequential reads from the matrix, and row order for ties
+            exact = self.distances(query[None, :], shortlist)
+            best = self.top_k(exact, n_results)[0]
+            rows.append(shortlist[best])
+            distances.append(exact[0, best])
+        return self.result(rows, distances, include)
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+
+# The helper modules sit next to generate_rag_prompt.py, which imports them as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(scope='session')
+def rag_module(tmp_path_factory):
+    # generate_rag_prompt sets up its log file under ~/Documents on import: point the home folder elsewhere first
+    home = tmp_path_factory.mktemp('home')
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('HOME', str(home))
+        patch.setenv('USERPROFILE', str(home))
+        import generate_rag_prompt
+    return generate_rag_prompt
+
+@pytest.fixture
+def rag(rag_module, tmp_path, monkeypatch):
+    """
+    generate_rag_prompt with every cache and data path under tmp_path and no process-wide state from earlier tests.
+    """
+    configured, cache_directory = rag_module.cache_directory, str(tmp_path / "cache")
+    for name, value in list(vars(rag_module).items()):
+        if isinstance(value, str) and value.startswith(configured):
+            monkeypatch.setattr(rag_module, name, cache_directory + value[len(configured):])
+    monkeypatch.setattr(rag_module, 'persist_directory', str(tmp_path / "chroma"))
+    monkeypatch.setattr(rag_module, 'generated_code_directory', str(tmp_path / "GeneratedSuccessfulCode"))
+    for name in ('collection_name', 'model_name', 'retrieval_backend', 'cache_enabled', 'api_prefilter'):
+        monkeypatch.setattr(rag_module, name, getattr(rag_module, name)) # Restored after the test
+    monkeypatch.setattr(rag_module, '_caches', {})
+    monkeypatch.setattr(rag_module, '_active_pair', None)
+    monkeypatch.setattr(rag_module, '_mirrored_pair', None)
+    yield rag_module
+    for cache in rag_module._caches.values():
+        if cache is not None:
+            cache.close()
@@ -0,0 +1,434 @@
+"""
+Tests for generate_rag_prompt: prompt generation with a stand-in retriever and Gemini refinement.
+Nothing here imports chromadb, torch or google.generativeai.
+"""
+import io
+import json
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+class FakeEmbedder:
+    # Stands in for QueryEmbedder: one-dimensional vectors, every call recorded
+    def __init__(self):
+        self.calls = []
+        self.embedding_function = self
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(text))] for text in texts]
+
+class FakeRetriever:
+    """
+    Stands in for CollectionRetriever: query text `t` finds chunks 't/0', 't/1', ... at distances 0.1, 0.2, ...
+    (lazily: ids and distances only; get() supplies 'Document t/0', ...). Every query is recorded.
+    """
+    def __init__(self):
+        self.embedder = FakeEmbedder()
+        self.queries = []
+
+    def count(self):
+        return 100
+
+    def query(self, query_texts, n_results, include, where=None, query_embeddings=None):
+        self.queries.append((list(query_texts), where))
+        return {'ids': [[f"{text}/{j}" for j in range(n_results)] for text in query_texts],
+                'distances': [[0.1 * (j + 1) for j in range(n_results)] for _ in query_texts],
+                'documents': None, 'metadatas': None}
+
+    def get(self, ids, include):
+        return {'ids': list(ids), 'documents': [f"Document {i}" for i in ids], 'metadatas': [{} for _ in ids]}
+
+class FakeCollection:
+    """
+    In-memory stand-in for a Chroma collection: get() by ids or by page, add() recording what each row was given.
+    """
+    def __init__(self, name, rows=(), metadata=None):
+        self.name, self.metadata = name, metadata
+        self.rows = {row['id']: row for row in rows}
+
+    def count(self):
+        return len(self.rows)
+
+    def get(self, ids=None, limit=None, offset=0, include=()):
+        rows = [self.rows[i] for i in ids if i in self.rows] if ids is not None else list(self.rows.values())[offset:offset + limit]
+        return {'ids': [row['id'] for row in rows], 'embeddings': [row['embedding'] for row in rows],
+                'documents': [row['document'] for row in rows], 'metadatas': [row['metadata'] for row in rows]}
+
+    def add(self, ids, embeddings, documents=None, metadatas=None):
+        for i, chunk_id in enumerate(ids):
+            self.rows[chunk_id] = {'id': chunk_id, 'embedding': list(embeddings[i]),
+                                   'document': documents[i] if documents is not None else None,
+                                   'metadata': metadatas[i] if metadatas is not None else None}
+
+def source_rows(count, empty_metadata=(), missing_documents=()):
+    return [{'id': f"chunk{i}", 'embedding': [float(i + 1), 1.0, 0.5, 0.25],
+             'document': None if i in missing_documents else f"Document {i}",
+             'metadata': {} if i in empty_metadata else {'api_element_name': f"Element{i}", 'element_type': 'Class'}}
+            for i in range(count)]
+
+class FakeChromaClient:
+    # A persistent client without the pointer collection (no pair was ever switched to)
+    def get_collection(self, name, embedding_function=None):
+        raise ValueError(f"Collection {name} does not exist.")
+
+# --- Active Pair: Single Query ---
+
+def test_single_query_starts_refinement_before_opening_chroma(rag, monkeypatch):
+    events = []
+    retriever = FakeRetriever()
+    run_in_background = rag.run_in_background
+
+    def record_background(name, fn, *args, **kwargs):
+        events.append(f"start {name}")
+        return run_in_background(name, fn, *args, **kwargs)
+
+    def open_chroma_client():
+        events.append('open chroma')
+        return FakeChromaClient()
+
+    def get_retriever():
+        rag.resolve_active_pair(rag.open_chroma_client()) # As open_collection does
+        return retriever
+    monkeypatch.setattr(rag, 'run_in_background', record_background)
+    monkeypatch.setattr(rag, 'open_chroma_client', open_chroma_client)
+    monkeypatch.setattr(rag, 'refine_query_with_gemini', lambda query, api_key, timeout=None: [query])
+
+    assert rag.resolve_active_pair(mirror_only=True) is None # No copy of the pointer yet: nothing is opened
+    assert events == [] and not rag.active_pair_resolved()
+    rag.generate_prompt("create a wall", None, get_retriever)
+    assert events == ['start gemini-refine', 'open chroma']
+    assert rag.read_active_pair_mirror() == (True, None) # Copy written for the next run
+    assert 'chromadb' not in sys.modules
+
+def test_single_query_reads_pair_from_copy(rag, monkeypatch):
+    monkeypatch.setattr(rag, 'open_chroma_client', lambda: pytest.fail("ChromaDB opened"))
+    rag.write_active_pair_mirror({'collection': 'migrated', 'embedding_model': 'new-model'})
+    assert rag.resolve_active_pair(mirror_only=True) == ('migrated', 'new-model')
+    assert rag.active_collection_name() == 'migrated'
+
+# --- Final-Prompt Cache ---
+
+@pytest.fixture
+def pair_resolved(rag, monkeypatch):
+    monkeypatch.setattr(rag, '_active_pair', (rag.collection_name, rag.model_name))
+
+def fake_refiner(monkeypatch, rag, refine):
+    # Replaces Gemini with `refine(query)`; returns the list of queries it was called with
+    calls = []
+
+    def refine_query_with_gemini(query, api_key, timeout=None):
+        calls.append(query)
+        return refine(query)
+    monkeypatch.setattr(rag, 'refine_query_with_gemini', refine_query_with_gemini)
+    return calls
+
+def refuse_retriever():
+    pytest.fail("The retriever was needed for a cached prompt.")
+
+def test_context_without_api_key_is_cached(rag, pair_resolved, monkeypatch):
+    calls = fake_refiner(monkeypatch, rag, lambda query: [query]) # What refine_query_with_gemini returns without a key
+    prompt, _ = rag.generate_prompt("create a wall", None, FakeRetriever)
+    assert "Document create a wall/0" in prompt
+    assert rag.generate_prompt("create a wall", None, refuse_retriever)[0] == prompt
+    assert calls == ["create a wall"]
+
+def test_failed_refinement_is_not_cached(rag, pair_resolved, monkeypatch):
+    def refine(query):
+        raise RuntimeError("Gemini is down")
+    calls = fake_refiner(monkeypatch, rag, refine)
+    rag.generate_prompt("create a wall", "key", FakeRetriever)
+    rag.generate_prompt("create a wall", "key", FakeRetriever) # Not served from the cache: refinement is attempted again
+    assert calls == ["create a wall", "create a wall"]
+
+class FailingOriginalRetriever(FakeRetriever):
+    # The search on the original query fails; every other search succeeds
+    def query(self, query_texts, n_results, include, where=None, query_embeddings=None):
+        if list(query_texts) == ["create a wall"]:
+            self.queries.append((list(query_texts), where))
+            raise RuntimeError("ChromaDB is busy")
+        return super().query(query_texts, n_results, include, where=where, query_embeddings=query_embeddings)
+
+def test_failed_original_search_is_not_cached(rag, pair_resolved, monkeypatch):
+    calls = fake_refiner(monkeypatch, rag, lambda query: [query, "place a basic wall"])
+    failing = FailingOriginalRetriever()
+    prompt, _ = rag.generate_prompt("create a wall", "key", lambda: failing)
+    assert "Document place a basic wall/0" in prompt and "Document create a wall/0" not in prompt
+    retriever = FakeRetriever()
+    prompt, _ = rag.generate_prompt("create a wall", "key", lambda: retriever) # Not served from the cache
+    assert "Document create a wall/0" in prompt and ["create a wall"] in [texts for texts, _ in retriever.queries]
+    assert calls == ["create a wall", "create a wall"]
+
+def test_gemini_fallback_is_not_cached(rag, pair_resolved, monkeypatch):
+    calls = fake_refiner(monkeypatch, rag, lambda query: [query]) # Gemini errors are answered with the original query
+    rag.generate_prompt("create a wall", "key", FakeRetriever)
+    rag.generate_prompt("create a wall", "key", FakeRetriever)
+    assert len(calls) == 2
+
+def test_refined_context_is_cached_apart_from_unrefined_one(rag, pair_resolved, monkeypatch):
+    calls = fake_refiner(monkeypatch, rag, lambda query: [query, "place a basic wall"])
+    refined, _ = rag.generate_prompt("create a wall", "key", FakeRetriever)
+    assert "Document place a basic wall/0" in refined
+    assert rag.generate_prompt("create a wall", "key", refuse_retriever)[0] == refined
+    assert calls == ["create a wall"]
+    unrefined, _ = rag.generate_prompt("create a wall", None, FakeRetriever) # Without a key: its own entry
+    assert len(calls) == 2
+
+# --- Speculative Retrieval and the Refinement Deadline ---
+
+def retrieved_texts(retriever):
+    return [text for texts, _ in retriever.queries for text in texts]
+
+def test_refinement_within_deadline_is_merged(rag, monkeypatch):
+    fake_refiner(monkeypatch, rag, lambda query: [query, "place a basic wall", " "])
+    retriever = FakeRetriever()
+    prompt, timings = rag.generate_prompt("create a wall", "key", lambda: retriever, refine_budget=5.0)
+    assert retrieved_texts(retriever) == ["create a wall", "place a basic wall"] # Blank and repeated queries are dropped
+    assert "Document create a wall/0" in prompt and "Document place a basic wall/0" in prompt
+    assert 'retrieve refined' in timings
+
+def test_missed_deadline_uses_original_query_results(rag, monkeypatch):
+    release = threading.Event()
+
+    def refine(query):
+        release.wait(10)
+        return [query, "place a basic wall"]
+    fake_refiner(monkeypatch, rag, refine)
+    retriever = FakeRetriever()
+    try:
+        started = time.perf_counter()
+        prompt, timings = rag.generate_prompt("create a wall", "key", lambda: retriever, refine_budget=0.2)
+        elapsed = time.perf_counter() - started
+    finally:
+        release.set()
+    assert elapsed < 2.0 # Bounded by the budget, not by the refinement
+    assert retrieved_texts(retriever) == ["create a wall"]
+    assert "Document create a wall/0" in prompt and "place a basic wall" not in prompt
+    assert 'retrieve refined' not in timings
+
+def test_failed_refinement_uses_original_query_results(rag, monkeypatch):
+    def refine(query):
+        raise RuntimeError("Gemini is down")
+    fake_refiner(monkeypatch, rag, refine)
+    retriever = FakeRetriever()
+    prompt, _ = rag.generate_prompt("create a wall", "key", lambda: retriever, refine_budget=5.0)
+    assert retrieved_texts(retriever) == ["create a wall"]
+    assert "Document create a wall/0" in prompt
+
+# --- Serve Mode: Worker Protocol ---
+
+def fake_generate_prompt(monkeypatch, rag):
+    # Replaces generate_prompt: "fail" raises, anything else is answered; returns the (query, refine budget) calls
+    answered = []
+
+    def generate_prompt(query, api_key, get_retriever, refine_budget=None):
+        answered.append((query, refine_budget))
+        if query == "fail":
+            raise RuntimeError("retrieval failed")
+        return f"prompt for {query}", {'retrieve original': 0.01}
+    monkeypatch.setattr(rag, 'generate_prompt', generate_prompt)
+    return answered
+
+def serve(rag, monkeypatch, lines):
+    # Runs the worker loop over `lines` with generate_prompt replaced; returns the JSON replies and the queries answered
+    answered = fake_generate_prompt(monkeypatch, rag)
+    output = io.StringIO()
+    rag.serve_requests(FakeRetriever(), None, startup_timings={'load': 1.0}, input_stream=io.StringIO("".join(lines)),
+                       output_stream=output, default_refine_budget=3.0)
+    return [json.loads(line) for line in output.getvalue().splitlines()], answered
+
+def test_worker_announces_ready_then_answers_each_line(rag, monkeypatch):
+    replies, answered = serve(rag, monkeypatch, ['{"id": 1, "query": "create a wall"}\n', '\n', '   \n',
+                                                 '{"id": "b", "query": "tag doors", "refine_budget": 0.5}\n'])
+    assert replies[0]['event'] == 'ready' and replies[0]['timings'] == {'load': 1.0}
+    assert [(r['id'], r['ok'], r['prompt']) for r in replies[1:]] == [(1, True, "prompt for create a wall"),
+                                                                    ('b', True, "prompt for tag doors")]
+    assert 'total' in replies[1]['timings']
+    assert answered == [("create a wall", 3.0), ("tag doors", 0.5)]
+
+def test_worker_reports_bad_requests_and_keeps_serving(rag, monkeypatch):
+    replies, answered = serve(rag, monkeypatch, ['not json\n', '[1, 2]\n', '{"id": 3}\n', '{"id": 4, "query": "  "}\n',
+                                                 '{"id": 5, "query": "fail"}\n', '{"id": 6, "query": "tag doors"}\n'])
+    assert [(r['id'], r['ok']) for r in replies[1:]] == [(None, False), (None, False), (3, False), (4, False),
+                                                         (5, False), (6, True)]
+    assert "must be a JSON object" in replies[2]['error']
+    assert "non-empty string" in replies[3]['error']
+    assert replies[5]['error'] == "retrieval failed"
+    assert answered == [("fail", 3.0), ("tag doors", 3.0)]
+
+def test_worker_stops_at_shutdown(rag, monkeypatch):
+    replies, answered = serve(rag, monkeypatch, ['{"id": 1, "query": "create a wall"}\n', '{"id": 2, "command": "shutdown"}\n',
+                                                 '{"id": 3, "query": "never answered"}\n'])
+    assert replies[-1] == {'id': 2, 'ok': True, 'event': 'shutdown'}
+    assert answered == [("create a wall", 3.0)]
+
+def test_worker_stats_count_requests_and_errors_per_client(rag, monkeypatch):
+    replies, _ = serve(rag, monkeypatch, ['{"id": 1, "query": "create a wall", "client": "revit-1"}\n',
+                                          '{"id": 2, "query": "fail", "client": "revit-1"}\n', '{"id": 3, "query": "tag doors"}\n',
+                                          '{"id": 4, "command": "stats"}\n'])
+    clients = replies[-1]['clients']
+    assert {client: (stats['requests'], stats['errors']) for client, stats in clients.items()} == {'revit-1': (2, 1), 'stdin': (1, 0)}
+    assert replies[-1]['embedding_batches'] is None
+
+def test_worker_ends_at_end_of_input(rag, monkeypatch):
+    replies, answered = serve(rag, monkeypatch, ['{"id": 1, "query": "create a wall"}'])  # No trailing newline
+    assert [r.get('id') for r in replies] == [None, 1]
+
+# --- Socket Service and Client Latency ---
+
+def test_latency_log_keeps_the_last_window_per_client(rag):
+    log = rag.ClientLatencyLog(window=3)
+    for seconds in (5.0, 4.0, 0.3, 0.1, 0.2):
+        log.record('revit-1', seconds)
+    log.record('revit-1')
+    log.record('revit-2')
+    assert log.snapshot() == {'revit-1': {'requests': 6, 'errors': 1, 'mean': 0.2, 'p50': 0.2, 'p95': 0.3, 'max': 0.3},
+                              'revit-2': {'requests': 1, 'errors': 1, 'mean': None, 'p50': None, 'p95': None, 'max': None}}
+
+def test_latency_log_percentiles_use_the_nearest_rank(rag):
+    log = rag.ClientLatencyLog()
+    for i in reversed(range(1, 101)):
+        log.record('revit-1', i / 100)
+    stats = log.snapshot()['revit-1']
+    assert (stats['mean'], stats['p50'], stats['p95'], stats['max']) == (0.505, 0.51, 0.95, 1.0)
+
+def test_socket_service_round_trip_on_loopback(rag, monkeypatch):
+    answered = fake_generate_prompt(monkeypatch, rag)
+    server = rag.create_socket_service(FakeRetriever(), None, '127.0.0.1:0', startup_timings={'load': 1.0},
+                                       default_refine_budget=2.0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with socket.create_connection(server.server_address, timeout=10) as connection:
+            stream = connection.makefile('rw', encoding='utf-8', newline='\n')
+            assert json.loads(stream.readline())['event'] == 'ready'
+            stream.write('{"id": 1, "query": "create a wall"}\n{"id": 2, "query": "fail"}\n{"id": 3, "command": "stats"}\n')
+            stream.flush()
+            replies = [json.loads(stream.readline()) for _ in range(3)]
+            client = f"127.0.0.1/{connection.getsockname()[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join(10)
+    assert (replies[0]['id'], replies[0]['ok'], replies[0]['prompt']) == (1, True, "prompt for create a wall")
+    assert (replies[1]['id'], replies[1]['ok']) == (2, False)
+    assert (replies[2]['clients'][client]['requests'], replies[2]['clients'][client]['errors']) == (2, 1)
+    assert answered == [("create a wall", 2.0), ("fail", 2.0)]
+    assert server.latency_log.snapshot()[client]['requests'] == 2
+
+# --- Ranking ---
+
+def test_merge_keeps_best_distance_and_prefilter_flag(rag):
+    merged = {}
+    rag.merge_query_results(merged, {'ids': [['a', 'b'], ['a']], 'distances': [[0.4, 0.5], [0.2]],
+                                     'documents': None, 'metadatas': None}, ["q1", "q2"])
+    rag.merge_query_results(merged, {'ids': [['b']], 'distances': [[0.9]], 'documents': None, 'metadatas': None},
+                            ["q1"], prefiltered=True)
+    assert {doc_id: (entry['distance'], entry['prefiltered']) for doc_id, entry in merged.items()} == \
+        {'a': (0.2, False), 'b': (0.5, True)}
+
+def test_rank_keeps_reserved_prefiltered_results(rag, monkeypatch):
+    monkeypatch.setattr(rag, 'final_num_results', 3)
+    monkeypatch.setattr(rag, 'api_prefilter_reserved_results', 1)
+    merged = {doc_id: {'id': doc_id, 'distance': distance, 'document': None, 'metadata': None, 'prefiltered': doc_id == 'api'}
+              for doc_id, distance in [('a', 0.1), ('b', 0.2), ('c', 0.3), ('d', 0.4), ('api', 0.9)]}
+    assert [entry['id'] for entry in rag.rank_results(merged)] == ['a', 'b', 'api']
+
+# --- Batch Mode ---
+
+def test_batch_requests_skip_blank_lines_and_report_bad_ones(rag, tmp_path):
+    path = tmp_path / "requests.jsonl"
+    path.write_text('{"id": "a", "query": "create a wall"}\n'
+                    '\n'
+                    '"tag all doors"\n'
+                    '{"request_id": "c", "title": "hide grids", "body": ""}\n'
+                    '{not json\n'
+                    '{"id": "e", "query": 42}\n'
+                    '{"id": "f"}\n'
+                    '[]\n', encoding='utf-8')
+    requests = list(rag.read_batch_requests(str(path)))
+    assert [request[:2] for request in requests] == [('a', "create a wall"), (3, "tag all doors"), ('c', "hide grids"),
+                                                     (5, None), ('e', None), ('f', None), (8, None)]
+    assert [request[2] is None for request in requests] == [True, True, True, False, False, False, False]
+    assert requests[3][2].startswith("Line 5: ")
+    assert "no non-empty 'query'" in requests[5][2]
+
+def test_split_query_results_keeps_result_shape(rag):
+    results = {'ids': [['a'], ['b', 'c']], 'distances': [[0.1], [0.2, 0.3]], 'documents': None, 'metadatas': None}
+    assert rag.split_query_results(results, 1) == {'ids': [['b', 'c']], 'distances': [[0.2, 0.3]]}
+    assert rag.split_query_results(dict(results, documents=[['x'], ['y', 'z']]), 0)['documents'] == [['x']]
+
+def run_batch(rag, requests, retriever, size=2):
+    output = io.StringIO()
+    counters = rag.generate_prompts_batch(iter(requests), None, retriever, output, size=size, refine_concurrency=2)
+    return [json.loads(line) for line in output.getvalue().splitlines()], counters
+
+def test_batch_answers_each_request_with_its_own_results(rag, pair_resolved, monkeypatch):
+    fake_refiner(monkeypatch, rag, lambda query: [query, f"{query} refined"])
+    retriever = FakeRetriever()
+    requests = [(1, "create a wall", None), (2, None, "Line 2: bad"), (3, "tag all doors", None), (4, "hide grids", None)]
+    replies, counters = run_batch(rag, requests, retriever)
+    assert [(reply['id'], reply['ok']) for reply in replies] == [(1, True), (2, False), (3, True), (4, True)]
+    assert replies[1]['error'] == "Line 2: bad"
+    for reply, query in [(replies[0], "create a wall"), (replies[2], "tag all doors"), (replies[3], "hide grids")]:
+        assert f"Document {query}/0" in reply['prompt'] and f"Document {query} refined/0" in reply['prompt']
+        assert all(f"Document {other}/" not in reply['prompt']
+                   for other in ("create a wall", "tag all doors", "hide grids") if other != query)
+    # One query for the originals and one for the refined queries of each chunk of two requests
+    assert [texts for texts, _ in retriever.queries] == [["create a wall"], ["create a wall refined"],
+                                                         ["tag all doors", "hide grids"], ["tag all doors refined", "hide grids refined"]]
+    assert counters == {'requests': 4, 'ok': 3, 'cached': 0, 'failed': 1}
+    replies, counters = run_batch(rag, requests, FakeRetriever())
+    assert [reply.get('cached') for reply in replies] == [True, None, True, True]
+
+def test_batch_does_not_cache_contexts_after_a_failed_search(rag, pair_resolved, monkeypatch):
+    fake_refiner(monkeypatch, rag, lambda query: [query, f"{query} refined"])
+    requests = [(1, "create a wall", None), (2, "tag all doors", None)]
+    failing = FailingOriginalRetriever() # Chunks of one: request 1 alone makes the failing original-query search
+    replies, counters = run_batch(rag, requests, failing, size=1)
+    assert counters['ok'] == 2 and "Document create a wall/0" not in replies[0]['prompt']
+    replies, _ = run_batch(rag, requests, FakeRetriever(), size=1)
+    assert [reply['cached'] for reply in replies] == [False, True]
+
+    def failing_prefilter(retriever, merged, texts, identifiers, vectors):
+        raise RuntimeError("Bad metadata filter")
+    monkeypatch.setattr(rag, 'retrieve_prefiltered', failing_prefilter)
+    run_batch(rag, [(3, "hide grids", None)], FakeRetriever())
+    replies, _ = run_batch(rag, [(3, "hide grids", None)], FakeRetriever())
+    assert replies[0]['cached'] is False
+
+# --- Matryoshka Collections ---
+
+def test_truncated_collection_copies_each_chunk_as_stored(rag, monkeypatch):
+    pytest.importorskip('numpy')
+    source = FakeCollection(rag.collection_name, source_rows(5, empty_metadata={1}, missing_documents={3}),
+                            metadata={'hnsw:space': 'cosine', 'embedding_model': 'other'})
+    client = FakeChromaClient()
+    created = {}
+    client.get_collection = lambda name, embedding_function=None: source if name == source.name else FakeChromaClient.get_collection(client, name)
+    client.create_collection = lambda name, metadata, embedding_function=None: created.setdefault(name, FakeCollection(name, metadata=metadata))
+    monkeypatch.setattr(rag, 'open_chroma_client', lambda: client)
+    monkeypatch.setattr(rag, 'resolve_active_pair', lambda client=None, mirror_only=False: (rag.collection_name, rag.model_name))
+    assert rag.build_truncated_collection(2, batch_size=3) == 5
+    target = created[f"{rag.collection_name}_d2"]
+    assert target.metadata == {'hnsw:space': 'cosine', 'matryoshka_source': rag.collection_name,
+                               'matryoshka_dims': 2, 'embedding_model': rag.model_name}
+    assert [row['document'] for row in target.rows.values()] == [f"Document {i}" if i != 3 else None for i in range(5)]
+    assert [row['metadata'] for row in target.rows.values()] == \
+        [source.rows[f"chunk{i}"]['metadata'] if i != 1 else None for i in range(5)]
+    for i, row in enumerate(target.rows.values()):
+        assert row['embedding'] == pytest.approx([(i + 1) / (1 + (i + 1) ** 2) ** 0.5, 1 / (1 + (i + 1) ** 2) ** 0.5])
+
+# --- Embedding Model Migration ---
+
+def test_migration_keeps_metadata_next_to_an_empty_one(rag):
+    source, target = FakeCollection('revit_api', source_rows(5, empty_metadata={1})), FakeCollection('revit_api_new')
+    embedder = FakeEmbedder()
+    assert rag.migrate_collection(source, target, embedder, page_size=3) == 5
+    assert [row['metadata'] for row in target.rows.values()] == \
+        [source.rows[f"chunk{i}"]['metadata'] if i != 1 else None for i in range(5)]
+    assert [row['embedding'] for row in target.rows.values()] == [[float(len(f"Document {i}"))] for i in range(5)]
+    assert rag.migrate_collection(source, target, embedder, page_size=3) == 0 # Nothing left to resume
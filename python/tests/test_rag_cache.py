@@ -0,0 +1,200 @@
+"""
+Tests for rag_cache: expiry and LRU eviction of SqliteCache, and row reuse in EmbeddingCache.
+"""
+import pytest
+
+try:
+    import numpy as np
+except ImportError: # Only EmbeddingCache needs numpy
+    np = None
+
+needs_numpy = pytest.mark.skipif(np is None, reason="EmbeddingCache needs numpy")
+
+import rag_cache
+from rag_cache import EmbeddingCache, SqliteCache
+
+class Clock:
+    # Stand-in for time.time that only moves when told to
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rag_cache.time, 'time', clock)
+    return clock
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "cache" / "rag_cache.sqlite3")
+
+# --- SqliteCache ---
+
+def test_round_trip_and_counters(db_path, clock):
+    cache = SqliteCache(db_path, 'prompts')
+    assert cache.get('missing') is None
+    cache.put('query', {'context': ["a", "b"], 'score': 0.5})
+    assert cache.get('query') == {'context': ["a", "b"], 'score': 0.5}
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+    reopened = SqliteCache(db_path, 'prompts')
+    assert reopened.get('query') == {'context': ["a", "b"], 'score': 0.5}
+    assert reopened.lifetime_counters() == (2, 1)
+
+def test_tables_are_separate(db_path, clock):
+    first, second = SqliteCache(db_path, 'first'), SqliteCache(db_path, 'second')
+    first.put('key', 1)
+    assert second.get('key') is None
+    assert first.lifetime_counters() == (0, 0) and second.lifetime_counters() == (0, 1)
+
+def test_expired_entries_are_misses(db_path, clock):
+    cache = SqliteCache(db_path, 'prompts', ttl_seconds=60)
+    cache.put('old', 1)
+    clock.advance(30)
+    cache.put('new', 2)
+    assert cache.get('old') == 1
+    clock.advance(31)
+    assert cache.get('old') is None # Expired even though it was read 31 seconds ago: the TTL runs from creation
+    assert cache.get('new') == 2
+    assert cache.values() == [2]
+    assert (cache.hits, cache.misses) == (2, 1)
+
+def test_expired_entries_are_deleted_on_put(db_path, clock):
+    cache = SqliteCache(db_path, 'prompts', ttl_seconds=60)
+    cache.put('old', 1)
+    clock.advance(61)
+    cache.put('new', 2)
+    cache.ttl_seconds = None # Would make 'old' readable again had it not been deleted
+    assert cache.get('old') is None
+
+def test_least_recently_used_entries_are_evicted(db_path, clock):
+    cache = SqliteCache(db_path, 'prompts', max_entries=3)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, key)
+        clock.advance(1)
+    assert cache.get('a') == 'a' # 'b' is now the least recently used
+    clock.advance(1)
+    cache.put('d', 'd')
+    assert cache.get('b') is None
+    assert sorted(cache.values()) == ['a', 'c', 'd']
+
+def test_replacing_a_key_does_not_evict(db_path, clock):
+    cache = SqliteCache(db_path, 'prompts', max_entries=2)
+    cache.put('a', 1)
+    clock.advance(1)
+    cache.put('b', 2)
+    clock.advance(1)
+    cache.put('a', 3)
+    assert (cache.get('a'), cache.get('b')) == (3, 2)
+
+@pytest.mark.parametrize('table', ["prompts; DROP TABLE cache_stats", "1prompts", ""])
+def test_invalid_table_name_is_rejected(db_path, table):
+    with pytest.raises(ValueError, match="Invalid cache table name"):
+        SqliteCache(db_path, table)
+
+# --- EmbeddingCache ---
+
+DIM = 16
+
+def vectors(count, seed=0):
+    # Random vectors that survive the float16 round trip exactly
+    return np.random.default_rng(seed).standard_normal((count, DIM)).astype(np.float16).astype(np.float32)
+
+@pytest.fixture
+def embedding_cache(tmp_path, clock):
+    return EmbeddingCache(str(tmp_path / "rag_cache.sqlite3"), str(tmp_path / "embeddings.f16"), 'test-model', capacity=4)
+
+@needs_numpy
+def test_embeddings_round_trip(embedding_cache):
+    texts, stored = ["Create a wall", "Tag all doors"], vectors(2)
+    assert embedding_cache.get_many(texts) == {}
+    embedding_cache.put_many(texts, stored)
+    found = embedding_cache.get_many(texts + ["Unknown"])
+    assert sorted(found) == sorted(texts)
+    np.testing.assert_array_equal(found["Tag all doors"], stored[1])
+    assert found["Create a wall"].dtype == np.float32
+    assert (embedding_cache.hits, embedding_cache.misses) == (2, 3)
+
+@needs_numpy
+def test_keys_collapse_whitespace_but_keep_case(embedding_cache):
+    embedding_cache.put_many(["Create a  wall "], vectors(1))
+    assert list(embedding_cache.get_many([" Create a wall"])) == [" Create a wall"]
+    assert embedding_cache.get_many(["create a wall"]) == {}
+
+@needs_numpy
+def test_full_cache_reuses_least_recently_used_row(embedding_cache, clock):
+    texts, stored = [f"request {i}" for i in range(4)], vectors(5)
+    for text, vector in zip(texts, stored):
+        embedding_cache.put_many([text], vector[None])
+        clock.advance(1)
+    embedding_cache.get_many(["request 0"]) # 'request 1' is now the least recently used
+    clock.advance(1)
+    embedding_cache.put_many(["request 4"], stored[4:])
+    assert embedding_cache.size() == 4
+    found = embedding_cache.get_many(texts + ["request 4"])
+    assert sorted(found) == ["request 0", "request 2", "request 3", "request 4"]
+    for i in (0, 2, 3, 4):
+        np.testing.assert_array_equal(found[f"request {i}"], stored[i])
+    assert np.memmap(embedding_cache.matrix_path, dtype=np.float16, mode='r').size == 4 * DIM # The matrix did not grow
+
+@needs_numpy
+def test_updating_a_text_keeps_its_row(embedding_cache):
+    embedding_cache.put_many(["Create a wall"], vectors(1, seed=1))
+    embedding_cache.put_many(["Create a wall"], vectors(1, seed=2))
+    assert embedding_cache.size() == 1
+    np.testing.assert_array_equal(embedding_cache.get_many(["Create a wall"])["Create a wall"], vectors(1, seed=2)[0])
+
+@needs_numpy
+def test_models_do_not_share_rows(tmp_path, embedding_cache):
+    embedding_cache.put_many(["Create a wall"], vectors(1))
+    other = EmbeddingCache(embedding_cache.db_path, str(tmp_path / "embeddings.f16"), 'other-model', capacity=4)
+    assert other.get_many(["Create a wall"]) == {}
+    assert other.matrix_path != embedding_cache.matrix_path
+
+@needs_numpy
+def test_mismatched_vectors_are_rejected(embedding_cache):
+    embedding_cache.put_many(["Create a wall"], vectors(1))
+    with pytest.raises(ValueError, match="does not match cache matrix"):
+        embedding_cache.put_many(["Tag all doors"], np.zeros((1, DIM + 1), dtype=np.float32))
+    with pytest.raises(ValueError, match="one embedding vector per text"):
+        embedding_cache.put_many(["Tag all doors", "Hide grids"], vectors(1))
+    assert embedding_cache.size() == 1
+
+@needs_numpy
+def test_failed_insert_leaves_no_reused_row_behind(embedding_cache, clock, monkeypatch):
+    stored = vectors(6)
+    embedding_cache.put_many([f"request {i}" for i in range(4)], stored[:4])
+    clock.advance(1)
+    embedding_cache.get_many(["request 1", "request 2", "request 3"]) # 'request 0' is now the least recently used
+
+    def key_for(text):
+        if text == "fails":
+            raise RuntimeError("insert failed")
+        return EmbeddingCache.key_for(text)
+    with monkeypatch.context() as patch:
+        patch.setattr(embedding_cache, 'key_for', key_for)
+        with pytest.raises(RuntimeError):
+            embedding_cache.put_many(["request 4", "fails"], stored[4:6]) # 'request 4' overwrites the row of 'request 0'
+
+    # The rollback maps 'request 0' to its old row again, but that row now holds the vector of 'request 4'
+    found = embedding_cache.get_many([f"request {i}" for i in range(5)])
+    assert sorted(found) == ["request 1", "request 2", "request 3"]
+    embedding_cache.put_many(["request 0"], stored[:1]) # The stale mapping heals on the next insert
+    np.testing.assert_array_equal(embedding_cache.get_many(["request 0"])["request 0"], stored[0])
+
+@needs_numpy
+def test_row_reused_by_another_process_is_a_miss(tmp_path, embedding_cache, clock):
+    embedding_cache.put_many(["Create a wall", "Tag all doors"], vectors(2))
+    slot = embedding_cache._conn.execute("SELECT slot FROM embedding_slots WHERE key = ?",
+                                         (EmbeddingCache.key_for("Create a wall"),)).fetchone()[0]
+    other = EmbeddingCache(embedding_cache.db_path, str(tmp_path / "embeddings.f16"), 'test-model', capacity=4)
+    other._open_matrix()
+    other._checks[slot] = EmbeddingCache.key_check(EmbeddingCache.key_for("Hide grids")) # Mid-rewrite for another text
+    other._checks.flush()
+    assert list(embedding_cache.get_many(["Create a wall", "Tag all doors"])) == ["Tag all doors"]
@@ -0,0 +1,288 @@
+"""
+Tests for rag_embeddings: the micro-batching coalescer shared by concurrent service requests, Matryoshka
+truncation and length bucketing, the projected query encoder fitted on a synthetic linear map, the
+past-request index checked against numpy brute force, and the shared model weights file.
+"""
+import os
+import threading
+import time
+
+import pytest
+
+try:
+    import numpy as np
+except ImportError: # Only the vector helpers need numpy
+    np = None
+
+needs_numpy = pytest.mark.skipif(np is None, reason="Vector helpers need numpy")
+
+from rag_embeddings import (EmbeddingCoalescer, LengthBucketedEmbeddingFunction, ProjectedQueryEmbeddingFunction,
+                            PurposeIndex, QueryProjection, TruncatedEmbeddingFunction, length_buckets, share_torch_weights,
+                            truncate_embeddings)
+
+# --- Micro-Batching Coalescer ---
+
+def vector_for(text):
+    return [float(len(text)), float(sum(map(ord, text)))]
+
+class RecordingEmbedder:
+    # embed_batch stand-in: one vector per text that identifies the text, and a record of every batch
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        if self.error is not None:
+            raise self.error
+        return [vector_for(text) for text in texts]
+
+def call_concurrently(coalescer, requests):
+    # Submits each list of texts from its own thread; returns the result (or exception) per request
+    results = [None] * len(requests)
+    def submit(index):
+        try:
+            results[index] = coalescer(requests[index])
+        except Exception as e:
+            results[index] = e
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+def test_full_batch_is_embedded_without_waiting_for_the_window():
+    embedder = RecordingEmbedder()
+    coalescer = EmbeddingCoalescer(embedder, window_seconds=30, max_batch_size=4)
+    started = time.perf_counter()
+    requests = [["create a wall", "tag doors"], ["hide grids", "list levels"]]
+    results = call_concurrently(coalescer, requests)
+    assert time.perf_counter() - started < 10
+    assert len(embedder.batches) == 1 and sorted(embedder.batches[0]) == ["create a wall", "hide grids", "list levels", "tag doors"]
+    assert results == [[vector_for(text) for text in texts] for texts in requests]
+    assert coalescer.histograms()['requests_per_batch']['count'] == 1
+
+def test_lone_request_is_embedded_when_the_window_closes():
+    embedder = RecordingEmbedder()
+    coalescer = EmbeddingCoalescer(embedder, window_seconds=0.05, max_batch_size=64)
+    started = time.perf_counter()
+    assert coalescer(["create a wall"]) == [vector_for("create a wall")]
+    assert 0.04 <= time.perf_counter() - started < 5
+    assert coalescer([]) == [] and embedder.batches == [["create a wall"]]
+
+def test_embedding_error_reaches_every_waiting_caller():
+    coalescer = EmbeddingCoalescer(RecordingEmbedder(RuntimeError("model failed")), window_seconds=30, max_batch_size=2)
+    results = call_concurrently(coalescer, [["create a wall"], ["tag doors"]])
+    assert all(isinstance(result, RuntimeError) and str(result) == "model failed" for result in results)
+    assert len(coalescer.embed_batch.batches) == 1
+    # The worker thread survives the error and serves the next batch
+    coalescer.embed_batch.error = None
+    assert call_concurrently(coalescer, [["hide grids"], ["tag doors"]]) == [[vector_for("hide grids")], [vector_for("tag doors")]]
+
+def test_each_caller_gets_its_own_rows_in_order():
+    embedder = RecordingEmbedder()
+    coalescer = EmbeddingCoalescer(embedder, window_seconds=30, max_batch_size=6)
+    requests = [["tag doors", "create a wall"], ["create a wall"], ["hide grids", "tag doors", "list levels"]]
+    results = call_concurrently(coalescer, requests)
+    assert results == [[vector_for(text) for text in texts] for texts in requests]
+    # Duplicates within the batch are embedded once
+    assert len(embedder.batches) == 1 and sorted(embedder.batches[0]) == ["create a wall", "hide grids", "list levels", "tag doors"]
+    assert results == [[vector_for(text) for text in texts] for texts in requests]
+
+# --- Matryoshka Truncation and Length Bucketing ---
+
+@needs_numpy
+def test_truncated_vectors_are_renormalized():
+    vectors = [[3.0, 4.0, 12.0], [0.0, 2.0, 5.0]]
+    truncated = truncate_embeddings(vectors, 2)
+    assert truncated.dtype == np.float32 and np.allclose(truncated, [[0.6, 0.8], [0.0, 1.0]])
+    assert np.allclose(truncate_embeddings([[0.0, 0.0, 1.0]], 2), [[0.0, 0.0]]) # No division by zero
+    with pytest.raises(ValueError):
+        truncate_embeddings(vectors, 4)
+    function = TruncatedEmbeddingFunction(lambda texts: [[3.0, 4.0, 1.0] for _ in texts], 2)
+    assert np.allclose(function(["create a wall"]), [[0.6, 0.8]]) and function([]) == []
+
+class WordTokenizer:
+    # tokenizers.Tokenizer stand-in: one token per word plus two special tokens, truncated to max_length
+    class Encoding:
+        def __init__(self, length):
+            self.attention_mask = [1] * length
+
+    def __init__(self):
+        self.max_length = None
+
+    def encode_batch(self, texts):
+        return [self.Encoding(min(len(text.split()) + 2, self.max_length or 10**9)) for text in texts]
+
+    def enable_truncation(self, max_length):
+        self.max_length = max_length
+
+class TokenizedEmbedder(RecordingEmbedder):
+    def __init__(self):
+        super().__init__()
+        self.tokenizer = WordTokenizer()
+
+def test_length_buckets_group_by_bound():
+    assert length_buckets([3, 40, 16, 17, 100, 2], (16, 32, 64)) == [[0, 2, 5], [3], [1], [4]]
+
+def test_bucketed_vectors_come_back_in_input_order():
+    embedder = TokenizedEmbedder()
+    function = LengthBucketedEmbeddingFunction(embedder, bounds=(8, 4), max_tokens=30)
+    texts = ["wall", " ".join(["word"] * 40), "tag all doors", " ".join(["word"] * 5), "hide grids"]
+    assert function(texts) == [vector_for(text) for text in texts]
+    assert embedder.tokenizer.max_length == 30
+    assert embedder.batches == [["wall", "hide grids"], ["tag all doors", texts[3]], [texts[1]]]
+    assert (function.tokens, function.padded_tokens) == (3 + 30 + 5 + 7 + 4, 2 * 4 + 2 * 7 + 30)
+    assert function(["wall"]) == [vector_for("wall")] and function([]) == []
+
+def test_functions_without_a_tokenizer_are_called_unchanged():
+    embedder = RecordingEmbedder()
+    function = LengthBucketedEmbeddingFunction(embedder, bounds=(4,))
+    texts = ["wall", " ".join(["word"] * 40)]
+    assert function(texts) == [vector_for(text) for text in texts] and embedder.batches == [texts]
+    assert function.tokens == 0
+
+# --- Projected Query Encoder ---
+
+STUDENT_DIM, TEACHER_DIM = 8, 12
+
+def linear_pairs(count, seed=0):
+    # Small-model vectors in the positive orthant and large-model vectors that are one fixed affine map of them
+    weights = np.random.default_rng(42).standard_normal((STUDENT_DIM + 1, TEACHER_DIM))
+    student = unit(np.abs(np.random.default_rng(seed).standard_normal((count, STUDENT_DIM))))
+    return student, student @ weights[:-1] + weights[-1] * 0.1
+
+def unit(matrix):
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+@needs_numpy
+def test_projection_recovers_a_linear_map_and_survives_a_round_trip(tmp_path):
+    student, teacher = linear_pairs(300)
+    projection = QueryProjection.fit(student, teacher, 'small', 'large', ridge=1e-4)
+    assert projection.weights.shape == (STUDENT_DIM + 1, TEACHER_DIM) and len(projection.anchors) == 270
+    assert projection.stats['train_pairs'] == 270 and projection.stats['validation_pairs'] == 30
+    assert projection.stats['validation_p10_cosine'] > 0.99 and projection.stats['validation_accepted_fraction'] == 1.0
+
+    queries, expected = linear_pairs(20, seed=1)
+    projected, confidence = projection.project(queries * 3.0) # Input length does not matter
+    assert projected.dtype == np.float32 and np.allclose(np.linalg.norm(projected, axis=1), 1.0, atol=1e-5)
+    assert (projected * unit(expected)).sum(axis=1).min() > 0.99
+    assert confidence.min() > 0.5
+
+    path = str(tmp_path / "projection" / "small-to-large.npz")
+    projection.save(path)
+    loaded = QueryProjection.load(path)
+    assert (loaded.student_model, loaded.teacher_model, loaded.min_confidence, loaded.stats) == \
+        ('small', 'large', projection.min_confidence, projection.stats)
+    assert np.array_equal(loaded.weights, projection.weights) and np.array_equal(loaded.anchors, projection.anchors)
+    assert np.array_equal(loaded.project(queries * 3.0)[0], projected)
+
+@needs_numpy
+def test_queries_unlike_the_training_data_fall_back_to_the_full_model():
+    student, teacher = linear_pairs(300)
+    projection = QueryProjection.fit(student, teacher, 'small', 'large', ridge=1e-4)
+    known, _ = linear_pairs(2, seed=1)
+    student_vectors = {"create a wall": known[0], "tag doors": known[1], "zzz": -known[0]} # Opposite of every anchor
+    loads, fallbacks = [], []
+
+    def load_fallback():
+        loads.append(True)
+        return lambda texts: [np.full(TEACHER_DIM, float(len(text)), dtype=np.float32) for text in texts]
+    function = ProjectedQueryEmbeddingFunction(lambda texts: np.stack([student_vectors[t] for t in texts]), projection,
+                                               load_fallback, on_fallback=lambda texts, confidences: fallbacks.append((texts, confidences)))
+    assert function.min_confidence == projection.min_confidence
+
+    vectors = function(["create a wall", "tag doors"])
+    assert np.allclose(vectors, projection.project(known)[0]) and loads == [] and fallbacks == []
+    vectors = function(["create a wall", "zzz", "tag doors"])
+    assert np.allclose(vectors[0], projection.project(known[:1])[0][0]) and list(vectors[1]) == [3.0] * TEACHER_DIM
+    assert [texts for texts, _ in fallbacks] == [["zzz"]] and fallbacks[0][1][0] < 0
+    function(["zzz"])
+    assert loads == [True] # The full model is loaded once, on the first fallback
+    assert (function.projected, function.fallbacks) == (4, 2)
+    assert function([]) == []
+
+    strict = ProjectedQueryEmbeddingFunction(lambda texts: np.stack([student_vectors[t] for t in texts]), projection,
+                                             load_fallback, min_confidence=1.01)
+    assert [list(vector) for vector in strict(["tag doors"])] == [[9.0] * TEACHER_DIM]
+
+# --- Past Request Index ---
+
+def script_names(count):
+    # Saved-script names whose timestamps run backwards, so index order differs from input order
+    return [f"create_wall_{i}_20260{1 + i % 9}{10 + i % 17:02d}_{120000 - i:06d}.py" for i in range(count)]
+
+@needs_numpy
+def test_purpose_index_round_trip_keeps_timestamp_order(tmp_path):
+    files = script_names(30)
+    vectors = np.random.default_rng(0).standard_normal((30, 16)).astype(np.float32)
+    index = PurposeIndex.empty('model-a').updated(files, [f"Purpose {i}" for i in range(30)], vectors)
+    order = sorted(range(30), key=lambda i: (files[i][-18:-3], files[i]))
+    assert index.files == [files[i] for i in order] and index.purposes == [f"Purpose {i}" for i in order]
+    assert index.vectors.dtype == np.float16 and np.allclose(index.vectors.astype(np.float32), unit(vectors[order]), atol=1e-3)
+
+    path = str(tmp_path / "purposes" / "index.npz")
+    index.save(path)
+    loaded = PurposeIndex.load(path)
+    assert (loaded.model, loaded.files, loaded.purposes) == ('model-a', index.files, index.purposes)
+    assert np.array_equal(loaded.vectors, index.vectors)
+    assert sorted(os.listdir(tmp_path / "purposes")) == ["index.npz"]
+
+@needs_numpy
+def test_purpose_index_changes_and_removal():
+    files = script_names(5)
+    index = PurposeIndex.empty('model-a').updated(files[:4], ["a", "b", "c", "d"], np.eye(4, 8))
+    new, removed = index.changes(files[1:])
+    assert (new, removed) == ([files[4]], [files[0]])
+    updated = index.updated(new, ["e"], np.eye(1, 8, 5), removed=removed)
+    assert sorted(updated.files) == sorted(files[1:]) and len(updated.vectors) == 4
+    assert updated.changes(files[1:]) == ([], [])
+    assert PurposeIndex.empty('model-a').updated([], [], [], removed=files).files == []
+
+@needs_numpy
+def test_purpose_index_top_k_matches_brute_force():
+    rng = np.random.default_rng(1)
+    files, vectors = script_names(200), rng.standard_normal((200, 32)).astype(np.float32)
+    index = PurposeIndex.empty('model-a').updated(files, [f"Purpose {i}" for i in range(200)], vectors)
+    stored = index.vectors.astype(np.float64)
+    for query in rng.standard_normal((10, 32)):
+        scores = stored @ (query / np.linalg.norm(query))
+        expected = np.argsort(-scores, kind='stable')[:5]
+        hits = index.nearest(query * 7.0, k=5)
+        assert [hit['file'] for hit in hits] == [index.files[i] for i in expected]
+        assert [hit['score'] for hit in hits] == pytest.approx(scores[expected], abs=1e-3)
+    assert len(index.nearest(query, k=500)) == 200
+    assert PurposeIndex.empty('model-a').nearest(query) == []
+
+# --- Shared Model Weights ---
+
+def test_shared_weights_file_is_reused_once_written(tmp_path):
+    torch = pytest.importorskip('torch')
+    path = str(tmp_path / "weights" / "model.pt")
+    first, second = torch.nn.Linear(4, 3), torch.nn.Linear(4, 3)
+    assert share_torch_weights(first, path) is True
+    assert share_torch_weights(second, path) is False # Loads the existing file instead of overwriting it
+    assert torch.equal(second.weight, first.weight) and torch.equal(second.bias, first.bias)
+    assert sorted(os.listdir(tmp_path / "weights")) == ["model.pt"]
+
+def test_shared_weights_file_written_by_another_process_first(tmp_path, monkeypatch):
+    torch = pytest.importorskip('torch')
+    path = str(tmp_path / "model.pt")
+    winner, loser = torch.nn.Linear(4, 3), torch.nn.Linear(4, 3)
+
+    def replace_after_other_writer(source, destination):
+        # The other process renames its copy in first and maps it: on Windows our rename over it then fails
+        torch.save(winner.state_dict(), destination)
+        raise PermissionError(13, "The process cannot access the file", destination)
+    monkeypatch.setattr(os, 'replace', replace_after_other_writer)
+    assert share_torch_weights(loser, path) is False
+    assert torch.equal(loser.weight, winner.weight)
+    assert sorted(os.listdir(tmp_path)) == ["model.pt"] # No '.tmp' left behind
+
+    def replace_denied(source, destination):
+        raise PermissionError(13, "Access is denied", destination)
+    monkeypatch.setattr(os, 'replace', replace_denied)
+    with pytest.raises(PermissionError): # Nobody wrote the file: the error is real
+        share_torch_weights(torch.nn.Linear(4, 3), str(tmp_path / "other.pt"))
+    assert sorted(os.listdir(tmp_path)) == ["model.pt"]
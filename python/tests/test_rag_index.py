@@ -0,0 +1,216 @@
+"""
+Tests for rag_index: snapshot round trips and integrity checks, and exact search over exported flat indexes
+(directory and snapshot), checked against numpy brute force.
+"""
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from rag_index import (DISTANCE_SPACES, BinaryQuantizedIndex, FlatIndex, read_index_snapshot, stored_matrix,
+                       verify_index_snapshot, write_flat_index, write_index_snapshot, zstd_functions)
+
+COUNT, DIM = 200, 48
+API_NAMES = ('FilteredElementCollector', 'BuiltInParameter', 'Wall', 'Document.Create.NewFloor')
+ELEMENT_TYPES = ('Class', 'Method', 'Property')
+
+def synthetic_collection(seed=0):
+    # ids, embeddings, documents and metadatas shaped like a Chroma export; row 3 has no text, row 5 no metadata
+    rng = np.random.default_rng(seed)
+    embeddings = rng.standard_normal((COUNT, DIM)).astype(np.float32)
+    ids = [f"chunk-{i}" for i in range(COUNT)]
+    documents = [f"Document {i}: " + "Revit API text " * (i % 7) for i in range(COUNT)]
+    documents[3] = ''
+    metadatas = [{'api_element_name': API_NAMES[i % 4], 'element_type': ELEMENT_TYPES[i % 3], 'page': i} for i in range(COUNT)]
+    metadatas[5] = {}
+    return ids, embeddings, documents, metadatas
+
+def brute_force(embeddings, queries, space, k, rows=None):
+    # (row indices, distances) of the k nearest stored rows per query in float64, ties broken by row
+    stored = stored_matrix(embeddings, space).astype(np.float16).astype(np.float64)
+    rows = np.arange(len(stored)) if rows is None else np.asarray(rows)
+    stored = stored[rows]
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float64))
+    if space == 'cosine':
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    if space == 'l2':
+        distances = ((queries[:, None, :] - stored[None, :, :]) ** 2).sum(axis=2)
+    else:
+        distances = 1.0 - queries @ stored.T
+    order = [np.lexsort((rows, row_distances))[:k] for row_distances in distances]
+    return [rows[o] for o in order], [row_distances[o] for row_distances, o in zip(distances, order)]
+
+def has_zstd():
+    try:
+        zstd_functions()
+        return True
+    except ImportError:
+        return False
+
+needs_zstd = pytest.mark.skipif(not has_zstd(), reason="snapshots need zstd")
+
+def write_snapshot(tmp_path, space='cosine'):
+    ids, embeddings, documents, metadatas = synthetic_collection()
+    path = str(tmp_path / "index.ragidx")
+    write_index_snapshot(path, ids, embeddings, documents, metadatas, {'collection': 'test', 'space': space}, level=3)
+    return path
+
+def corrupt(path, offset):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        value = f.read(1)
+        f.seek(offset)
+        f.write(bytes([value[0] ^ 0xFF]))
+
+@pytest.fixture(params=[(storage, space) for storage in ('directory', pytest.param('snapshot', marks=needs_zstd))
+                        for space in DISTANCE_SPACES])
+def flat_index(request, tmp_path):
+    storage, space = request.param
+    ids, embeddings, documents, metadatas = synthetic_collection()
+    if storage == 'snapshot':
+        path = write_snapshot(tmp_path, space)
+    else:
+        path = str(tmp_path / "index")
+        write_flat_index(path, ids, embeddings, documents, metadatas, {'collection': 'test', 'space': space})
+    return FlatIndex(path), embeddings
+
+# --- Snapshots ---
+
+@needs_zstd
+def test_snapshot_round_trip(tmp_path):
+    ids, embeddings, documents, metadatas = synthetic_collection()
+    path = write_snapshot(tmp_path)
+    header, stored, codes, stored_ids, stored_documents, stored_metadatas = read_index_snapshot(path)
+    assert (header['collection'], header['space'], header['count'], header['dim']) == ('test', 'cosine', COUNT, DIM)
+    assert [stored_ids[i] for i in range(COUNT)] == ids
+    assert [stored_documents[i] for i in range(COUNT)] == documents
+    assert [stored_metadatas[i] for i in range(COUNT)] == metadatas
+    np.testing.assert_array_equal(stored, stored_matrix(embeddings, 'cosine').astype(np.float16))
+    assert codes.shape == (COUNT, 1)
+
+@needs_zstd
+def test_verify_returns_header(tmp_path):
+    path = write_snapshot(tmp_path)
+    assert verify_index_snapshot(path) == read_index_snapshot(path)[0]
+
+@needs_zstd
+def test_corrupt_header_is_detected(tmp_path):
+    path = write_snapshot(tmp_path)
+    corrupt(path, 40) # Inside the JSON header, just after the preamble
+    with pytest.raises(ValueError, match="CRC mismatch"):
+        verify_index_snapshot(path)
+    with pytest.raises(ValueError, match="CRC mismatch"):
+        FlatIndex(path)
+
+@needs_zstd
+def test_corrupt_contents_are_detected(tmp_path):
+    path = write_snapshot(tmp_path)
+    corrupt(path, os.path.getsize(path) - 100)
+    with pytest.raises(ValueError, match="does not match its checksum"):
+        verify_index_snapshot(path)
+
+@needs_zstd
+def test_truncated_snapshot_is_detected(tmp_path):
+    path = write_snapshot(tmp_path)
+    os.truncate(path, os.path.getsize(path) - 1000)
+    with pytest.raises(ValueError, match="truncated"):
+        verify_index_snapshot(path)
+    with pytest.raises(ValueError, match="truncated"):
+        read_index_snapshot(path)
+
+def test_other_files_are_rejected(tmp_path):
+    path = tmp_path / "index.ragidx"
+    path.write_bytes(b"not a snapshot" * 10)
+    with pytest.raises(ValueError, match="bad magic bytes"):
+        verify_index_snapshot(str(path))
+
+# --- Exact Search ---
+
+def test_query_matches_brute_force(flat_index):
+    index, embeddings = flat_index
+    queries = np.random.default_rng(1).standard_normal((5, DIM)).astype(np.float32)
+    result = index.query(queries, n_results=10, include=['distances'])
+    expected_rows, expected_distances = brute_force(embeddings, queries, index.space, 10)
+    for ids, distances, rows, reference in zip(result['ids'], result['distances'], expected_rows, expected_distances):
+        assert ids == [f"chunk-{row}" for row in rows]
+        np.testing.assert_allclose(distances, reference, rtol=1e-4, atol=1e-3)
+
+def test_query_returns_documents_and_metadata(flat_index):
+    index, _ = flat_index
+    ids, _, documents, metadatas = synthetic_collection()
+    result = index.query(np.asarray(index.embeddings[:4], dtype=np.float32), n_results=3)
+    for query_ids, query_documents, query_metadatas in zip(result['ids'], result['documents'], result['metadatas']):
+        rows = [ids.index(i) for i in query_ids]
+        assert query_documents == [documents[row] for row in rows]
+        assert query_metadatas == [metadatas[row] for row in rows]
+
+def test_query_more_results_than_rows(flat_index):
+    index, _ = flat_index
+    result = index.query(np.ones((1, DIM), dtype=np.float32), n_results=COUNT + 50, include=['distances'])
+    assert sorted(result['ids'][0]) == sorted(f"chunk-{i}" for i in range(COUNT))
+    assert result['distances'][0] == sorted(result['distances'][0])
+
+def test_top_k_breaks_ties_by_row(flat_index):
+    index, _ = flat_index
+    distances = np.array([[0.5, 0.1, 0.5, 0.1, 0.9]], dtype=np.float32)
+    assert index.top_k(distances, 4).tolist() == [[1, 3, 0, 2]]
+
+def test_get_keeps_requested_order_and_skips_unknown_ids(flat_index):
+    index, _ = flat_index
+    result = index.get(ids=['chunk-7', 'missing', 'chunk-2'])
+    assert result['ids'] == ['chunk-7', 'chunk-2']
+    assert result['documents'] == [synthetic_collection()[2][7], synthetic_collection()[2][2]]
+
+def test_binary_index_with_full_shortlist_is_exact(flat_index):
+    index, embeddings = flat_index
+    binary = BinaryQuantizedIndex(index.path, candidates_per_result=COUNT, min_candidates=COUNT)
+    queries = np.random.default_rng(2).standard_normal((3, DIM)).astype(np.float32)
+    assert binary.query(queries, n_results=10, include=['distances'])['ids'] == \
+        index.query(queries, n_results=10, include=['distances'])['ids']
+
+# --- Metadata Filters ---
+
+WHERE_CASES = [
+    ({'element_type': 'Class'}, lambda m: m.get('element_type') == 'Class'),
+    ({'element_type': {'$eq': 'Method'}}, lambda m: m.get('element_type') == 'Method'),
+    ({'element_type': {'$ne': 'Method'}}, lambda m: m.get('element_type') != 'Method'),
+    ({'api_element_name': {'$in': ['Wall', 'BuiltInParameter']}}, lambda m: m.get('api_element_name') in ('Wall', 'BuiltInParameter')),
+    ({'api_element_name': {'$nin': ['Wall', 'BuiltInParameter']}}, lambda m: m.get('api_element_name') not in ('Wall', 'BuiltInParameter')),
+    ({'api_element_name': 'Wall', 'element_type': 'Property'},
+     lambda m: m.get('api_element_name') == 'Wall' and m.get('element_type') == 'Property'),
+    ({'$and': [{'element_type': {'$ne': 'Class'}}, {'page': {'$in': list(range(0, COUNT, 5))}}]},
+     lambda m: m.get('element_type') != 'Class' and m.get('page') in range(0, COUNT, 5)),
+    ({'$or': [{'api_element_name': 'Document.Create.NewFloor'}, {'element_type': {'$eq': 'Class'}}]},
+     lambda m: m.get('api_element_name') == 'Document.Create.NewFloor' or m.get('element_type') == 'Class'),
+    ({'$or': [{'$and': [{'element_type': 'Method'}, {'api_element_name': 'Wall'}]}, {'page': 7}]},
+     lambda m: (m.get('element_type') == 'Method' and m.get('api_element_name') == 'Wall') or m.get('page') == 7),
+]
+
+@pytest.mark.parametrize('where, predicate', WHERE_CASES)
+def test_where_rows_match_predicate(flat_index, where, predicate):
+    index, _ = flat_index
+    metadatas = synthetic_collection()[3]
+    assert index.where_rows(where).tolist() == [i for i, metadata in enumerate(metadatas) if predicate(metadata)]
+
+@pytest.mark.parametrize('where, predicate', WHERE_CASES[2:5])
+def test_filtered_query_matches_brute_force_on_subset(flat_index, where, predicate):
+    index, embeddings = flat_index
+    rows = [i for i, metadata in enumerate(synthetic_collection()[3]) if predicate(metadata)]
+    queries = np.random.default_rng(3).standard_normal((3, DIM)).astype(np.float32)
+    result = index.query(queries, n_results=8, include=['distances'], where=where)
+    expected_rows, expected_distances = brute_force(embeddings, queries, index.space, 8, rows=rows)
+    for ids, distances, query_rows, reference in zip(result['ids'], result['distances'], expected_rows, expected_distances):
+        assert ids == [f"chunk-{row}" for row in query_rows]
+        np.testing.assert_allclose(distances, reference, rtol=1e-4, atol=1e-3)
+
+def test_row_without_metadata_only_matches_negations(flat_index):
+    index, _ = flat_index
+    assert 5 not in index.where_rows({'element_type': {'$in': list(ELEMENT_TYPES)}}).tolist()
+    assert 5 in index.where_rows({'element_type': {'$nin': ['Class']}}).tolist()
+    assert index.where_rows({'no_such_key': 'Wall'}).tolist() == []
+
+def test_unsupported_operator_is_rejected(flat_index):
+    index, _ = flat_index
+    with pytest.raises(ValueError, match=r"Unsupported metadata filter operator '\$gt'"):
+        index.where_rows({'page': {'$gt': 3}})